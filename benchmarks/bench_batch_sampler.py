@@ -0,0 +1,66 @@
+"""Epoch time of the in-memory ``TensorEnsembleBatchSampler``, against ``EnsembleBufferDataset`` + ``DataLoader``.
+
+Only the iteration over batches is timed, as an epoch of training without the forward and backward, e.g.:
+
+    python benchmarks/bench_batch_sampler.py --data-size 1000000 --num-workers 8
+"""
+
+import argparse
+import time
+from multiprocessing import cpu_count
+
+import torch
+from torch.utils.data import DataLoader
+
+from cmrl.models.data_loader import EnsembleBufferDataset, TensorEnsembleBatchSampler, collate_fn
+
+
+def make_data(data_size, obs_dim, act_dim):
+    inputs = dict([("obs_{}".format(i), torch.rand(data_size, 1)) for i in range(obs_dim)])
+    inputs.update([("act_{}".format(i), torch.rand(data_size, 1)) for i in range(act_dim)])
+    outputs = dict([("next_obs_{}".format(i), torch.rand(data_size, 1)) for i in range(obs_dim)])
+    return inputs, outputs
+
+
+def epoch_time(loader, device):
+    start = time.perf_counter()
+    batch_num = 0
+    for inputs, outputs in loader:
+        # the batch is ready to use on the device
+        next(iter(inputs.values())).to(device)
+        batch_num += 1
+    if torch.device(device).type == "cuda":
+        torch.cuda.synchronize()
+    return time.perf_counter() - start, batch_num
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data-size", type=int, default=1000000)
+    parser.add_argument("--obs-dim", type=int, default=11)
+    parser.add_argument("--act-dim", type=int, default=3)
+    parser.add_argument("--ensemble-num", type=int, default=7)
+    parser.add_argument("--batch-size", type=int, default=256)
+    parser.add_argument("--num-workers", type=int, default=cpu_count())
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    args = parser.parse_args()
+
+    inputs, outputs = make_data(args.data_size, args.obs_dim, args.act_dim)
+    train_set = EnsembleBufferDataset(inputs, outputs, training=True, ensemble_num=args.ensemble_num, seed=1)
+
+    print("{:<32}{:>14}{:>10}".format("loader", "epoch (s)", "batches"))
+
+    loader = DataLoader(train_set, batch_size=args.batch_size, collate_fn=collate_fn, num_workers=args.num_workers)
+    elapsed, batch_num = epoch_time(loader, args.device)
+    print("{:<32}{:>14.2f}{:>10}".format("DataLoader({} workers)".format(args.num_workers), elapsed, batch_num))
+
+    start = time.perf_counter()
+    sampler = TensorEnsembleBatchSampler(inputs, outputs, train_set.indexes, args.batch_size, device=args.device)
+    build_time = time.perf_counter() - start
+    elapsed, batch_num = epoch_time(sampler, args.device)
+    print("{:<32}{:>14.2f}{:>10}".format("TensorEnsembleBatchSampler", elapsed, batch_num))
+    print("{:<32}{:>14.2f}".format("  (packing, once per learn)", build_time))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""Peak memory and wall time of the masked encoder reduction, against the repeat-and-index path it replaces.
+
+Every measurement runs in a fresh process so that the peak RSS belongs to one path only, e.g.:
+
+    python benchmarks/bench_encoder_reduction.py --batch-size 256 --encoder-output-dim 100
+"""
+
+import argparse
+import multiprocessing as mp
+import resource
+import time
+
+import torch
+
+from cmrl.models.causal_mech.util import masked_encoder_reduction
+
+
+def repeated_reduction(encoder_output, mask, reduction):
+    mask = mask.repeat((1,) * len(mask.shape[:-3]) + (*encoder_output.shape[:2], 1))
+    mask = mask[..., None].repeat([1] * len(mask.shape) + [encoder_output.shape[-1]])
+    masked_encoder_output = encoder_output.repeat(tuple(mask.shape[:-4]) + (1,) * 4)
+    masked_encoder_output[mask == 0] = -float("inf") if reduction == "max" else 0
+
+    if reduction == "sum":
+        return masked_encoder_output.sum(-2)
+    elif reduction == "mean":
+        return masked_encoder_output.mean(-2)
+    else:
+        return masked_encoder_output.max(-2)[0]
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run(path, reduction, args, queue):
+    torch.manual_seed(0)
+    encoder_output = torch.rand(args.ensemble_num, args.batch_size, args.input_var_num, args.encoder_output_dim)
+    mask = torch.randint(2, (args.output_var_num, args.input_var_num))[:, None, None, :]
+    reduce = repeated_reduction if path == "repeat" else masked_encoder_reduction
+
+    base_rss = peak_rss_mb()
+    reduce(encoder_output, mask, reduction)  # warm up
+    start = time.perf_counter()
+    for _ in range(args.repeat):
+        reduce(encoder_output, mask, reduction)
+    elapsed = (time.perf_counter() - start) / args.repeat
+    queue.put((elapsed, peak_rss_mb() - base_rss, peak_rss_mb()))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--ensemble-num", type=int, default=7)
+    parser.add_argument("--batch-size", type=int, default=1024)
+    parser.add_argument("--input-var-num", type=int, default=20)
+    parser.add_argument("--output-var-num", type=int, default=20)
+    parser.add_argument("--encoder-output-dim", type=int, default=200)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--paths", nargs="+", default=["repeat", "fused"])
+    parser.add_argument("--reductions", nargs="+", default=["sum", "mean", "max"])
+    args = parser.parse_args()
+
+    ctx = mp.get_context("spawn")
+    print("{:<8}{:<8}{:>14}{:>18}{:>16}".format("path", "reduce", "time (ms)", "peak delta (MB)", "peak rss (MB)"))
+    for reduction in args.reductions:
+        for path in args.paths:
+            queue = ctx.Queue()
+            proc = ctx.Process(target=run, args=(path, reduction, args, queue))
+            proc.start()
+            proc.join()
+            if proc.exitcode != 0:
+                print("{:<8}{:<8}{:>14}".format(path, reduction, "failed (oom?)"))
+                continue
+            elapsed, delta, peak = queue.get()
+            print("{:<8}{:<8}{:>14.2f}{:>18.1f}{:>16.1f}".format(path, reduction, elapsed * 1e3, delta, peak))
+
+
+if __name__ == "__main__":
+    main()
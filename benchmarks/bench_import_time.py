@@ -0,0 +1,51 @@
+"""Import time of causal mechs, and the heavy modules it pulls in, from ``python -X importtime``, e.g.:
+
+    python benchmarks/bench_import_time.py --module cmrl.models.causal_mech --repeat 5
+
+CI tests are imported on first use through ``cmrl.utils.ci_test``, so none of R (rpy2), sklearn, causallearn or
+``cmrl.utils.RCIT`` should be imported by any mech. The time of importing ``cmrl.utils.RCIT`` itself, paid on the
+first CI test, is reported alongside.
+"""
+
+import argparse
+import subprocess
+import sys
+
+HEAVY_MODULES = ["rpy2", "sklearn", "causallearn", "cmrl.utils.RCIT", "scipy.stats"]
+
+
+def import_time(module):
+    """Cumulative import time of module in microseconds, and all modules imported in a fresh interpreter."""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import {}".format(module)], capture_output=True, text=True
+    )
+    assert result.returncode == 0, result.stderr
+
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "imported package" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:") :].split("|")
+        if cumulative_us.strip().isdigit():
+            times[name.strip()] = int(cumulative_us)
+    return times[module], set(times.keys())
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--module", type=str, nargs="+", default=["cmrl.models.causal_mech", "cmrl.utils.RCIT"])
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    print("{:<32}{:>16}   {}".format("module", "best (ms)", "heavy modules imported"))
+    for module in args.module:
+        results = [import_time(module) for _ in range(args.repeat)]
+        best = min(cumulative_us for cumulative_us, _ in results) / 1000
+        imported = results[0][1] - {module}
+        # a package counts as imported with any of its submodules
+        heavy = [name for name in HEAVY_MODULES if any(m == name or m.startswith(name + ".") for m in imported)]
+        print("{:<32}{:>16.1f}   {}".format(module, best, ", ".join(heavy) if heavy else "-"))
+
+
+if __name__ == "__main__":
+    main()
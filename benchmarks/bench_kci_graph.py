@@ -0,0 +1,75 @@
+"""Wall time of discovering the graph of ``KernelTestMech`` by KCI tests on a Hopper-sized variable set (11 obs and 3
+act variables), with tests run in the current process against a pool of ``--workers`` processes, e.g.:
+
+    python benchmarks/bench_kci_graph.py --obs-dim 11 --act-dim 3 --workers 1 4 8
+
+Data is synthetic, every next-obs depending on its obs and two random other inputs.
+"""
+
+import argparse
+import pathlib
+import tempfile
+import time
+
+import numpy as np
+from gym import spaces
+
+from cmrl.models.causal_mech.kernel_test import KernelTestMech
+from cmrl.utils.variables import parse_space
+
+
+def make_data(input_variables, output_variables, data_num, seed=0):
+    rng = np.random.default_rng(seed)
+    inputs = dict([(var.name, rng.uniform(-1, 1, (data_num, 1))) for var in input_variables])
+    in_names = list(inputs.keys())
+
+    outputs = {}
+    for var in output_variables:
+        obs_name = var.name.replace("next_", "")
+        parents = rng.choice([name for name in in_names if name != obs_name], size=2, replace=False)
+        effect = sum(np.sin(2 * inputs[name]) for name in parents)
+        outputs[var.name] = inputs[obs_name] + effect + 0.1 * rng.standard_normal((data_num, 1))
+    return inputs, outputs
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--obs-dim", type=int, default=11)
+    parser.add_argument("--act-dim", type=int, default=3)
+    parser.add_argument("--data-num", type=int, default=5000)
+    parser.add_argument("--sample-num", type=int, default=256)
+    parser.add_argument("--kci-times", type=int, default=16)
+    parser.add_argument("--longest-sample", type=int, default=1000)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 4])
+    args = parser.parse_args()
+
+    state_space = spaces.Box(-1, 1, (args.obs_dim,), dtype=np.float32)
+    action_space = spaces.Box(-1, 1, (args.act_dim,), dtype=np.float32)
+    input_variables = parse_space(state_space, "obs") + parse_space(action_space, "act")
+    output_variables = parse_space(state_space, "next_obs")
+    inputs, outputs = make_data(input_variables, output_variables, args.data_num)
+
+    results = []
+    for workers in args.workers:
+        mech = KernelTestMech(
+            "transition",
+            input_variables,
+            output_variables,
+            sample_num=args.sample_num,
+            kci_times=args.kci_times,
+            longest_sample=args.longest_sample,
+            kci_workers=workers,
+        )
+        np.random.seed(0)
+        with tempfile.TemporaryDirectory() as work_dir:
+            start = time.perf_counter()
+            graph = mech.kci_compute_graph(inputs, outputs, work_dir=pathlib.Path(work_dir))
+            results.append((workers, time.perf_counter() - start, graph))
+
+    print("{:<12}{:>14}{:>18}".format("workers", "wall (s)", "same graph"))
+    for workers, wall, graph in results:
+        print("{:<12}{:>14.2f}{:>18}".format(workers, wall, str((graph == results[0][2]).all())))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+"""Runtime, peak memory and p-values of a single KCI test, exact against its low-rank approximations, e.g.:
+
+    python benchmarks/bench_kci_lowrank.py --sizes 1000 2000 20000 --exact-max-size 2000 --ranks 100 200
+
+x depends on 2 of the conditioning inputs z only, so x is independent of y given z, and the p-values of the
+approximations should stay close to the exact one. With a multi-dimensional y (``--y-dim``) there are more products
+of the eigenvectors of the kernels of x and y than samples, of which ``--max-eig-products`` are kept. Peak memory is
+traced by tracemalloc, which numpy reports to.
+"""
+
+import argparse
+import time
+import tracemalloc
+
+import numpy as np
+
+from cmrl.utils.RCIT import KCI_CInd
+
+
+def make_data(data_num, z_dim, y_dim=1, seed=0):
+    rng = np.random.default_rng(seed)
+    data_y = rng.uniform(-1, 1, (data_num, y_dim))
+    data_z = rng.uniform(-1, 1, (data_num, z_dim))
+    data_x = np.sin(2 * data_z[:, :1]) + data_z[:, 1:2] ** 2 + 0.2 * rng.standard_normal((data_num, 1))
+    return data_x, data_y, data_z
+
+
+def run_test(data_x, data_y, data_z, **kwargs):
+    tracemalloc.start()
+    start = time.perf_counter()
+    p_value, _ = KCI_CInd(**kwargs).compute_pvalue(data_x, data_y, data_z)
+    wall = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return p_value, wall, peak / 2**20
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--z-dim", type=int, default=13)
+    parser.add_argument("--y-dim", type=int, default=1)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 2000, 20000])
+    parser.add_argument("--exact-max-size", type=int, default=2000)
+    parser.add_argument("--ranks", type=int, nargs="+", default=[100, 200])
+    parser.add_argument("--max-eig-products", type=int, default=2000)
+    args = parser.parse_args()
+
+    row = "{:<16}{:>10}{:>8}{:>12.2f}{:>14.1f}{:>12.3f}"
+    print("{:<16}{:>10}{:>8}{:>12}{:>14}{:>12}".format("kernel", "samples", "rank", "time (s)", "memory (MiB)", "p-value"))
+    for size in args.sizes:
+        data_x, data_y, data_z = make_data(size, args.z_dim, args.y_dim)
+        if size <= args.exact_max_size:
+            p_value, wall, peak = run_test(data_x, data_y, data_z, max_eig_products=args.max_eig_products)
+            print(row.format("exact", size, "-", wall, peak, p_value))
+        for factorization in ["nystrom", "icholesky"]:
+            for rank in args.ranks:
+                p_value, wall, peak = run_test(
+                    data_x, data_y, data_z, rank=rank, factorization=factorization, max_eig_products=args.max_eig_products
+                )
+                print(row.format(factorization, size, rank, wall, peak, p_value))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""Startup time of building causal-mechs on a Hopper-sized variable set (11 obs and 3 act variables), with the
+whole-tensor truncated-normal initialisation of ``ParallelLinear``, against the former rejection sampling of every
+parallel slice, e.g.:
+
+    python benchmarks/bench_mech_build.py --obs-dim 11 --act-dim 3
+
+``ReinforceCausalMech`` builds the same ``ParallelMLP`` of ``extra_dims=[output-var-num, ensemble-num]`` as the mechs
+here, so its build time follows ``OracleMech``.
+"""
+
+import argparse
+import time
+from itertools import product
+
+import numpy as np
+import torch
+from gym import spaces
+
+from cmrl.models.layers import ParallelLinear
+from cmrl.models.causal_mech.oracle_mech import OracleMech
+from cmrl.models.causal_mech.CMI_test import CMITestMech
+from cmrl.utils.variables import parse_space
+
+
+def rejection_truncated_normal_(tensor, mean=0, std=1):
+    # the former sampler, which loops with a sync until no value violates the bounds
+    torch.nn.init.normal_(tensor, mean=mean, std=std)
+    while True:
+        cond = torch.logical_or(tensor < mean - 2 * std, tensor > mean + 2 * std)
+        bound_violations = torch.sum(cond).item()
+        if bound_violations == 0:
+            break
+        tensor[cond] = torch.normal(mean, std, size=(bound_violations,), device=tensor.device)
+    return tensor
+
+
+def sliced_init_params(self):
+    # the former initialisation, slice by slice
+    stddev = 1 / (2 * np.sqrt(self.input_dim))
+    for dims in product(*map(range, self.extra_dims)):
+        rejection_truncated_normal_(self.weight.data[dims], std=stddev)
+
+
+def build_time(mech_class, input_variables, output_variables, ensemble_num, repeat):
+    # warm-up
+    mech_class("transition", input_variables, output_variables, ensemble_num=ensemble_num)
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        mech_class("transition", input_variables, output_variables, ensemble_num=ensemble_num)
+    return (time.perf_counter() - start) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--obs-dim", type=int, default=11)
+    parser.add_argument("--act-dim", type=int, default=3)
+    parser.add_argument("--ensemble-num", type=int, default=7)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    state_space = spaces.Box(-1, 1, (args.obs_dim,), dtype=np.float32)
+    action_space = spaces.Box(-1, 1, (args.act_dim,), dtype=np.float32)
+    input_variables = parse_space(state_space, "obs") + parse_space(action_space, "act")
+    output_variables = parse_space(state_space, "next_obs")
+
+    print("{:<24}{:>18}{:>18}".format("mech", "sliced init (s)", "whole init (s)"))
+    for mech_class in [OracleMech, CMITestMech]:
+        whole_init_params = ParallelLinear.init_params
+        ParallelLinear.init_params = sliced_init_params
+        try:
+            sliced = build_time(mech_class, input_variables, output_variables, args.ensemble_num, args.repeat)
+        finally:
+            ParallelLinear.init_params = whole_init_params
+        whole = build_time(mech_class, input_variables, output_variables, args.ensemble_num, args.repeat)
+        print("{:<24}{:>18.3f}{:>18.3f}".format(mech_class.__name__, sliced, whole))
+
+
+if __name__ == "__main__":
+    main()
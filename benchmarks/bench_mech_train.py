@@ -0,0 +1,92 @@
+"""Epoch time of training a causal-mech in fp32 eager mode, against the accelerated training modes of
+``EnsembleNeuralMech`` (bf16 autocast and/or ``torch.compile``, without per-batch syncs), e.g.:
+
+    python benchmarks/bench_mech_train.py --data-size 100000 --device cpu
+
+The first epoch of every mode is a warm-up (and compiles the forward if needed), and not timed.
+"""
+
+import argparse
+import time
+from functools import partial
+
+import numpy as np
+import torch
+
+from cmrl.models.causal_mech.oracle_mech import OracleMech
+from cmrl.models.causal_mech.util import variable_loss_func, train_func
+from cmrl.models.data_loader import TensorEnsembleBatchSampler
+from cmrl.utils.variables import ContinuousVariable
+
+
+MODES = [
+    ("fp32 eager", None, False),
+    ("bf16 autocast", "bfloat16", False),
+    ("fp32 compile", None, True),
+    ("bf16 autocast + compile", "bfloat16", True),
+]
+
+
+def make_data(data_size, obs_dim, act_dim):
+    inputs = dict([("obs_{}".format(i), torch.rand(data_size, 1)) for i in range(obs_dim)])
+    inputs.update([("act_{}".format(i), torch.rand(data_size, 1)) for i in range(act_dim)])
+    outputs = dict([("next_obs_{}".format(i), torch.rand(data_size, 1)) for i in range(obs_dim)])
+    return inputs, outputs
+
+
+def epoch_time(mech, loader, device, epochs):
+    # the same as ``EnsembleNeuralMech.learn``
+    progress = mech.autocast_dtype is None and not mech.compile_forward
+    forward = mech.autocast_forward
+    loss_func = partial(variable_loss_func, output_variables=mech.output_variables, device=device, check_finite=progress)
+    if mech.compile_forward:
+        forward, loss_func = torch.compile(forward), torch.compile(loss_func)
+    train = partial(train_func, forward=forward, optimizer=mech.optimizer, loss_func=loss_func, progress=progress)
+
+    # warm-up
+    train(loader)
+
+    start = time.perf_counter()
+    for _ in range(epochs):
+        loss = train(loader)
+    if torch.device(device).type == "cuda":
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / epochs, loss.mean().item()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data-size", type=int, default=100000)
+    parser.add_argument("--obs-dim", type=int, default=11)
+    parser.add_argument("--act-dim", type=int, default=3)
+    parser.add_argument("--ensemble-num", type=int, default=7)
+    parser.add_argument("--batch-size", type=int, default=256)
+    parser.add_argument("--epochs", type=int, default=3)
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    args = parser.parse_args()
+
+    inputs, outputs = make_data(args.data_size, args.obs_dim, args.act_dim)
+    input_variables = [ContinuousVariable(name, dim=1) for name in inputs]
+    output_variables = [ContinuousVariable(name, dim=1) for name in outputs]
+    indexes = np.random.randint(args.data_size, size=(args.data_size, args.ensemble_num))
+    loader = TensorEnsembleBatchSampler(inputs, outputs, indexes, args.batch_size, device=args.device)
+
+    print("{:<32}{:>14}{:>12}".format("mode", "epoch (s)", "loss"))
+    for mode, autocast_dtype, compile_forward in MODES:
+        torch.manual_seed(0)
+        mech = OracleMech(
+            "transition",
+            input_variables,
+            output_variables,
+            ensemble_num=args.ensemble_num,
+            batch_size=args.batch_size,
+            autocast_dtype=autocast_dtype,
+            compile_forward=compile_forward,
+            device=args.device,
+        )
+        elapsed, loss = epoch_time(mech, loader, args.device, args.epochs)
+        print("{:<32}{:>14.2f}{:>12.4f}".format(mode, elapsed, loss))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+"""Agent steps of MBPO-style training, fed by stepping ``num_envs`` fake envs on every step (SB3's collection), or by
+``BranchRolloutCallback`` with ``feeding_collect_rollouts``, where the fake env is not stepped at all, e.g.:
+
+    python benchmarks/bench_rollout_feeding.py --num-envs 1000 --agent-steps 500
+"""
+
+import argparse
+import time
+from types import MethodType
+
+import numpy as np
+import torch
+from gym import spaces
+from stable_baselines3 import SAC
+from stable_baselines3.common.buffers import ReplayBuffer
+from stable_baselines3.common.vec_env import VecMonitor
+
+from cmrl.models.causal_mech.oracle_mech import OracleMech
+from cmrl.models.dynamics import Dynamics
+from cmrl.models.fake_env import VecFakeEnv
+from cmrl.sb3_extension.branch_rollout_callback import BranchRolloutCallback, feeding_collect_rollouts
+from cmrl.utils.variables import parse_space
+
+
+def make_dynamics(obs_dim, act_dim, device):
+    state_space = spaces.Box(-1, 1, (obs_dim,), dtype=np.float32)
+    action_space = spaces.Box(-1, 1, (act_dim,), dtype=np.float32)
+    input_variables = parse_space(state_space, "obs") + parse_space(action_space, "act")
+    output_variables = parse_space(state_space, "next_obs")
+    transition = OracleMech("transition", input_variables, output_variables, device=device)
+    transition.set_oracle_graph(None)
+
+    return Dynamics(
+        transition,
+        state_space,
+        action_space,
+        obs2state_fn=lambda obs, extra_obs: obs,
+        state2obs_fn=lambda state: state,
+    )
+
+
+def reward_fn(next_obs, obs, action):
+    return -np.square(next_obs).sum(-1)
+
+
+def termination_fn(next_obs, obs, action):
+    return np.zeros(len(next_obs), dtype=bool)
+
+
+def run(dynamics, real_replay_buffer, num_envs, feeding, args):
+    fake_env = VecFakeEnv(
+        num_envs,
+        dynamics.state_space,
+        dynamics.action_space,
+        dynamics,
+        reward_fn,
+        termination_fn,
+        real_replay_buffer=real_replay_buffer,
+        max_episode_steps=args.rollout_length,
+        branch_rollout=True,
+    )
+    env_steps = [0]
+    step_wait = fake_env.step_wait
+
+    def counted_step_wait():
+        env_steps[0] += 1
+        return step_wait()
+
+    fake_env.step_wait = counted_step_wait
+
+    agent = SAC("MlpPolicy", VecMonitor(fake_env), learning_starts=0, buffer_size=args.buffer_size, device=args.device)
+    callback = None
+    if feeding:
+        agent.collect_rollouts = MethodType(feeding_collect_rollouts, agent)
+        callback = BranchRolloutCallback(
+            dynamics,
+            real_replay_buffer,
+            reward_fn,
+            termination_fn,
+            rollout_batch_size=args.rollout_batch_size,
+            rollout_length=args.rollout_length,
+            freq_rollout=args.freq_rollout,
+            seed=0,
+        )
+
+    start = time.perf_counter()
+    agent.learn(total_timesteps=args.agent_steps * (1 if feeding else num_envs), callback=callback)
+    elapsed = time.perf_counter() - start
+    # transitions of all envs in the buffer of the agent
+    return elapsed, env_steps[0], agent.replay_buffer.size() * agent.replay_buffer.n_envs
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--obs-dim", type=int, default=11)
+    parser.add_argument("--act-dim", type=int, default=3)
+    parser.add_argument("--num-envs", type=int, default=1000)
+    parser.add_argument("--agent-steps", type=int, default=500)
+    parser.add_argument("--rollout-batch-size", type=int, default=100000)
+    parser.add_argument("--rollout-length", type=int, default=1)
+    parser.add_argument("--freq-rollout", type=int, default=250)
+    parser.add_argument("--buffer-size", type=int, default=1000000)
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    args = parser.parse_args()
+
+    dynamics = make_dynamics(args.obs_dim, args.act_dim, args.device)
+    real_replay_buffer = ReplayBuffer(
+        10000, dynamics.state_space, dynamics.action_space, "cpu", handle_timeout_termination=False
+    )
+    real_replay_buffer.observations[:] = np.random.uniform(-1, 1, real_replay_buffer.observations.shape)
+    real_replay_buffer.full = True
+
+    print("{:<40}{:>12}{:>16}{:>14}".format("collection", "agent (s)", "fake env steps", "transitions"))
+    for name, num_envs, feeding in [
+        ("per-step fake env ({} envs)".format(args.num_envs), args.num_envs, False),
+        ("rollout feeding", 1, True),
+    ]:
+        elapsed, env_steps, transition_num = run(dynamics, real_replay_buffer, num_envs, feeding, args)
+        print("{:<40}{:>12.2f}{:>16}{:>14}".format(name, elapsed, env_steps, transition_num))
+
+
+if __name__ == "__main__":
+    main()
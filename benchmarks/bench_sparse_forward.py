@@ -0,0 +1,86 @@
+"""Forward (rollout) and training-step time of a causal-mech with sparse forward, against the dense masked forward,
+on a Hopper-sized variable set (11 obs and 3 act variables) and a random causal graph of the given density, e.g.:
+
+    python benchmarks/bench_sparse_forward.py --density 0.3 --batch-size 10000
+
+Only the encoders and the reduction over input variables are sparse, the network after the reduction costs the same
+whatever the number of parents.
+"""
+
+import argparse
+import time
+from functools import partial
+
+import numpy as np
+import torch
+from gym import spaces
+
+from cmrl.models.causal_mech.oracle_mech import OracleMech
+from cmrl.models.causal_mech.util import variable_loss_func
+from cmrl.utils.variables import parse_space
+
+
+def timeit(fn, repeat, device):
+    fn()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    if torch.device(device).type == "cuda":
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--obs-dim", type=int, default=11)
+    parser.add_argument("--act-dim", type=int, default=3)
+    parser.add_argument("--density", type=float, default=0.3)
+    parser.add_argument("--ensemble-num", type=int, default=7)
+    parser.add_argument("--batch-size", type=int, default=10000)
+    parser.add_argument("--train-batch-size", type=int, default=256)
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    args = parser.parse_args()
+
+    state_space = spaces.Box(-1, 1, (args.obs_dim,), dtype=np.float32)
+    action_space = spaces.Box(-1, 1, (args.act_dim,), dtype=np.float32)
+    input_variables = parse_space(state_space, "obs") + parse_space(action_space, "act")
+    output_variables = parse_space(state_space, "next_obs")
+
+    rng = np.random.default_rng(0)
+    graph = rng.random((len(input_variables), len(output_variables))) < args.density
+    print("graph with {} of {} edges, {} of {} inputs used".format(graph.sum(), graph.size, graph.any(1).sum(), len(graph)))
+
+    mech = OracleMech("transition", input_variables, output_variables, ensemble_num=args.ensemble_num, device=args.device)
+    mech.set_oracle_graph(graph)
+
+    def rollout_inputs(batch_size):
+        return dict([(var.name, torch.rand(1, batch_size, 1, device=args.device)) for var in input_variables])
+
+    inputs = rollout_inputs(args.batch_size)
+    train_inputs = dict([(name, value.repeat(args.ensemble_num, 1, 1)) for name, value in rollout_inputs(256).items()])
+    train_targets = dict([(var.name, torch.rand(args.ensemble_num, 256, 1, device=args.device)) for var in output_variables])
+    loss_func = partial(variable_loss_func, output_variables=output_variables, device=args.device)
+
+    @torch.no_grad()
+    def forward():
+        mech.forward(inputs)
+
+    def train_step():
+        loss = loss_func(mech.forward(train_inputs), train_targets)
+        mech.optimizer.zero_grad()
+        loss.mean().backward()
+        mech.optimizer.step()
+
+    print("{:<16}{:>16}{:>16}".format("forward", "rollout (ms)", "train step (ms)"))
+    for sparse_forward in [False, True]:
+        mech.sparse_forward = sparse_forward
+        mech.build_sparse_forward()
+        rollout_time = timeit(forward, args.repeat, args.device)
+        train_time = timeit(train_step, args.repeat, args.device)
+        name = "sparse" if sparse_forward else "dense"
+        print("{:<16}{:>16.2f}{:>16.2f}".format(name, rollout_time * 1e3, train_time * 1e3))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,17 +1,19 @@
 import os
 from typing import Optional
 from functools import partial
+from types import MethodType
 
 import numpy as np
 import torch
 from omegaconf import DictConfig, OmegaConf
 from stable_baselines3.common.buffers import ReplayBuffer
-from stable_baselines3.common.callbacks import BaseCallback
+from stable_baselines3.common.callbacks import BaseCallback, CallbackList
 import wandb
 
-from cmrl.models.fake_env import VecFakeEnv
+from cmrl.models.fake_env import VecFakeEnv, TorchVecFakeEnv
 from cmrl.sb3_extension.logger import configure as logger_configure
 from cmrl.sb3_extension.eval_callback import EvalCallback
+from cmrl.sb3_extension.branch_rollout_callback import BranchRolloutCallback, feeding_collect_rollouts
 from cmrl.utils.creator import create_dynamics, create_agent
 from cmrl.utils.env import make_env
 
@@ -69,9 +71,13 @@ class BaseAlgorithm:
             handle_timeout_termination=False,
         )
 
+        # keep the states of fake env on the device of dynamics
+        fake_env_cls = TorchVecFakeEnv if self.cfg.algorithm.get("torch_fake_env", False) else VecFakeEnv
+        # with rollout feeding, the fake env of the agent is never stepped, and only one is kept for evaluation
+        num_envs = 1 if self.rollout_feeding else self.cfg.algorithm.num_envs
         self.partial_fake_env = partial(
-            VecFakeEnv,
-            self.cfg.algorithm.num_envs,
+            fake_env_cls,
+            num_envs,
             self.env.state_space,
             self.env.action_space,
             self.dynamics,
@@ -80,9 +86,17 @@ class BaseAlgorithm:
             self.get_init_obs_fn,
             self.real_replay_buffer,
             penalty_coeff=self.cfg.task.penalty_coeff,
+            seed=self.cfg.seed,
             logger=self.logger,
         )
         self.agent = create_agent(self.cfg, self.fake_env, self.logger)
+        if self.rollout_feeding:
+            # the replay buffer of the agent is fed by ``BranchRolloutCallback`` instead of stepping the fake env
+            self.agent.collect_rollouts = MethodType(feeding_collect_rollouts, self.agent)
+
+    @property
+    def rollout_feeding(self) -> bool:
+        return self.cfg.algorithm.get("rollout_feeding", False)
 
     @property
     def fake_env(self) -> VecFakeEnv:
@@ -97,7 +111,7 @@ class BaseAlgorithm:
         fake_eval_env = self.partial_fake_env(
             deterministic=True, max_episode_steps=self.env.spec.max_episode_steps, branch_rollout=False
         )
-        return EvalCallback(
+        eval_callback = EvalCallback(
             self.eval_env,
             fake_eval_env,
             n_eval_episodes=self.cfg.task.n_eval_episodes,
@@ -106,6 +120,21 @@ class BaseAlgorithm:
             deterministic=True,
             render=False,
         )
+        if not self.rollout_feeding:
+            return eval_callback
+
+        # feed the agent with bulk branch-rollouts of dynamics
+        rollout_callback = BranchRolloutCallback(
+            self.dynamics,
+            self.real_replay_buffer,
+            self.reward_fn,
+            self.termination_fn,
+            rollout_batch_size=self.cfg.algorithm.rollout_batch_size,
+            rollout_length=self.cfg.algorithm.get("branch_rollout_length", 1),
+            freq_rollout=self.cfg.algorithm.freq_rollout,
+            seed=self.cfg.seed,
+        )
+        return CallbackList([eval_callback, rollout_callback])
 
     def learn(self):
         self._setup_learn()
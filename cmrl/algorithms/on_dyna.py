@@ -26,6 +26,10 @@ class OnlineDyna(BaseAlgorithm):
             total_online_timesteps=self.cfg.task.online_num_steps,
             initial_exploration_steps=self.cfg.algorithm.initial_exploration_steps,
             freq_train_model=self.cfg.task.freq_train_model,
+            train_steps_per_round=self.cfg.algorithm.get("train_steps_per_round", None),
+            epochs_per_round=self.cfg.algorithm.get("epochs_per_round", 5),
+            recent_ratio=self.cfg.algorithm.get("recent_ratio", 0.5),
+            async_learn=self.cfg.algorithm.get("async_learn", False),
             device=self.cfg.device,
         )
 
@@ -97,12 +97,8 @@ class CMITestMech(EnsembleNeuralMech):
         """
         batch_size, extra_dim = self.get_inputs_info(inputs)
 
-        inputs_tensor = torch.empty(*extra_dim, self.ensemble_num, batch_size, self.input_var_num, self.encoder_output_dim).to(
-            self.device
-        )
-        for i, var in enumerate(self.input_variables):
-            out = self.variable_encoders[var.name](inputs[var.name].to(self.device))
-            inputs_tensor[..., i, :] = out
+        # [..., ensemble-num, batch-size, input-var-num, encoder-output-dim]
+        inputs_tensor = self.encoder_bank(inputs)
 
         # if len(extra_dim) == 0:
         #     # [..., output-var-num, input-var-num]
@@ -140,19 +136,15 @@ class CMITestMech(EnsembleNeuralMech):
         #                 output_tensor[i, j] = outs[j]
 
         mask = self.CMI_mask
-        # [..., output-var-num, ensemble-num, batch-size, input-var-num]
+        # [..., output-var-num, 1, 1, input-var-num], broadcast to ensemble-num and batch-size in reduction
         mask = mask.unsqueeze(-2).unsqueeze(-2)
-        mask = mask.repeat((1,) * len(mask.shape[:-3]) + (self.ensemble_num, batch_size, 1))
         reduced_inputs_tensor = self.reduce_encoder_output(inputs_tensor, mask)
         assert (
             not torch.isinf(reduced_inputs_tensor).any() and not torch.isnan(reduced_inputs_tensor).any()
         ), "tensor must not be inf or nan"
         output_tensor = self.network(reduced_inputs_tensor)
 
-        outputs = {}
-        for i, var in enumerate(self.output_variables):
-            hid = output_tensor[:, i]
-            outputs[var.name] = self.variable_decoders[var.name](hid)
+        _, outputs = self.decoder_bank(output_tensor.transpose(0, 1))
 
         if self.residual:
             outputs = self.residual_outputs(inputs, outputs)
@@ -1,4 +1,4 @@
 from cmrl.models.causal_mech.oracle_mech import OracleMech
 from cmrl.models.causal_mech.CMI_test import CMITestMech
-# from cmrl.models.causal_mech.reinforce import ReinforceCausalMech
+from cmrl.models.causal_mech.reinforce import ReinforceCausalMech
 from cmrl.models.causal_mech.kernel_test import KernelTestMech
\ No newline at end of file
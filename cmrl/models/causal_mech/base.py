@@ -1,29 +1,31 @@
-from typing import Optional, List, Dict, Union, MutableMapping
+from typing import Callable, Optional, List, Dict, Tuple, Union, MutableMapping
 from abc import abstractmethod, ABC
 from itertools import chain, count
 import pathlib
 from functools import partial
-import copy
-from multiprocessing import cpu_count
 
 import numpy as np
 import torch
-from torch.utils.data import DataLoader
 from torch.optim import Optimizer
 from omegaconf import DictConfig
 from stable_baselines3.common.logger import Logger
 from hydra.utils import instantiate
 
-from cmrl.models.graphs.base_graph import BaseGraph
-from cmrl.models.graphs.binary_graph import BinaryGraph
-from cmrl.utils.variables import Variable
 from cmrl.models.constant import NETWORK_CFG, ENCODER_CFG, DECODER_CFG, OPTIMIZER_CFG, SCHEDULER_CFG
 from cmrl.models.networks.base_network import BaseNetwork
 from cmrl.models.graphs.base_graph import BaseGraph
-from cmrl.models.networks.coder import VariableEncoder, VariableDecoder
-from cmrl.utils.variables import Variable, ContinuousVariable, DiscreteVariable, BinaryVariable
-from cmrl.models.causal_mech.util import variable_loss_func, train_func, eval_func
-from cmrl.models.data_loader import EnsembleBufferDataset, collate_fn
+from cmrl.models.networks.coder import EncoderBank, DecoderBank
+from cmrl.utils.variables import Variable
+from cmrl.models.causal_mech.util import (
+    variable_loss_func,
+    train_func,
+    eval_func,
+    masked_encoder_reduction,
+    check_finite_loss,
+    EnsembleBestWeights,
+)
+from cmrl.models.layers import ParallelLinear
+from cmrl.models.data_loader import EnsembleDataSplit, PackedTensorData, TensorEnsembleBatchSampler
 
 
 class BaseCausalMech(ABC):
@@ -104,9 +106,24 @@ class EnsembleNeuralMech(BaseCausalMech):
         # forward method
         residual: bool = True,
         encoder_reduction: str = "sum",
+        sparse_forward: bool = False,
+        # training acceleration
+        autocast_dtype: Optional[str] = None,
+        compile_forward: bool = False,
         # others
         device: Union[str, torch.device] = "cpu",
     ):
+        """Causal-mech of an ensemble of neural networks.
+
+        Args:
+            sparse_forward: whether to run the encoders of the input variables which are parents of any output variable
+                in the causal graph only, and reduce over them only, see ``build_sparse_forward``.
+            autocast_dtype: if given (e.g. "bfloat16"), run the forward of training in autocast of this dtype, while the
+                residual and loss are still computed in fp32.
+            compile_forward: whether to ``torch.compile`` the forward and loss function of training.
+                Setting either of them turns on the accelerated training mode, which has no per-batch progress bar and
+                keeps the losses on the device until the end of every epoch.
+        """
         BaseCausalMech.__init__(
             self, name=name, input_variables=input_variables, output_variables=output_variables, logger=logger
         )
@@ -127,23 +144,41 @@ class EnsembleNeuralMech(BaseCausalMech):
         # forward method
         self.residual = residual
         self.encoder_reduction = encoder_reduction
+        self.sparse_forward = sparse_forward
+        # training acceleration
+        self.autocast_dtype = None if autocast_dtype is None else getattr(torch, autocast_dtype)
+        self.compile_forward = compile_forward
         # others
         self.device = device
 
         # build member object
-        self.variable_encoders: Optional[Dict[str, VariableEncoder]] = None
-        self.variable_decoders: Optional[Dict[str, VariableEncoder]] = None
+        self.encoder_bank: Optional[EncoderBank] = None
+        self.decoder_bank: Optional[DecoderBank] = None
         self.network: Optional[BaseNetwork] = None
+        self.elite_network: Optional[BaseNetwork] = None
         self.graph: Optional[BaseGraph] = None
         self.optimizer: Optional[Optimizer] = None
         self.scheduler: Optional[object] = None
+        self.best_weights: Optional[EnsembleBestWeights] = None
+        # validation loss of every member in the last learning, of the weights before it and of the best weights
+        self.start_val_loss: Optional[torch.Tensor] = None
+        self.best_val_loss: Optional[torch.Tensor] = None
+        # parents of output variables for sparse forward, see ``build_sparse_forward``
+        self.parent_plan: Optional[Tuple] = None
+        self.parent_mask: Optional[torch.Tensor] = None
+        # modules compiled for and functions compiled by ``torch.compile``, see ``_compiled_functions``
+        self._compiled: Optional[Tuple[Tuple, Tuple[Callable, ...]]] = None
         self.build_coders()
         self.build_network()
         self.build_graph()
         self.build_optimizer()
+        self.build_sparse_forward()
 
         self.total_epoch = 0
         self.elite_indices: List[int] = []
+        # persistent across repeated learning
+        self.data_split = EnsembleDataSplit(ensemble_num=self.ensemble_num, train_ratio=0.8, seed=1)
+        self.packed_data = PackedTensorData(device=self.device)
 
     @property
     def encoder_output_dim(self):
@@ -162,48 +197,107 @@ class EnsembleNeuralMech(BaseCausalMech):
 
     def build_optimizer(self):
         assert self.network, "you must build network first"
-        assert self.variable_encoders and self.variable_decoders, "you must build coders first"
-        params = (
-            [self.network.parameters()]
-            + [encoder.parameters() for encoder in self.variable_encoders.values()]
-            + [decoder.parameters() for decoder in self.variable_decoders.values()]
-        )
+        assert self.encoder_bank and self.decoder_bank, "you must build coders first"
+        params = [self.network.parameters(), self.encoder_bank.parameters(), self.decoder_bank.parameters()]
 
         self.optimizer = instantiate(self.optimizer_cfg)(params=chain(*params))
         self.scheduler = instantiate(self.scheduler_cfg)(optimizer=self.optimizer)
 
-    def forward(self, inputs: MutableMapping[str, torch.Tensor]) -> Dict[str, torch.Tensor]:
+    def build_best_weights(self):
+        """Preallocate the buffers of the best weights of every ensemble member, which are reused in every learning."""
+        member_tensors = []
+        for module in self.network.modules():
+            if isinstance(module, ParallelLinear) and module.extra_dims[-1:] == [self.ensemble_num]:
+                # ensemble-num is the last extra dim of the network
+                member_tensors += [(param, len(module.extra_dims) - 1) for param in module.parameters(recurse=False)]
+        member_ids = set(id(tensor) for tensor, _ in member_tensors)
+
+        params = chain(self.network.parameters(), self.encoder_bank.parameters(), self.decoder_bank.parameters())
+        shared_tensors = [param for param in params if id(param) not in member_ids]
+        if self.graph is not None:
+            shared_tensors += list(self.graph.parameters)
+
+        self.best_weights = EnsembleBestWeights(member_tensors, shared_tensors)
+
+    def build_sparse_forward(self):
+        """Read the causal graph once, and plan to encode the parents (input variables used by any output variable)
+        only, with the mask of output variables over parents. Called whenever the graph is set.
+        """
+        self.parent_plan, self.parent_mask = None, None
+        if not self.sparse_forward:
+            return
+
+        # [output-var-num, input-var-num]
+        mask = self.forward_mask
+        parents = mask.bool().any(dim=0).nonzero().squeeze(-1)
+        if len(parents) == 0:
+            return
+
+        self.parent_plan = self.encoder_bank.subset_plan([self.input_variables[i].name for i in parents.tolist()])
+        # [output-var-num, 1, 1, parent-num], broadcast to ensemble-num and batch-size in reduction
+        self.parent_mask = mask.index_select(-1, parents).unsqueeze(-2).unsqueeze(-2)
+
+    def build_elite_network(self):
+        """Slice the elite members out of the ensemble network once, for inference with elites only."""
+        if len(self.elite_indices) == 0:
+            self.elite_network = None
+        else:
+            # ensemble-num is the last extra dim of the network
+            self.elite_network = self.network.select(-1, torch.as_tensor(self.elite_indices, device=self.device))
+
+    def forward(self, inputs: MutableMapping[str, torch.Tensor], elite: bool = False) -> Dict[str, torch.Tensor]:
+        """Forward of all ensemble members, or elite members only if ``elite`` is True (and elites are known).
+
+        Args:
+            inputs: dict of tensors with shape (ensemble-num, batch-size, specific-dim), where ensemble-num can be 1
+                to broadcast the inputs to all members.
+            elite: whether to forward elite members only.
+
+        Returns: dict of tensors with shape (ensemble-num or elite-num, batch-size, specific-dim).
+
+        """
         batch_size, _ = self.get_inputs_batch_size(inputs)
+        network = self.elite_network if elite and self.elite_network is not None else self.network
 
-        inputs_tensor = torch.zeros(self.ensemble_num, batch_size, self.input_var_num, self.encoder_output_dim).to(self.device)
-        for i, var in enumerate(self.input_variables):
-            out = self.variable_encoders[var.name](inputs[var.name].to(self.device))
-            inputs_tensor[:, :, i] = out
+        if self.parent_plan is None:
+            # [ensemble-num, batch-size, input-var-num, encoder-output-dim]
+            inputs_tensor = self.encoder_bank(inputs)
+            reduced_inputs_tensor = self.reduce_encoder_output(inputs_tensor)
+        else:
+            # [ensemble-num, batch-size, parent-num, encoder-output-dim]
+            inputs_tensor = self.encoder_bank(inputs, plan=self.parent_plan)
+            reduced_inputs_tensor = masked_encoder_reduction(
+                inputs_tensor, self.parent_mask, reduction=self.encoder_reduction, input_var_num=self.input_var_num
+            )
 
-        output_tensor = self.network(self.reduce_encoder_output(inputs_tensor))
+        output_tensor = network(reduced_inputs_tensor)
 
-        outputs = {}
-        for i, var in enumerate(self.output_variables):
-            hid = output_tensor[i]
-            outputs[var.name] = self.variable_decoders[var.name](hid)
+        _, outputs = self.decoder_bank(output_tensor)
+        if self.autocast_dtype is not None:
+            # residual and loss in full precision
+            outputs = dict([(name, output.float()) for name, output in outputs.items()])
 
         if self.residual:
             outputs = self.residual_outputs(inputs, outputs)
         return outputs
 
+    def autocast_forward(self, inputs: MutableMapping[str, torch.Tensor], elite: bool = False) -> Dict[str, torch.Tensor]:
+        """Forward in autocast of ``self.autocast_dtype``, or the same as ``forward`` if it is None."""
+        if self.autocast_dtype is None:
+            return self.forward(inputs, elite=elite)
+
+        with torch.autocast(device_type=torch.device(self.device).type, dtype=self.autocast_dtype):
+            return self.forward(inputs, elite=elite)
+
     def build_graph(self):
         pass
 
     def build_coders(self):
-        self.variable_encoders = {}
-        for var in self.input_variables:
-            assert var.name not in self.variable_encoders, "duplicate name in encoders: {}".format(var.name)
-            self.variable_encoders[var.name] = instantiate(self.encoder_cfg)(variable=var).to(self.device)
+        assert len(self.input_variables_dict) == self.input_var_num, "duplicate name in encoders"
+        self.encoder_bank = EncoderBank(self.input_variables, self.encoder_cfg).to(self.device)
 
-        self.variable_decoders = {}
-        for var in self.output_variables:
-            assert var.name not in self.variable_decoders, "duplicate name in decoders: {}".format(var.name)
-            self.variable_decoders[var.name] = instantiate(self.decoder_cfg)(variable=var).to(self.device)
+        assert len(self.output_variables_dict) == self.output_var_num, "duplicate name in decoders"
+        self.decoder_bank = DecoderBank(self.output_variables, self.decoder_cfg).to(self.device)
 
     def save(self, save_dir: Union[str, pathlib.Path]):
         if isinstance(save_dir, str):
@@ -214,10 +308,9 @@ class EnsembleNeuralMech(BaseCausalMech):
         self.network.save(save_dir)
         if self.graph is not None:
             self.graph.save(save_dir)
-        for coder in self.variable_encoders.values():
-            coder.save(save_dir)
-        for coder in self.variable_decoders.values():
-            coder.save(save_dir)
+        self.encoder_bank.save(save_dir)
+        self.decoder_bank.save(save_dir)
+        torch.save({"elite_indices": list(self.elite_indices)}, save_dir / "elite.pth")
 
     def load(self, load_dir: Union[str, pathlib.Path]):
         if isinstance(load_dir, str):
@@ -227,17 +320,53 @@ class EnsembleNeuralMech(BaseCausalMech):
         self.network.load(load_dir)
         if self.graph is not None:
             self.graph.load(load_dir)
-        for coder in self.variable_encoders.values():
-            coder.load(load_dir)
-        for coder in self.variable_decoders.values():
-            coder.load(load_dir)
+        self.encoder_bank.load(load_dir)
+        self.decoder_bank.load(load_dir)
+        if (load_dir / "elite.pth").exists():
+            self.elite_indices = torch.load(load_dir / "elite.pth")["elite_indices"]
+        self.build_elite_network()
+        self.build_sparse_forward()
+
+    def state_dict(self) -> Dict:
+        """State of learning, i.e. weights, graph, optimizer states and elites, see ``load_state_dict``."""
+        return {
+            "network": self.network.state_dict(),
+            "encoder_bank": self.encoder_bank.state_dict(),
+            "decoder_bank": self.decoder_bank.state_dict(),
+            "graph": [] if self.graph is None else list(self.graph.parameters),
+            "optimizer": self.optimizer.state_dict(),
+            "scheduler": self.scheduler.state_dict(),
+            "elite_indices": list(self.elite_indices),
+            "total_epoch": self.total_epoch,
+        }
+
+    def load_state_dict(self, state_dict: Dict):
+        """Copy the state of learning of a mech of the same config into this mech, in place, e.g. to warm-start a
+        shadow mech from the live one without copying the whole mech.
+
+        Args:
+            state_dict: state of learning, see ``state_dict``.
+        """
+        self.network.load_state_dict(state_dict["network"])
+        self.encoder_bank.load_state_dict(state_dict["encoder_bank"])
+        self.decoder_bank.load_state_dict(state_dict["decoder_bank"])
+        with torch.no_grad():
+            for param, value in zip([] if self.graph is None else self.graph.parameters, state_dict["graph"]):
+                param.copy_(value)
+        self.optimizer.load_state_dict(state_dict["optimizer"])
+        self.scheduler.load_state_dict(state_dict["scheduler"])
+        self.elite_indices = list(state_dict["elite_indices"])
+        self.total_epoch = state_dict["total_epoch"]
+        self.build_elite_network()
+        self.build_sparse_forward()
 
     def get_inputs_info(self, inputs: MutableMapping[str, torch.Tensor]):
         assert len(set(inputs.keys()) & set(self.input_variables_dict.keys())) == len(inputs)
         data_shape = next(iter(inputs.values())).shape
         # assert len(data_shape) == 3, "{}".format(data_shape)  # ensemble-num, batch-size, specific-dim
         ensemble, batch_size, specific_dim = data_shape[-3:]
-        assert ensemble == self.ensemble_num
+        # ensemble-num of 1 is broadcast to all ensemble members
+        assert ensemble in [1, self.ensemble_num, len(self.elite_indices)]
 
         return batch_size, data_shape[:-3]
 
@@ -246,7 +375,8 @@ class EnsembleNeuralMech(BaseCausalMech):
         inputs: MutableMapping[str, torch.Tensor],
         outputs: MutableMapping[str, torch.Tensor],
     ) -> MutableMapping[str, torch.Tensor]:
-        for name in filter(lambda s: s.startswith("obs"), inputs.keys()):
+        # mechs without next-obs outputs (e.g. reward-mech) are left untouched
+        for name in filter(lambda s: s.startswith("obs") and "next_{}".format(s) in outputs, inputs.keys()):
             # assert inputs[name].shape[:2] == outputs["next_{}".format(name)].shape[:2]
             # assert inputs[name].shape[2] * 2 == outputs["next_{}".format(name)].shape[2]
             var_dim = inputs[name].shape[-1]
@@ -266,34 +396,15 @@ class EnsembleNeuralMech(BaseCausalMech):
         if mask is None:
             # [..., input-var-num]
             mask = self.forward_mask
-            # [..., ensemble-num, batch-size, input-var-num]
+            # [..., 1, 1, input-var-num], broadcast to ensemble-num and batch-size in reduction
             mask = mask.unsqueeze(-2).unsqueeze(-2)
-            mask = mask.repeat((1,) * len(mask.shape[:-3]) + (*encoder_output.shape[:2], 1))
 
         # mask shape [..., ensemble-num, batch-size, input-var-num]
-        assert (
-            mask.shape[-3:] == encoder_output.shape[:-1]
+        assert len(mask.shape) >= 3 and all(
+            m == 1 or m == e for m, e in zip(mask.shape[-3:], encoder_output.shape[:-1])
         ), "mask shape should be (..., ensemble-num, batch-size, input-var-num)"
 
-        # [*mask-extra-dims, ensemble-num, batch-size, input-var-num, encoder-output-dim]
-        mask = mask[..., None].repeat([1] * len(mask.shape) + [encoder_output.shape[-1]])
-        masked_encoder_output = encoder_output.repeat(tuple(mask.shape[:-4]) + (1,) * 4)
-
-        # choose mask value
-        mask_value = 0
-        if self.encoder_reduction == "max":
-            mask_value = -float("inf")
-        masked_encoder_output[mask == 0] = mask_value
-
-        if self.encoder_reduction == "sum":
-            return masked_encoder_output.sum(-2)
-        elif self.encoder_reduction == "mean":
-            return masked_encoder_output.mean(-2)
-        elif self.encoder_reduction == "max":
-            values, indices = masked_encoder_output.max(-2)
-            return values
-        else:
-            raise NotImplementedError("not implemented encoder reduction method: {}".format(self.encoder_reduction))
+        return masked_encoder_reduction(encoder_output, mask, reduction=self.encoder_reduction)
 
     @property
     def forward_mask(self) -> torch.Tensor:
@@ -304,17 +415,52 @@ class EnsembleNeuralMech(BaseCausalMech):
         self,
         inputs: MutableMapping[str, np.ndarray],
         outputs: MutableMapping[str, np.ndarray],
+        train_steps: Optional[int] = None,
+        recent_indexes: Optional[np.ndarray] = None,
+        recent_ratio: float = 0.5,
+        updated_indexes: Optional[np.ndarray] = None,
     ):
-        train_set = EnsembleBufferDataset(
-            inputs=inputs, outputs=outputs, training=True, train_ratio=0.8, ensemble_num=self.ensemble_num, seed=1
+        """Get loaders of train and valid data, gathering batches from ``self.packed_data``.
+
+        Args:
+            inputs: inputs of all data.
+            outputs: outputs of all data.
+            train_steps: if given, train for a budget of ``train_steps`` batches per epoch, sampled with bias to
+                ``recent_indexes`` (see ``EnsembleDataSplit.recent_ensemble_indexes``), and validate on a subset of the
+                same size, so that the cost of an epoch does not grow with data; otherwise go through all data.
+            recent_indexes: indexes of data added recently.
+            recent_ratio: ratio of samples from recent data.
+            updated_indexes: indexes of data changed since the last learning, which are packed together with the data
+                appended, see ``PackedTensorData.update``; all data is packed again if None.
+
+        Returns: train loader and valid loader.
+
+        """
+        # keep the split and the packed tensor of data learned before, and split and pack the new data only
+        self.data_split.extend(len(next(iter(inputs.values()))))
+        self.packed_data.update(inputs, outputs, updated_indexes)
+
+        if train_steps is None:
+            train_indexes = self.data_split.train_ensemble_indexes
+            valid_indexes = self.data_split.valid_ensemble_indexes()
+        else:
+            sample_num = train_steps * self.batch_size
+            train_indexes = partial(
+                self.data_split.recent_ensemble_indexes,
+                sample_num,
+                recent_indexes=recent_indexes,
+                recent_ratio=recent_ratio,
+            )
+            valid_indexes = self.data_split.valid_ensemble_indexes(sample_num)
+
+        # data is already in memory, gather batches from the packed tensor on device rather than in workers
+        train_loader = TensorEnsembleBatchSampler(
+            inputs, outputs, train_indexes, self.batch_size, device=self.device, packed_data=self.packed_data
         )
-        valid_set = EnsembleBufferDataset(
-            inputs=inputs, outputs=outputs, training=False, train_ratio=0.8, ensemble_num=self.ensemble_num, seed=1
+        valid_loader = TensorEnsembleBatchSampler(
+            inputs, outputs, valid_indexes, self.batch_size, device=self.device, packed_data=self.packed_data
         )
 
-        train_loader = DataLoader(train_set, batch_size=self.batch_size, collate_fn=collate_fn, num_workers=cpu_count())
-        valid_loader = DataLoader(valid_set, batch_size=self.batch_size, collate_fn=collate_fn, num_workers=cpu_count())
-
         return train_loader, valid_loader
 
     def learn(
@@ -322,31 +468,62 @@ class EnsembleNeuralMech(BaseCausalMech):
         inputs: MutableMapping[str, np.ndarray],
         outputs: MutableMapping[str, np.ndarray],
         work_dir: Optional[Union[str, pathlib.Path]] = None,
+        longest_epoch: Optional[int] = None,
+        train_steps: Optional[int] = None,
+        recent_indexes: Optional[np.ndarray] = None,
+        recent_ratio: float = 0.5,
+        updated_indexes: Optional[np.ndarray] = None,
         **kwargs
     ):
-        train_loader, valid_loader = self.get_data_loaders(inputs, outputs)
+        """Learn from data, warm-started from the current weights and optimizer state.
 
-        best_weights: Optional[Dict] = None
-        epoch_iter = range(self.longest_epoch) if self.longest_epoch >= 0 else count()
+        Args:
+            inputs: inputs of all data.
+            outputs: outputs of all data.
+            work_dir: directory to save models.
+            longest_epoch: the longest epoch of this learning, ``self.longest_epoch`` if None.
+            train_steps, recent_indexes, recent_ratio, updated_indexes: see ``get_data_loaders``.
+        """
+        train_loader, valid_loader = self.get_data_loaders(
+            inputs, outputs, train_steps, recent_indexes, recent_ratio, updated_indexes
+        )
+        # the graph may be set before learning, e.g. by causal discovery
+        self.build_sparse_forward()
+
+        if self.best_weights is None:
+            self.build_best_weights()
+        self.best_weights.reset()
+        longest_epoch = self.longest_epoch if longest_epoch is None else longest_epoch
+        epoch_iter = range(longest_epoch) if longest_epoch >= 0 else count()
         epochs_since_update = 0
 
-        loss_func = partial(variable_loss_func, output_variables=self.output_variables, device=self.device)
-        train = partial(train_func, forward=self.forward, optimizer=self.optimizer, loss_func=loss_func)
-        eval = partial(eval_func, forward=self.forward, loss_func=loss_func)
+        # no per-batch sync with device in the accelerated training mode, for either progress bar or loss check
+        progress = self.autocast_dtype is None and not self.compile_forward
+        forward = self.autocast_forward
+        loss_func = partial(
+            variable_loss_func, output_variables=self.output_variables, device=self.device, check_finite=progress
+        )
+        train_forward = self.train_forward
+        if self.compile_forward:
+            forward, train_forward, loss_func = self._compiled_functions(forward, train_forward, loss_func)
+        train = partial(train_func, forward=train_forward, optimizer=self.optimizer, loss_func=loss_func, progress=progress)
+        eval = partial(eval_func, forward=forward, loss_func=loss_func, progress=progress)
 
         best_eval_loss = eval(valid_loader).mean(dim=(-2, -1))
+        self.start_val_loss = best_eval_loss
 
         for epoch in epoch_iter:
+            epoch_records = self.before_epoch(epoch, train_loader)
             train_loss = train(train_loader)
             eval_loss = eval(valid_loader)
-
-            maybe_best_weights = self._maybe_get_best_weights(
-                best_eval_loss, eval_loss.mean(dim=(-2, -1)), self.improvement_threshold
-            )
-            if maybe_best_weights:
-                # best loss
-                best_eval_loss = torch.minimum(best_eval_loss, eval_loss.mean(dim=(-2, -1)))
-                best_weights = maybe_best_weights
+            if not progress:
+                check_finite_loss(train_loss, self.output_variables)
+                check_finite_loss(eval_loss, self.output_variables)
+
+            improved = self._maybe_get_best_weights(best_eval_loss, eval_loss.mean(dim=(-2, -1)), self.improvement_threshold)
+            if improved is not None:
+                # best loss of the improved members, consistent with the best weights kept
+                best_eval_loss = torch.where(improved, eval_loss.mean(dim=(-2, -1)), best_eval_loss)
                 epochs_since_update = 0
             else:
                 epochs_since_update += 1
@@ -356,12 +533,14 @@ class EnsembleNeuralMech(BaseCausalMech):
             if self.logger is not None:
                 self.logger.record("{}/epoch".format(self.name), epoch)
                 self.logger.record("{}/epochs_since_update".format(self.name), epochs_since_update)
-                self.logger.record("{}/train_dataset_size".format(self.name), len(train_loader.dataset))
-                self.logger.record("{}/valid_dataset_size".format(self.name), len(valid_loader.dataset))
+                self.logger.record("{}/train_dataset_size".format(self.name), train_loader.sample_num)
+                self.logger.record("{}/valid_dataset_size".format(self.name), valid_loader.sample_num)
                 self.logger.record("{}/train_loss".format(self.name), train_loss.mean().item())
                 self.logger.record("{}/val_loss".format(self.name), eval_loss.mean().item())
                 self.logger.record("{}/best_val_loss".format(self.name), best_eval_loss.mean().item())
                 self.logger.record("{}/lr".format(self.name), self.optimizer.param_groups[0]["lr"])
+                for key, value in epoch_records.items():
+                    self.logger.record("{}/{}".format(self.name, key), value)
 
                 self.logger.dump(self.total_epoch)
 
@@ -370,50 +549,91 @@ class EnsembleNeuralMech(BaseCausalMech):
 
             self.scheduler.step()
 
-        # saving the best models:
-        self._maybe_set_best_weights_and_elite(best_weights, best_eval_loss)
+        # saving the best models, with elites ranked by the validation loss of the weights restored
+        self.best_weights.restore()
+        self.best_val_loss = eval(valid_loader).mean(dim=(-2, -1))
+        self._set_elite(self.best_val_loss)
 
         self.save(save_dir=work_dir)
 
+    def _compiled_functions(self, *functions: Callable) -> Tuple[Callable, ...]:
+        """``torch.compile`` the functions of learning once, and again only if the network or coders are built again.
+
+        The elite network is not used in learning, so building it (at the end of every learning) keeps the cache.
+        """
+        modules = (self.network, self.encoder_bank, self.decoder_bank, self.autocast_dtype)
+        if self._compiled is None or any(a is not b for a, b in zip(self._compiled[0], modules)):
+            self._compiled = (modules, tuple(torch.compile(function) for function in functions))
+        return self._compiled[1]
+
+    def __getstate__(self):
+        # compiled functions are bound to this mech and not copyable, a copy compiles its own
+        state = self.__dict__.copy()
+        state["_compiled"] = None
+        return state
+
+    def train_forward(self, inputs: MutableMapping[str, torch.Tensor]) -> Dict[str, torch.Tensor]:
+        """Forward of training in ``learn``, the same as in evaluation by default.
+
+        Args:
+            inputs: dict of tensors with shape (ensemble-num, batch-size, specific-dim).
+
+        Returns: dict of tensors with shape (ensemble-num, batch-size, specific-dim).
+
+        """
+        return self.autocast_forward(inputs)
+
+    def before_epoch(self, epoch: int, train_loader: TensorEnsembleBatchSampler) -> Dict[str, float]:
+        """Extra update before the training of every epoch in ``learn``, e.g. of the graph, nothing by default.
+
+        Args:
+            epoch: index of the epoch in this learning.
+            train_loader: loader of train data.
+
+        Returns: dict of the name and value of records to log in this epoch.
+
+        """
+        return {}
+
     def _maybe_get_best_weights(
         self,
         best_val_loss: torch.Tensor,
         val_loss: torch.Tensor,
         threshold: float = 0.01,
-    ) -> Optional[Dict]:
-        """Return the current model state dict  if the validation score improves.
-        For ensembles, this checks the validation for each ensemble member separately.
-        Copy from https://github.com/facebookresearch/mbrl-lib/blob/main/mbrl/models/model_trainer.py
+    ) -> Optional[torch.Tensor]:
+        """Keep the current weights of the ensemble members whose validation score improves.
+        For ensembles, this checks the validation for each ensemble member separately, unless the members share
+        tensors (e.g. coders and graph), where the ensemble is kept as one unit when its mean validation score
+        improves, so that the weights restored are all of the same epoch.
+        Modified from https://github.com/facebookresearch/mbrl-lib/blob/main/mbrl/models/model_trainer.py
 
         Args:
             best_val_score (tensor): the current best validation losses per model.
             val_score (tensor): the new validation loss per model.
             threshold (float): the threshold for relative improvement.
         Returns:
-            (dict, optional): if the validation score's relative improvement over the
-            best validation score is higher than the threshold, returns the state dictionary
-            of the stored model, otherwise returns ``None``.
+            (tensor, optional): if the validation score's relative improvement over the
+            best validation score is higher than the threshold for any member, returns the
+            bool mask of the improved members, otherwise returns ``None``.
         """
-        improvement = (best_val_loss - val_loss) / torch.abs(best_val_loss)
-        if (improvement > threshold).any().item():
-            best_weights = copy.deepcopy(self.network.state_dict())
+        if len(self.best_weights.shared_tensors) == 0:
+            improved = (best_val_loss - val_loss) / torch.abs(best_val_loss) > threshold
         else:
-            best_weights = None
+            best_mean_loss, mean_loss = best_val_loss.mean(), val_loss.mean()
+            improved = ((best_mean_loss - mean_loss) / torch.abs(best_mean_loss) > threshold).expand_as(val_loss)
+        return improved if self.best_weights.update(improved) else None
 
-        return best_weights
-
-    def _maybe_set_best_weights_and_elite(self, best_weights: Optional[Dict], best_val_score: torch.Tensor):
-        if best_weights is not None:
-            self.network.load_state_dict(best_weights)
-
-        sorted_indices = np.argsort(best_val_score.tolist())
-        self.elite_indices = sorted_indices[: self.elite_num]
+    def _set_elite(self, val_score: torch.Tensor):
+        sorted_indices = np.argsort(val_score.tolist())
+        self.elite_indices = sorted_indices[: self.elite_num].tolist()
+        self.build_elite_network()
 
     def get_inputs_batch_size(self, inputs: MutableMapping[str, torch.Tensor]) -> int:
-        assert len(set(inputs.keys()) & set(self.variable_encoders.keys())) == len(inputs)
+        assert len(set(inputs.keys()) & set(self.input_variables_dict.keys())) == len(inputs)
         data_shape = list(inputs.values())[0].shape
         # assert len(data_shape) == 3, "{}".format(data_shape)  # ensemble-num, batch-size, specific-dim
         ensemble, batch_size, specific_dim = data_shape[-3:]
-        assert ensemble == self.ensemble_num
+        # ensemble-num of 1 is broadcast to all ensemble members
+        assert ensemble in [1, self.ensemble_num, len(self.elite_indices)]
 
         return batch_size, data_shape[:-3]
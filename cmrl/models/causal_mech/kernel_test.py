@@ -1,5 +1,4 @@
-from typing import Optional, List, Dict, Union, MutableMapping
-from functools import partial
+from typing import Optional, List, Dict, Union, MutableMapping, Tuple
 from collections import defaultdict
 
 import pathlib
@@ -10,13 +9,13 @@ from omegaconf import DictConfig
 from stable_baselines3.common.logger import Logger
 from hydra.utils import instantiate
 
-# from cmrl.utils.RCIT import KCI_CInd
-from causallearn.utils.KCI.KCI import KCI_CInd
 from tqdm import tqdm
 
 from cmrl.models.causal_mech.base import EnsembleNeuralMech
 from cmrl.utils.variables import Variable, ContinuousVariable, DiscreteVariable, BinaryVariable, RadianVariable
 from cmrl.models.graphs.binary_graph import BinaryGraph
+from cmrl.utils.ci_scheduler import CITestScheduler
+from cmrl.utils.ci_test import get_ci_test
 
 
 class KernelTestMech(EnsembleNeuralMech):
@@ -44,6 +43,10 @@ class KernelTestMech(EnsembleNeuralMech):
         # forward method
         residual: bool = True,
         encoder_reduction: str = "sum",
+        sparse_forward: bool = False,
+        # training acceleration
+        autocast_dtype: Optional[str] = None,
+        compile_forward: bool = False,
         # others
         device: Union[str, torch.device] = "cpu",
         # KCI
@@ -51,7 +54,27 @@ class KernelTestMech(EnsembleNeuralMech):
         kci_times: int = 10,
         not_confident_bound: float = 0.25,
         longest_sample: int = 5000,
+        kci_workers: int = 1,
+        kci_cache_budget: float = 256,
+        ci_test: str = "kci",
+        ci_test_kwargs: Optional[Dict] = None,
     ):
+        """Causal mech with the graph discovered by kernel-based conditional independence (KCI) tests.
+
+        Args:
+            kci_workers: number of processes running KCI tests in parallel, see ``CITestScheduler``. 1 runs them in
+                the current process, and non-positive uses all cores.
+            kci_cache_budget: memory budget (in MiB) of the cache of kernel matrices in every process, which are
+                shared by tests of the same input and samples, see ``KernelCache``.
+            ci_test: name of the conditional independence test registered in ``cmrl.utils.ci_test``, in "kci", or
+                "rcit" and "rcot" approximating KCI by random Fourier features in linear time of samples, which afford
+                a much larger ``sample_num`` and ``longest_sample``.
+                RCoT is better calibrated than RCIT when conditioned on many inputs (see benchmarks/bench_ci_test.py).
+                "kci-nystrom" and "kci-icholesky" approximate kernel matrices of KCI by low-rank factors, in linear time
+                and memory of samples.
+            ci_test_kwargs: keyword arguments overriding those of the registered test, e.g. ``rank`` of the low-rank
+                approximations.
+        """
         EnsembleNeuralMech.__init__(
             self,
             name=name,
@@ -71,27 +94,26 @@ class KernelTestMech(EnsembleNeuralMech):
             scheduler_cfg=scheduler_cfg,
             residual=residual,
             encoder_reduction=encoder_reduction,
+            sparse_forward=sparse_forward,
+            autocast_dtype=autocast_dtype,
+            compile_forward=compile_forward,
             device=device,
         )
         self.sample_num = sample_num
         self.kci_times = kci_times
         self.not_confident_bound = not_confident_bound
         self.longest_sample = longest_sample
+        self.kci_workers = kci_workers
+        self.kci_cache_budget = kci_cache_budget
+        # only look up the registry, the test is imported on first use
+        self.ci_test = get_ci_test(ci_test, **({} if ci_test_kwargs is None else ci_test_kwargs))
 
-    def kci(
+    def kci_data(
         self,
-        input_idx: int,
-        output_idx: int,
         inputs: MutableMapping[str, numpy.ndarray],
         outputs: MutableMapping[str, numpy.ndarray],
-        sample_indices: np.ndarray,
-    ):
-        in_name, out_name = list(inputs.keys())[input_idx], list(outputs.keys())[output_idx]
-
-        if self.residual:
-            data_x = outputs[out_name][sample_indices] - inputs[out_name.replace("next_", "")][sample_indices]
-        else:
-            data_x = outputs[out_name][sample_indices]
+    ) -> Tuple[List[np.ndarray], List[np.ndarray]]:
+        """Data of input and output variables in KCI, with radian inputs wrapped and residual outputs if needed."""
 
         def deal_with_radian_input(name, data):
             if isinstance(self.input_variables_dict[name], RadianVariable):
@@ -99,17 +121,12 @@ class KernelTestMech(EnsembleNeuralMech):
             else:
                 return data
 
-        data_y = deal_with_radian_input(in_name, inputs[in_name])[sample_indices]
-        data_z = [
-            deal_with_radian_input(other_in_name, in_data)[sample_indices]
-            for other_in_name, in_data in inputs.items()
-            if other_in_name != in_name
-        ]
-        data_z = np.concatenate(data_z, axis=1)
-
-        kci = KCI_CInd()
-        p_value, test_stat = kci.compute_pvalue(data_x, data_y, data_z)
-        return p_value
+        kci_inputs = [deal_with_radian_input(name, data) for name, data in inputs.items()]
+        if self.residual:
+            kci_outputs = [data - inputs[name.replace("next_", "")] for name, data in outputs.items()]
+        else:
+            kci_outputs = list(outputs.values())
+        return kci_inputs, kci_outputs
 
     def kci_compute_graph(
         self,
@@ -118,59 +135,71 @@ class KernelTestMech(EnsembleNeuralMech):
         work_dir: Optional[pathlib.Path] = None,
         **kwargs
     ):
-
+        work_dir = pathlib.Path(".") if work_dir is None else work_dir
         open(work_dir / "history_vote.txt", "w")
 
         length = next(iter(inputs.values())).shape[0]
         sample_length = min(length, self.sample_num) if self.sample_num > 0 else length
+        in_names, out_names = list(inputs.keys()), list(outputs.keys())
 
-        init_pvalues_array = np.empty((self.kci_times, self.input_var_num, self.output_var_num))
-        with tqdm(
-            total=self.kci_times * self.input_var_num * self.output_var_num,
-            desc="init kci of {} samples".format(sample_length),
-        ) as pbar:
-            for time in range(self.kci_times):
-                sample_indices = np.random.permutation(length)[:sample_length]
-                kci = partial(self.kci, inputs=inputs, outputs=outputs, sample_indices=sample_indices)
-                for out_idx in range(len(outputs)):
-                    for in_idx in range(len(inputs)):
-                        init_pvalues_array[time][in_idx][out_idx] = kci(in_idx, out_idx)
-                        pbar.update(1)
-
-        votes = (init_pvalues_array < 0.05).mean(axis=0)
-        is_not_confident = np.logical_and(votes > self.not_confident_bound, votes < 1 - self.not_confident_bound)
-        not_confident_list = np.array(np.where(is_not_confident)).T
-
-        recompute_times = 1
-        while len(not_confident_list) != 0:
-            with open(work_dir / "history_vote.txt", "a") as f:
-                f.write(str(votes) + "\n")
-            print(votes)
+        # samples of every round of tests and every time, shared by all pairs tested in it
+        sample_indices_dict = {}
 
+        def submit(recompute_times, in_idx, out_idxs):
             new_sample_length = int(sample_length * 1.5**recompute_times)
-            if new_sample_length > min(self.longest_sample, length):
-                break
-
-            pvalues_dict = defaultdict(list)
-            with tqdm(
-                total=self.kci_times * len(not_confident_list),
-                desc="{}th re-compute kci of {} samples".format(recompute_times, new_sample_length),
-            ) as pbar:
-                for time in range(self.kci_times):
-                    sample_indices = np.random.permutation(length)[:new_sample_length]
-                    kci = partial(self.kci, inputs=inputs, outputs=outputs, sample_indices=sample_indices)
-                    for in_idx, out_idx in not_confident_list:
-                        pvalues_dict[(in_idx, out_idx)].append(kci(in_idx, out_idx))
-                        pbar.update(1)
-
-            not_confident_list = []
-            for key, value in pvalues_dict.items():
-                vote = (np.array(value) < 0.05).mean()
-                if self.not_confident_bound < vote < 1 - self.not_confident_bound:
-                    not_confident_list.append(key)
-                else:
-                    votes[key] = vote
-            recompute_times += 1
+            for time in range(self.kci_times):
+                if (recompute_times, time) not in sample_indices_dict:
+                    sample_indices_dict[(recompute_times, time)] = np.random.permutation(length)[:new_sample_length]
+                sample_indices = sample_indices_dict[(recompute_times, time)]
+                scheduler.submit((recompute_times, in_idx), sample_indices, in_idx, out_idxs)
+
+        votes = np.empty((self.input_var_num, self.output_var_num))
+        pvalues_dict = defaultdict(list)
+        kci_inputs, kci_outputs = self.kci_data(inputs, outputs)
+        with CITestScheduler(
+            kci_inputs,
+            kci_outputs,
+            ci_test=self.ci_test,
+            workers=self.kci_workers,
+            cache_budget=self.kci_cache_budget,
+        ) as scheduler, tqdm(
+            total=self.kci_times * self.input_var_num * self.output_var_num,
+            desc="kci of {} samples".format(sample_length),
+        ) as pbar:
+            # all outputs of an input are tested together, sharing the kernel matrices of inputs
+            for in_idx in range(self.input_var_num):
+                submit(0, in_idx, list(range(self.output_var_num)))
+
+            # re-test not confident pairs as soon as all their votes are in, rather than after all pairs of the round
+            for (recompute_times, in_idx), p_values in scheduler.results():
+                pbar.update(len(p_values))
+
+                retest_out_idxs = []
+                for out_idx, p_value in p_values.items():
+                    key = (recompute_times, in_idx, out_idx)
+                    pvalues_dict[key].append(p_value)
+                    if len(pvalues_dict[key]) < self.kci_times:
+                        continue
+
+                    vote = (np.array(pvalues_dict.pop(key)) < 0.05).mean()
+                    is_confident = not self.not_confident_bound < vote < 1 - self.not_confident_bound
+                    # the vote of the first round is kept unless a re-test is confident
+                    if recompute_times == 0 or is_confident:
+                        votes[in_idx, out_idx] = vote
+
+                    with open(work_dir / "history_vote.txt", "a") as f:
+                        f.write(
+                            "{}th round, {} -> {}: {}\n".format(recompute_times, in_names[in_idx], out_names[out_idx], vote)
+                        )
+
+                    new_sample_length = int(sample_length * 1.5 ** (recompute_times + 1))
+                    if not is_confident and new_sample_length <= min(self.longest_sample, length):
+                        retest_out_idxs.append(out_idx)
+
+                if len(retest_out_idxs) > 0:
+                    submit(recompute_times + 1, in_idx, retest_out_idxs)
+                    pbar.total += self.kci_times * len(retest_out_idxs)
+                    pbar.refresh()
 
         return votes > 0.5
 
@@ -181,25 +210,6 @@ class KernelTestMech(EnsembleNeuralMech):
             extra_dims=[self.ensemble_num],
         ).to(self.device)
 
-    def forward(self, inputs: MutableMapping[str, torch.Tensor]) -> Dict[str, torch.Tensor]:
-        batch_size, _ = self.get_inputs_batch_size(inputs)
-
-        inputs_tensor = torch.zeros(self.ensemble_num, batch_size, self.input_var_num, self.encoder_output_dim).to(self.device)
-        for i, var in enumerate(self.input_variables):
-            out = self.variable_encoders[var.name](inputs[var.name].to(self.device))
-            inputs_tensor[:, :, i] = out
-
-        output_tensor = self.network(self.reduce_encoder_output(inputs_tensor))
-
-        outputs = {}
-        for i, var in enumerate(self.output_variables):
-            hid = output_tensor[i]
-            outputs[var.name] = self.variable_decoders[var.name](hid)
-
-        if self.residual:
-            outputs = self.residual_outputs(inputs, outputs)
-        return outputs
-
     def build_graph(self):
         self.graph = BinaryGraph(self.input_var_num, self.output_var_num, device=self.device)
 
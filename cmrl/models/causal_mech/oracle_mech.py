@@ -38,6 +38,10 @@ class OracleMech(EnsembleNeuralMech):
         # forward method
         residual: bool = True,
         encoder_reduction: str = "sum",
+        sparse_forward: bool = False,
+        # training acceleration
+        autocast_dtype: Optional[str] = None,
+        compile_forward: bool = False,
         # others
         device: Union[str, torch.device] = "cpu",
     ):
@@ -60,6 +64,9 @@ class OracleMech(EnsembleNeuralMech):
             scheduler_cfg=scheduler_cfg,
             residual=residual,
             encoder_reduction=encoder_reduction,
+            sparse_forward=sparse_forward,
+            autocast_dtype=autocast_dtype,
+            compile_forward=compile_forward,
             device=device,
         )
 
@@ -68,6 +75,7 @@ class OracleMech(EnsembleNeuralMech):
         if graph_data is None:
             graph_data = np.ones([self.input_var_num, self.output_var_num])
         self.graph.set_data(graph_data=graph_data)
+        self.build_sparse_forward()
         print("set oracle causal graph successfully: \n{}".format(graph_data))
 
 
@@ -1,21 +1,15 @@
 from typing import List, Optional, Dict, Union, MutableMapping, Tuple
-import math
-import pathlib
-from itertools import count
-from functools import partial
-import copy
 
 import torch
-import numpy as np
 from torch.utils.data import DataLoader
 from stable_baselines3.common.logger import Logger
 from omegaconf import DictConfig
 from hydra.utils import instantiate
 
 from cmrl.utils.variables import Variable
-from cmrl.models.causal_mech.neural_causal_mech import NeuralCausalMech
+from cmrl.models.causal_mech.base import EnsembleNeuralMech
 from cmrl.models.graphs.prob_graph import BernoulliGraph
-from cmrl.models.causal_mech.util import variable_loss_func, train_func, eval_func
+from cmrl.models.causal_mech.util import variable_loss_func
 
 default_graph_optimizer_cfg = DictConfig(
     dict(
@@ -28,16 +22,18 @@ default_graph_optimizer_cfg = DictConfig(
 )
 
 
-class ReinforceCausalMech(NeuralCausalMech):
+class ReinforceCausalMech(EnsembleNeuralMech):
     def __init__(
         self,
         name: str,
         input_variables: List[Variable],
         output_variables: List[Variable],
+        logger: Optional[Logger] = None,
         # model learning
         longest_epoch: int = -1,
         improvement_threshold: float = 0.01,
         patience: int = 5,
+        batch_size: int = 256,
         # ensemble
         ensemble_num: int = 7,
         elite_num: int = 5,
@@ -48,41 +44,53 @@ class ReinforceCausalMech(NeuralCausalMech):
         optimizer_cfg: Optional[DictConfig] = None,
         graph_optimizer_cfg: Optional[DictConfig] = default_graph_optimizer_cfg,
         # graph params
+        discovery: bool = True,
         concat_mask: bool = True,
         graph_MC_samples: int = 100,
         graph_max_stack: int = 200,
+        graph_memory_budget: Optional[float] = None,
         lambda_sparse: float = 1e-3,
+        graph_data_ratio: float = 0.5,
+        train_graph_freq: int = 2,
         # forward method
         residual: bool = True,
         encoder_reduction: str = "sum",
         multi_step: str = "none",
-        # logger
-        logger: Optional[Logger] = None,
         # others
         device: Union[str, torch.device] = "cpu",
-        **kwargs
     ):
         if multi_step == "none":
             multi_step = "forward-euler 1"
+        self.multi_step = multi_step
 
         # cfgs
         self.graph_optimizer_cfg = graph_optimizer_cfg
 
         # graph params
+        self.discovery = discovery
         self._concat_mask = concat_mask
         self._graph_MC_samples = graph_MC_samples
         self._graph_max_stack = graph_max_stack
+        # in MiB, adapt the number of sampled graphs evaluated together to it rather than `graph_max_stack` if given
+        self._graph_memory_budget = graph_memory_budget
         self._lambda_sparse = lambda_sparse
+        # update the graph with a ratio of train batches, every ``train_graph_freq`` epochs in learning
+        assert 0 <= graph_data_ratio <= 1, "graph data ratio should be in [0, 1]"
+        self._graph_data_ratio = graph_data_ratio
+        self._train_graph_freq = train_graph_freq
 
         self.graph_optimizer = None
 
-        super(ReinforceCausalMech, self).__init__(
+        EnsembleNeuralMech.__init__(
+            self,
             name=name,
             input_variables=input_variables,
             output_variables=output_variables,
+            logger=logger,
             longest_epoch=longest_epoch,
             improvement_threshold=improvement_threshold,
             patience=patience,
+            batch_size=batch_size,
             ensemble_num=ensemble_num,
             elite_num=elite_num,
             network_cfg=network_cfg,
@@ -91,10 +99,7 @@ class ReinforceCausalMech(NeuralCausalMech):
             optimizer_cfg=optimizer_cfg,
             residual=residual,
             encoder_reduction=encoder_reduction,
-            multi_step=multi_step,
-            logger=logger,
             device=device,
-            **kwargs
         )
 
     def build_network(self):
@@ -127,6 +132,15 @@ class ReinforceCausalMech(NeuralCausalMech):
         # graph optimizer
         self.graph_optimizer = instantiate(self.graph_optimizer_cfg)(self.graph.parameters)
 
+    def state_dict(self) -> Dict:
+        state_dict = super().state_dict()
+        state_dict["graph_optimizer"] = self.graph_optimizer.state_dict()
+        return state_dict
+
+    def load_state_dict(self, state_dict: Dict):
+        super().load_state_dict(state_dict)
+        self.graph_optimizer.load_state_dict(state_dict["graph_optimizer"])
+
     @property
     def causal_graph(self) -> torch.Tensor:
         """property causal graph"""
@@ -139,39 +153,37 @@ class ReinforceCausalMech(NeuralCausalMech):
         inputs: MutableMapping[str, torch.Tensor],
         train: bool = False,
         mask: Optional[torch.Tensor] = None,
+        elite: bool = False,
     ) -> Dict[str, torch.Tensor]:
         batch_size, extra_dim = self.get_inputs_batch_size(inputs)
         assert len(extra_dim) == 0, "unexpected dimension in the inputs"
+        network = self.elite_network if elite and self.elite_network is not None else self.network
+        member_num = len(self.elite_indices) if network is self.elite_network else self.ensemble_num
 
-        inputs_tensor = torch.zeros(self.ensemble_num, batch_size, self.input_var_num, self.encoder_output_dim).to(self.device)
-        for i, var in enumerate(self.input_variables):
-            out = self.variable_encoders[var.name](inputs[var.name].to(self.device))
-            inputs_tensor[..., i, :] = out
+        # [ensemble-num, batch-size, input-var-num, encoder-output-dim]
+        inputs_tensor = self.encoder_bank(inputs)
 
         if train and self.discovery:
             # [ensemble-num, batch-size, input-var-num, output-var-num]
-            adj_matrix = self.graph.sample(None, sample_size=(self.ensemble_num, batch_size))
-            # [ensemble-num, batch-size, output-var-num, input-var-num]
-            mask = adj_matrix.transpose(-1, -2)
+            adj_matrix = self.graph.sample(None, sample_size=(member_num, batch_size))
             # [output-var-num, ensemble-num, batch-size, input-var-num]
-            mask = mask.permute(2, 0, 1, 3)
-        else:
-            if mask is None:
-                mask = self.forward_mask
-                mask = mask.unsqueeze(-2).unsqueeze(-2)
-                mask = mask.repeat(1, self.ensemble_num, batch_size, 1)
+            mask = adj_matrix.permute(3, 0, 1, 2)
+        elif mask is None:
+            # [output-var-num, 1, 1, input-var-num], broadcast to ensemble-num and batch-size
+            mask = self.forward_mask.unsqueeze(-2).unsqueeze(-2)
 
         # [output-var-num, ensemble-num, batch-size, encoder-output-dim]
         reduced_inputs_tensor = self.reduce_encoder_output(inputs_tensor, mask=mask)
         if self._concat_mask:
+            expand_shape = (self.output_var_num, member_num, batch_size, -1)
             # [output-var-num, ensemble-num, batch-size, encoder-output-dim + input-var-num]
-            reduced_inputs_tensor = torch.cat([reduced_inputs_tensor, mask], dim=-1)
-        output_tensor = self.network(reduced_inputs_tensor)
+            reduced_inputs_tensor = torch.cat(
+                [reduced_inputs_tensor.expand(expand_shape), mask.to(reduced_inputs_tensor.dtype).expand(expand_shape)],
+                dim=-1,
+            )
+        output_tensor = network(reduced_inputs_tensor)
 
-        outputs = {}
-        for i, var in enumerate(self.output_variables):
-            hid = output_tensor[i]
-            outputs[var.name] = self.variable_decoders[var.name](hid)
+        _, outputs = self.decoder_bank(output_tensor)
 
         if self.residual:
             outputs = self.residual_outputs(inputs, outputs)
@@ -180,6 +192,7 @@ class ReinforceCausalMech(NeuralCausalMech):
     def forward(
         self,
         inputs: MutableMapping[str, torch.Tensor],
+        elite: bool = False,
         train: bool = False,
         mask: Optional[torch.Tensor] = None,
     ) -> Dict[str, torch.Tensor]:
@@ -188,7 +201,7 @@ class ReinforceCausalMech(NeuralCausalMech):
 
             outputs = {}
             for step in range(step_num):
-                outputs = self.single_step_forward(inputs, train=train, mask=mask)
+                outputs = self.single_step_forward(inputs, train=train, mask=mask, elite=elite)
                 if step < step_num - 1:
                     for name in filter(lambda s: s.startswith("obs"), inputs.keys()):
                         inputs[name] = outputs["next_{}".format(name)][..., : inputs[name].shape[-1]]
@@ -229,50 +242,147 @@ class ReinforceCausalMech(NeuralCausalMech):
 
         return graph_grads.detach().cpu()
 
+    def _graph_stack_size(self, batch_size: int) -> int:
+        """Number of sampled graphs evaluated together, as many as fit the memory budget if it is given."""
+        if self._graph_memory_budget is None:
+            return self._graph_max_stack
+
+        widths = [self.network.input_dim] + list(self.network.hidden_dims) + [self.decoder_input_dim]
+        # two live fp32 activations of the widest layer for every graph, in evaluation without grad
+        graph_bytes = 2 * 4 * max(widths) * self.output_var_num * self.ensemble_num * batch_size
+        return max(1, min(self._graph_MC_samples, int(self._graph_memory_budget * 2**20 // graph_bytes)))
+
+    def _MC_reduce(self, inputs_tensor: torch.Tensor, masks: torch.Tensor) -> torch.Tensor:
+        """Reduce the encoded inputs with every sampled graph, written graph by graph next to each other in the batch
+        dim, so that the graphs are flattened into the batch as a view rather than a copy.
+
+        Args:
+            inputs_tensor: encoded inputs with shape (ensemble-num, batch-size, input-var-num, encoder-output-dim).
+            masks: sampled masks with shape (graph-count, output-var-num, input-var-num).
+
+        Returns: tensor with shape (output-var-num, ensemble-num, graph-count * batch-size, encoder-output-dim).
+
+        """
+        graph_count = masks.shape[0]
+        ensemble_num, batch_size, input_var_num, encoder_output_dim = inputs_tensor.shape
+        masks = masks.to(inputs_tensor.dtype)
+
+        if self.encoder_reduction not in ["sum", "mean"]:
+            mask = masks.transpose(0, 1)[:, :, None, None]
+            # [output-var-num, graph-count, ensemble-num, batch-size, encoder-output-dim] -> graphs after ensemble-num
+            reduced = self.reduce_encoder_output(inputs_tensor, mask=mask).transpose(1, 2)
+            return reduced.reshape(self.output_var_num, ensemble_num, graph_count * batch_size, encoder_output_dim)
+
+        # [ensemble-num, input-var-num, batch-size * encoder-output-dim]
+        flat_inputs = inputs_tensor.permute(0, 2, 1, 3).reshape(ensemble_num, input_var_num, -1)
+        reduced = torch.empty(
+            self.output_var_num, ensemble_num, graph_count, batch_size * encoder_output_dim, device=inputs_tensor.device
+        )
+        for out_idx in range(self.output_var_num):
+            # [graph-count, input-var-num] x [ensemble-num, input-var-num, batch-size * encoder-output-dim]
+            torch.matmul(masks[:, out_idx], flat_inputs, out=reduced[out_idx])
+        if self.encoder_reduction == "mean":
+            reduced /= input_var_num
+        return reduced.view(self.output_var_num, ensemble_num, graph_count * batch_size, encoder_output_dim)
+
+    def _MC_forward(
+        self,
+        inputs: MutableMapping[str, torch.Tensor],
+        inputs_tensor: torch.Tensor,
+        masks: torch.Tensor,
+    ) -> Dict[str, torch.Tensor]:
+        """Forward with every sampled graph, where the inputs are encoded once and broadcast to all graphs.
+
+        The graphs are stacked in the batch dim by ``_MC_reduce`` without a copy, and with ``concat_mask``, the first
+        layer of the network takes the masks by a separate matmul of the mask rows of its weight, added to the output
+        of every sample, rather than concatenating the masks expanded to every member and sample to its input.
+
+        Args:
+            inputs: dict of tensors with shape (ensemble-num, batch-size, specific-dim).
+            inputs_tensor: encoded inputs with shape (ensemble-num, batch-size, input-var-num, encoder-output-dim).
+            masks: sampled masks with shape (graph-count, output-var-num, input-var-num).
+
+        Returns: dict of tensors with shape (ensemble-num, graph-count, batch-size, specific-dim).
+
+        """
+        graph_count, batch_size = masks.shape[0], inputs_tensor.shape[1]
+
+        # [output-var-num, ensemble-num, graph-count * batch-size, encoder-output-dim]
+        reduced_inputs_tensor = self._MC_reduce(inputs_tensor, masks)
+        if self._concat_mask:
+            first_layer, *layers = self.network._layers
+            weight = first_layer.weight
+            # [output-var-num, ensemble-num, graph-count * batch-size, hidden-dim]
+            x = reduced_inputs_tensor.matmul(weight[..., : self.encoder_output_dim, :])
+            # [output-var-num, 1, graph-count, input-var-num] x [output-var-num, ensemble-num, input-var-num, hidden-dim]
+            mask_term = masks.transpose(0, 1).unsqueeze(1).to(x.dtype).matmul(weight[..., self.encoder_output_dim :, :])
+            x.view(*x.shape[:2], graph_count, batch_size, -1).add_(mask_term.unsqueeze(-2))
+            if first_layer.use_bias:
+                x.add_(first_layer.bias)
+            for layer in layers:
+                x = layer(x)
+            output_tensor = x
+        else:
+            output_tensor = self.network(reduced_inputs_tensor)
+
+        _, outputs = self.decoder_bank(output_tensor)
+        # [ensemble-num, graph-count, batch-size, ...]
+        outputs = dict([(name, output.unflatten(1, (graph_count, batch_size))) for name, output in outputs.items()])
+        if self.residual:
+            outputs = self.residual_outputs(dict([(name, value.unsqueeze(1)) for name, value in inputs.items()]), outputs)
+
+        # the inputs differ between graphs from the second step of multi-step forward
+        step_num = int(self.multi_step.split()[-1])
+        if step_num > 1:
+            expand_shape = (self.output_var_num, self.ensemble_num, graph_count, batch_size, -1)
+            # [output-var-num, ensemble-num, graph-count * batch-size, input-var-num]
+            expanded_masks = masks.transpose(0, 1)[:, None, :, None].expand(expand_shape).flatten(2, 3)
+            step_inputs = dict(
+                [
+                    (name, value.unsqueeze(1).expand(self.ensemble_num, graph_count, -1, -1).flatten(1, 2))
+                    for name, value in inputs.items()
+                ]
+            )
+            for step in range(1, step_num):
+                for name in filter(lambda s: s.startswith("obs"), step_inputs.keys()):
+                    step_inputs[name] = outputs["next_{}".format(name)][..., : inputs[name].shape[-1]].flatten(1, 2)
+                outputs = self.single_step_forward(step_inputs, train=False, mask=expanded_masks)
+                outputs = dict([(name, output.unflatten(1, (graph_count, batch_size))) for name, output in outputs.items()])
+        return outputs
+
     def _MC_sample(
         self,
         inputs: MutableMapping[str, torch.Tensor],
         targets: MutableMapping[str, torch.Tensor],
     ) -> Tuple[torch.Tensor]:
-        num_graph_list = [
-            min(self._graph_max_stack, self._graph_MC_samples - i * self._graph_max_stack)
-            for i in range(math.ceil(self._graph_MC_samples / self._graph_max_stack))
-        ]
-        num_graph_list = [(num_graph_list[i], sum(num_graph_list[:i])) for i in range(len(num_graph_list))]
-
         # sample graphs
         adj_mats = self.graph.sample(None, sample_size=self._graph_MC_samples)
 
         # evaluate scores using the sampled adjacency matrices and data
         batch_size, extra_dim = self.get_inputs_batch_size(inputs)
         assert len(extra_dim) == 0, "unexpected dimension in the inputs"
+        graph_stack_size = self._graph_stack_size(batch_size)
+
+        # [ensemble-num, 1, batch-size, specific-dim], broadcast to all graphs
+        expanded_targets = dict([(name, value.unsqueeze(1)) for name, value in targets.items()])
 
         losses = []
-        for graph_count, start_idx in num_graph_list:
-            # [ensemble-num, samples*batch_size, input-var-num, output-var-num]
-            expanded_adj_mats = (
-                adj_mats[None, start_idx : start_idx + graph_count, None]
-                .expand(self.ensemble_num, -1, batch_size, -1, -1)
-                .flatten(1, 2)
-            )
-            expanded_masks = expanded_adj_mats.transpose(-1, -2).permute(2, 0, 1, 3)
+        with torch.no_grad():
+            # [ensemble-num, batch-size, input-var-num, encoder-output-dim], encoded once for all graphs
+            inputs_tensor = self.encoder_bank(inputs)
 
-            expanded_inputs = {}
-            expanded_targets = {}
-            # expand inputs and targets
-            for in_key in inputs:
-                expanded_inputs[in_key] = inputs[in_key].repeat(1, graph_count, 1)
-            for tar_key in targets:
-                expanded_targets[tar_key] = targets[tar_key].repeat(1, graph_count, 1)
+            for start_idx in range(0, self._graph_MC_samples, graph_stack_size):
+                # [graph-count, output-var-num, input-var-num]
+                masks = adj_mats[start_idx : start_idx + graph_stack_size].transpose(-1, -2)
+                outputs = self._MC_forward(inputs, inputs_tensor, masks)
 
-            with torch.no_grad():
-                outputs = self.forward(expanded_inputs, train=False, mask=expanded_masks)
-            loss = variable_loss_func(outputs, expanded_targets, self.output_variables, device=self.device)
-            loss = loss.reshape(loss.shape[0], graph_count, batch_size, -1)
-            losses.append(loss.mean(dim=(0, 2)))
-        losses = sum(losses)
+                graph_count = masks.shape[0]
+                targets_ = dict([(name, value.expand(-1, graph_count, -1, -1)) for name, value in expanded_targets.items()])
+                # [ensemble-num, graph-count, batch-size, output-var-num]
+                loss = variable_loss_func(outputs, targets_, self.output_variables, device=self.device)
+                losses.append(loss.mean(dim=(0, 2)))
 
-        return adj_mats, losses
+        return adj_mats, torch.cat(losses)
 
     def _estimate_graph_grads(
         self,
@@ -302,88 +412,14 @@ class ReinforceCausalMech(NeuralCausalMech):
 
         return graph_grads
 
-    def learn(
-        self,
-        train_loader: DataLoader,
-        valid_loader: DataLoader,
-        graph_data_ratio: float = 0.5,
-        train_graph_freq: int = 2,
-        work_dir: Optional[Union[str, pathlib.Path]] = None,
-        **kwargs
-    ):
-        assert 0 <= graph_data_ratio <= 1, "graph data ratio should be in [0, 1]"
-
-        best_weights: Optional[Dict] = None
-        epoch_iter = range(self.longest_epoch) if self.longest_epoch >= 0 else count()
-        epochs_since_update = 0
-
-        loss_fn = partial(variable_loss_func, output_variables=self.output_variables, device=self.device)
-        train_fn = partial(train_func, forward=partial(self.forward, train=True), optimizer=self.optimizer, loss_func=loss_fn)
-        eval_fn = partial(eval_func, forward=partial(self.forward, train=False), loss_func=loss_fn)
-
-        best_eval_loss = eval_fn(valid_loader).mean(dim=(-2, -1))
-        for epoch in epoch_iter:
-            if self.discovery and epoch % train_graph_freq == 0:
-                grads = self.train_graph(train_loader, data_ratio=graph_data_ratio)
-                print(self.graph.parameters[0])
-                print(self.graph.get_binary_adj_matrix())
-
-            train_loss = train_fn(train_loader)
-            eval_loss = eval_fn(valid_loader)
-
-            maybe_best_weights = self._maybe_get_best_weights(
-                best_eval_loss, eval_loss.mean(dim=(-2, -1)), self.improvement_threshold
-            )
-            if maybe_best_weights:
-                # best loss
-                best_eval_loss = torch.minimum(best_eval_loss, eval_loss.mean(dim=(-2, -1)))
-                best_weights = maybe_best_weights
-                epochs_since_update = 0
-            else:
-                epochs_since_update += 1
-
-            # log
-            self.total_epoch += 1
-            if self.logger is not None:
-                self.logger.record("{}/epoch".format(self.name), epoch)
-                self.logger.record("{}/epoch_since_update".format(self.name), epochs_since_update)
-                self.logger.record("{}/train_dataset_size".format(self.name), len(train_loader.dataset))
-                self.logger.record("{}/valid_dataset_size".format(self.name), len(valid_loader.dataset))
-                self.logger.record("{}/train_loss".format(self.name), train_loss.mean().item())
-                self.logger.record("{}/val_loss".format(self.name), eval_loss.mean().item())
-                self.logger.record("{}/best_val_loss".format(self.name), best_eval_loss.mean().item())
-
-                if self.discovery and epoch % train_graph_freq == 0:
-                    self.logger.record("{}/graph_update_grads".format(self.name), grads.abs().mean().item())
-
-                self.logger.dump(self.total_epoch)
-
-            if self.patience and epochs_since_update >= self.patience:
-                break
-
-        # saving the best models
-        self._maybe_set_best_weights_and_elite(best_weights, best_eval_loss)
-
-        self.save(save_dir=work_dir)
-
-    def _maybe_get_best_weights(
-        self, best_val_loss: torch.Tensor, val_loss: torch.Tensor, threshold: float = 0.01
-    ) -> Optional[Dict]:
-        improvement = (best_val_loss - val_loss) / torch.abs(best_val_loss)
-        if (improvement > threshold).any().item():
-            best_weights = {
-                "graph": copy.deepcopy(self.graph.parameters[0].detach().clone()),
-                "model": copy.deepcopy(self.network.state_dict()),
-            }
-        else:
-            best_weights = None
-
-        return best_weights
+    def train_forward(self, inputs: MutableMapping[str, torch.Tensor]) -> Dict[str, torch.Tensor]:
+        """Forward with graphs sampled for every member and sample in training, see ``single_step_forward``."""
+        return self.forward(inputs, train=True)
 
-    def _maybe_set_best_weights_and_elite(self, best_weights: Optional[Dict], best_val_score: torch.Tensor):
-        if best_weights is not None:
-            self.network.load_state_dict(best_weights["model"])
-            self.graph.set_data(best_weights["graph"])
+    def before_epoch(self, epoch: int, train_loader: DataLoader) -> Dict[str, float]:
+        """Update the graph by REINFORCE every ``train_graph_freq`` epochs, if ``discovery`` is True."""
+        if not self.discovery or epoch % self._train_graph_freq != 0:
+            return {}
 
-        sorted_indices = np.argsort(best_val_score.tolist())
-        self.elite_indices = sorted_indices[: self.elite_num]
+        grads = self.train_graph(train_loader, data_ratio=self._graph_data_ratio)
+        return {"graph_update_grads": grads.abs().mean().item()}
@@ -1,4 +1,4 @@
-from typing import Callable, Dict, List, Union, MutableMapping
+from typing import Callable, Dict, List, Optional, Tuple, Union, MutableMapping
 from collections import defaultdict
 import math
 import time
@@ -90,44 +90,158 @@ def circular_gaussian_nll_loss(
         return loss
 
 
+def masked_encoder_reduction(
+    encoder_output: Tensor,
+    mask: Tensor,
+    reduction: str = "sum",
+    input_var_num: Optional[int] = None,
+) -> Tensor:
+    """Reduce the encoder output over the input-var dimension, keeping only the inputs allowed by ``mask``.
+
+    The masked reduction is computed as a batched contraction over the (output-var, input-var) mask, so the
+    encoder output is never repeated across the extra dimensions of the mask.
+
+    Args:
+        encoder_output: tensor with shape (ensemble-num, batch-size, input-var-num, encoder-output-dim).
+        mask: tensor with shape (..., ensemble-num, batch-size, input-var-num). The ensemble-num and batch-size
+            dimensions may be 1 (e.g. a static graph), in which case they are broadcast without being copied.
+        reduction: "sum", "mean" or "max".
+        input_var_num: number of all input variables for "mean" reduction, if the encoder output is of a subset of
+            them (e.g. parents only), otherwise the input-var-num of the encoder output.
+
+    Returns: tensor with shape (..., ensemble-num, batch-size, encoder-output-dim).
+
+    """
+    ensemble_num, batch_size, encoded_var_num, _ = encoder_output.shape
+    assert mask.shape[-1] == encoded_var_num, "the last dimension of mask should be input-var-num"
+    input_var_num = encoded_var_num if input_var_num is None else input_var_num
+    mask = mask.to(encoder_output.dtype)
+
+    if reduction in ["sum", "mean"]:
+        if mask.shape[-3:-1] == (1, 1):
+            # static mask: one matmul between (..., input-var-num) and (input-var-num, ensemble*batch*dim)
+            reduced = torch.einsum("...i,ebid->...ebd", mask[..., 0, 0, :], encoder_output)
+        else:
+            mask = mask.expand(*mask.shape[:-3], ensemble_num, batch_size, encoded_var_num)
+            reduced = torch.einsum("...ebi,ebid->...ebd", mask, encoder_output)
+
+        if reduction == "mean":
+            # consistent with taking the mean over all input-vars, where the masked ones are zero
+            reduced = reduced / input_var_num
+        return reduced
+    elif reduction == "max":
+        # running maximum over input-vars, the peak memory is of the same size as the reduced output
+        reduced = None
+        for i in range(encoded_var_num):
+            masked = torch.where(mask[..., i, None] == 0, -float("inf"), encoder_output[..., i, :])
+            reduced = masked if reduced is None else torch.maximum(reduced, masked)
+        return reduced
+    else:
+        raise NotImplementedError("not implemented encoder reduction method: {}".format(reduction))
+
+
+def gaussian_nll(mean: Tensor, target: Tensor, log_var: Tensor, eps: float = 1e-4, circular: bool = False) -> Tensor:
+    """Elementwise Gaussian negative log likelihood, the same as ``F.gaussian_nll_loss(..., full=True)`` (or
+    ``circular_gaussian_nll_loss`` if ``circular``), but without the checks of negative var that sync with device.
+
+    The var is clamped by ``eps`` without affecting the gradient, as in ``F.gaussian_nll_loss``.
+    """
+    var = log_var.exp()
+    var = var + (var.clamp(min=eps) - var).detach()
+
+    diff = mean - target
+    if circular:
+        diff = torch.remainder(diff, 2 * torch.pi)
+        diff = torch.where(diff > torch.pi, 2 * torch.pi - diff, diff)
+        return 0.5 * (torch.log(var) + diff**2 / var)
+    return 0.5 * (torch.log(var) + diff**2 / var + math.log(2 * math.pi))
+
+
+def loss_groups(output_variables: List[Variable]) -> Dict[Tuple[type, int], List[int]]:
+    """Group the indices of output variables whose losses can be computed together, by the type and dim."""
+    groups = {}
+    for i, var in enumerate(output_variables):
+        if isinstance(var, (ContinuousVariable, RadianVariable)):
+            key = (type(var), var.dim)
+        elif isinstance(var, BinaryVariable):
+            key = (BinaryVariable, 1)
+        elif isinstance(var, DiscreteVariable):
+            # TODO: onehot to int?
+            raise NotImplementedError
+        else:
+            raise NotImplementedError
+        groups.setdefault(key, []).append(i)
+    return groups
+
+
+def check_finite_loss(loss: Tensor, output_variables: List[Variable]):
+    """Raise if any loss is nan or inf, naming the offending variables. Only one sync with device if all finite.
+
+    Args:
+        loss: tensor with shape (..., output-var-num).
+        output_variables: output variables.
+    """
+    if torch.isfinite(loss).all():
+        return
+
+    loss = loss.detach().reshape(-1, loss.shape[-1])
+    for i, var in enumerate(output_variables):
+        if torch.isnan(loss[:, i]).any():
+            raise ValueError(f"nan loss for {var.name} ({type(var)})")
+        elif torch.isinf(loss[:, i]).any():
+            raise ValueError(f"inf loss for {var.name} ({type(var)})")
+
+
 def variable_loss_func(
     outputs: Dict[str, torch.Tensor],
     targets: Dict[str, torch.Tensor],
     output_variables: List[Variable],
     device: Union[str, torch.device] = "cpu",
+    check_finite: bool = True,
 ):
-    dims = list(outputs.values())[0].shape[:-1]
-    total_loss = torch.zeros(*dims, len(outputs)).to(device)
+    """Losses of all output variables. The variables with the same type and dim are stacked, and their negative log
+    likelihoods are computed together.
 
-    for i, var in enumerate(output_variables):
-        output = outputs[var.name]
-        target = targets[var.name].to(device)
-        if isinstance(var, ContinuousVariable):
-            dim = target.shape[-1]  # (xxx, ensemble-num, batch-size, dim)
+    Args:
+        outputs: dict of outputs with shape (..., ensemble-num, batch-size, specific-dim).
+        targets: dict of targets with shape (..., ensemble-num, batch-size, dim).
+        output_variables: output variables.
+        device: device of the losses.
+        check_finite: whether to check the loss is finite, by one sync with device. It is always checked in the
+            anomaly mode of autograd. Otherwise, the check can be deferred to ``check_finite_loss``.
+
+    Returns: tensor of loss with shape (..., ensemble-num, batch-size, output-var-num).
+
+    """
+    group_losses, order = [], []
+    for (var_type, dim), indices in loss_groups(output_variables).items():
+        names = [output_variables[i].name for i in indices]
+        # [..., ensemble-num, batch-size, group-size, specific-dim]
+        output = torch.stack([outputs[name] for name in names], dim=-2)
+        target = torch.stack([targets[name].to(device) for name in names], dim=-2)
+
+        if var_type is ContinuousVariable:
             assert output.shape[-1] == 2 * dim
-            mean, log_var = output[..., :dim], output[..., dim:]
             # clip log_var to avoid nan loss
-            log_var = torch.clamp(log_var, min=-10, max=10)
-            loss = F.gaussian_nll_loss(mean, target, log_var.exp(), reduction="none", full=True, eps=1e-4).mean(dim=-1)
-            total_loss[..., i] = loss
-        elif isinstance(var, RadianVariable):
-            dim = target.shape[-1]  # (xxx, ensemble-num, batch-size, dim)
+            log_var = torch.clamp(output[..., dim:], min=-10, max=10)
+            loss = gaussian_nll(output[..., :dim], target, log_var, eps=1e-4)
+        elif var_type is RadianVariable:
             assert output.shape[-1] == 2 * dim
-            mean, log_var = output[..., :dim], output[..., dim:]
-            loss = circular_gaussian_nll_loss(mean, target, log_var.exp(), reduction="none").mean(dim=-1)
-            total_loss[..., i] = loss
-        elif isinstance(var, DiscreteVariable):
-            # TODO: onehot to int?
-            raise NotImplementedError
-        elif isinstance(var, BinaryVariable):
-            total_loss[..., i] = F.binary_cross_entropy(output, target, reduction="none")
+            loss = gaussian_nll(output[..., :dim], target, output[..., dim:], eps=1e-6, circular=True)
         else:
-            raise NotImplementedError
+            loss = F.binary_cross_entropy(output, target, reduction="none")
 
-        if torch.isnan(total_loss[..., i]).any():
-            raise ValueError(f"nan loss for {var.name} ({type(var)})")
-        elif torch.isinf(total_loss[..., i]).any():
-            raise ValueError(f"inf loss for {var.name} ({type(var)})")
+        group_losses.append(loss.mean(dim=-1))
+        order += indices
+
+    total_loss = group_losses[0] if len(group_losses) == 1 else torch.cat(group_losses, dim=-1)
+    if order != list(range(len(order))):
+        # back to the order of output variables
+        total_loss = total_loss[..., [order.index(i) for i in range(len(order))]]
+    total_loss = total_loss.to(device)
+
+    if check_finite or torch.is_anomaly_enabled():
+        check_finite_loss(total_loss, output_variables)
     return total_loss
 
 
@@ -136,6 +250,7 @@ def train_func(
     forward: Callable[[MutableMapping[str, torch.Tensor]], Dict[str, torch.Tensor]],
     optimizer: Optimizer,
     loss_func: Callable[[MutableMapping[str, torch.Tensor], MutableMapping[str, torch.Tensor]], torch.Tensor],
+    progress: bool = True,
 ):
     """train for data
 
@@ -144,12 +259,14 @@ def train_func(
         loader: train data-loader.
         optimizer: Optimizer
         loss_func: loss function
+        progress: whether to show the loss of every batch in a progress bar, which syncs with the device on every
+            batch. Otherwise, losses are kept on the device until the end of the epoch.
 
     Returns: tensor of train loss, with shape (xxx, ensemble-num, batch-size).
 
     """
     batch_loss_list = []
-    with tqdm(loader) as pbar:
+    with tqdm(loader, disable=not progress) as pbar:
         for inputs, targets in loader:
             outputs = forward(inputs)
             loss = loss_func(outputs, targets)  # ensemble-num, batch-size, output-var-num
@@ -157,18 +274,20 @@ def train_func(
             optimizer.zero_grad()
             loss.mean().backward()
             optimizer.step()
-            batch_loss_list.append(loss)
+            batch_loss_list.append(loss.detach())
 
-            pbar.set_description(f"train loss: {loss.mean().item():.4f}")
-            pbar.update()
+            if progress:
+                pbar.set_description(f"train loss: {loss.mean().item():.4f}")
+                pbar.update()
 
-    return torch.cat(batch_loss_list, dim=-2).detach().cpu()
+    return torch.cat(batch_loss_list, dim=-2).cpu()
 
 
 def eval_func(
     loader: DataLoader,
     forward: Callable[[MutableMapping[str, torch.Tensor]], Dict[str, torch.Tensor]],
     loss_func: Callable[[MutableMapping[str, torch.Tensor], MutableMapping[str, torch.Tensor]], torch.Tensor],
+    progress: bool = True,
 ):
     """evaluate for data
 
@@ -176,18 +295,81 @@ def eval_func(
         forward: forward function.
         loader: train data-loader.
         loss_func: loss function
+        progress: see ``train_func``.
 
     Returns: tensor of train loss, with shape (xxx, ensemble-num, batch-size).
 
     """
     batch_loss_list = []
     with torch.no_grad():
-        with tqdm(loader) as pbar:
+        with tqdm(loader, disable=not progress) as pbar:
             for inputs, targets in loader:
                 outputs = forward(inputs)
                 loss = loss_func(outputs, targets)  # ensemble-num, batch-size, output-var-num
                 batch_loss_list.append(loss)
 
-                pbar.set_description(f"eval loss: {loss.mean().item():.4f}")
-                pbar.update()
+                if progress:
+                    pbar.set_description(f"eval loss: {loss.mean().item():.4f}")
+                    pbar.update()
     return torch.cat(batch_loss_list, dim=-2).detach().cpu()
+
+
+class EnsembleBestWeights:
+    def __init__(
+        self,
+        member_tensors: List[Tuple[Tensor, int]],
+        shared_tensors: List[Tensor],
+    ):
+        """Best weights of every ensemble member, kept in buffers preallocated once and updated in place.
+
+        The parameters stacked over ensemble members (e.g. of ``ParallelLinear``) are copied only in the slices of
+        the members that improve. The parameters shared by all members (e.g. coders and graph) pair with the slices
+        of every member, so with any of them, the members are kept as one unit and must be updated all together.
+
+        Args:
+            member_tensors: list of (tensor, dim) of tensors stacked over ensemble members along dim ``dim``.
+            shared_tensors: list of tensors shared by all members.
+        """
+        self.member_tensors = member_tensors
+        self.shared_tensors = shared_tensors
+
+        self.member_buffers = [torch.empty_like(tensor) for tensor, _ in member_tensors]
+        self.shared_buffers = [torch.empty_like(tensor) for tensor in shared_tensors]
+
+    @torch.no_grad()
+    def reset(self):
+        """Take the current weights as the best of all members."""
+        for buffer, (tensor, _) in zip(self.member_buffers, self.member_tensors):
+            buffer.copy_(tensor)
+        for buffer, tensor in zip(self.shared_buffers, self.shared_tensors):
+            buffer.copy_(tensor)
+
+    @torch.no_grad()
+    def update(self, improved: Tensor) -> bool:
+        """Copy the current weights of the improved members.
+
+        Args:
+            improved: bool tensor with shape (ensemble-num,).
+
+        Returns: whether any member improved.
+
+        """
+        index = improved.nonzero().squeeze(-1)
+        if len(index) == 0:
+            return False
+        assert len(self.shared_tensors) == 0 or len(index) == len(improved), "members with shared tensors kept as a unit"
+
+        for buffer, (tensor, dim) in zip(self.member_buffers, self.member_tensors):
+            index = index.to(tensor.device)
+            buffer.index_copy_(dim, index, tensor.index_select(dim, index))
+        for buffer, tensor in zip(self.shared_buffers, self.shared_tensors):
+            buffer.copy_(tensor)
+        return True
+
+    @torch.no_grad()
+    def restore(self):
+        """Restore the best weights of all members in one pass."""
+        for buffer, (tensor, _) in zip(self.member_buffers, self.member_tensors):
+            tensor.copy_(buffer)
+        for buffer, tensor in zip(self.shared_buffers, self.shared_tensors):
+            tensor.copy_(buffer)
@@ -1,4 +1,5 @@
-from typing import Optional, MutableMapping
+import math
+from typing import Callable, Dict, Optional, MutableMapping, Tuple, Union
 
 from gym import spaces, Env
 import torch
@@ -6,53 +7,123 @@ from torch.utils.data import Dataset, default_collate
 import numpy as np
 from stable_baselines3.common.buffers import ReplayBuffer, DictReplayBuffer
 
-from cmrl.utils.variables import to_dict_by_space
+from cmrl.utils.variables import parse_space, variable_slices
 
 
 def buffer_to_dict(state_space, action_space, obs2state_fn, replay_buffer: ReplayBuffer, mech: str, device: str = "cpu"):
-    assert mech in ["transition", "reward_mech", "termination_mech"]
-    # dict action is not supported by SB3(so not done by cmrl)
-    assert not isinstance(action_space, spaces.Dict)
-    assert hasattr(replay_buffer, "extra_obs")
-    assert hasattr(replay_buffer, "next_extra_obs")
-
-    real_buffer_size = replay_buffer.buffer_size if replay_buffer.full else replay_buffer.pos
-
-    if hasattr(replay_buffer, "extra_obs"):
-        states = obs2state_fn(replay_buffer.observations[:real_buffer_size, 0], replay_buffer.extra_obs[:real_buffer_size, 0])
-    else:
-        states = replay_buffer.observations[:real_buffer_size, 0]
-    state_dict = to_dict_by_space(states, state_space, prefix="obs", to_tensor=True)
-    act_dict = to_dict_by_space(replay_buffer.actions[:real_buffer_size, 0], action_space, prefix="act", to_tensor=True)
-
-    if hasattr(replay_buffer, "next_extra_obs"):
-        next_states = obs2state_fn(
-            replay_buffer.next_observations[:real_buffer_size, 0], replay_buffer.next_extra_obs[:real_buffer_size, 0]
+    cache = BufferDatasetCache(state_space, action_space, obs2state_fn)
+    cache.update(replay_buffer)
+    return cache.get(mech)
+
+
+class BufferDatasetCache:
+    def __init__(self, state_space: spaces.Space, action_space: spaces.Space, obs2state_fn):
+        """Incremental dataset of a replay buffer, keyed by the position of the buffer.
+
+        States and next-states are converted by ``obs2state_fn`` only for the rows appended since the last ``update``,
+        and kept in packed arrays of the same size as the buffer; actions and rewards are views of the buffer itself.
+        The datasets of transition, reward-mech and termination-mech share the same views of the packed arrays.
+
+        Pay attention that less than ``buffer_size`` rows should be added to the buffer between two updates,
+        otherwise the overwritten rows are not detected.
+
+        Args:
+            state_space: state space.
+            action_space: action space.
+            obs2state_fn: function from (obs, extra-obs) to state.
+        """
+        assert not isinstance(action_space, spaces.Dict)  # dict action is not supported by SB3(so not done by cmrl)
+
+        self.state_space = state_space
+        self.action_space = action_space
+        self.obs2state_fn = obs2state_fn
+
+        self.state_slices = variable_slices(parse_space(state_space, "obs"))
+        self.act_slices = variable_slices(parse_space(action_space, "act"))
+
+        self.replay_buffer: Optional[ReplayBuffer] = None
+        self.pos = 0
+        self.full = False
+        self.states: Optional[np.ndarray] = None
+        self.next_states: Optional[np.ndarray] = None
+        self.terminals: Optional[np.ndarray] = None
+        # indexes of rows converted in the last update
+        self.recent_indexes = np.empty(0, dtype=np.int64)
+
+    def _to_states(self, observations: np.ndarray, extra_obs: Optional[np.ndarray]) -> np.ndarray:
+        if extra_obs is None:
+            return observations
+        return self.obs2state_fn(observations, extra_obs)
+
+    def update(self, replay_buffer: ReplayBuffer) -> int:
+        """Convert the rows appended to ``replay_buffer`` since the last update.
+
+        Returns: number of converted rows.
+
+        """
+        buffer_size = replay_buffer.buffer_size
+        if replay_buffer is not self.replay_buffer:
+            self.replay_buffer = replay_buffer
+            self.pos, self.full = 0, False
+            state_dim = sum(s.stop - s.start for s in self.state_slices.values())
+            self.states = np.zeros((buffer_size, state_dim), dtype=np.float32)
+            self.next_states = np.zeros((buffer_size, state_dim), dtype=np.float32)
+            self.terminals = np.zeros((buffer_size, 1), dtype=np.float32)
+
+        row_num = (replay_buffer.pos - self.pos) % buffer_size
+        if row_num == 0 and replay_buffer.full and not self.full:
+            row_num = buffer_size
+        indices = (self.pos + np.arange(row_num)) % buffer_size
+        self.recent_indexes = indices
+        if row_num == 0:
+            return 0
+
+        extra_obs = getattr(replay_buffer, "extra_obs", None)
+        next_extra_obs = getattr(replay_buffer, "next_extra_obs", None)
+        self.states[indices] = self._to_states(
+            replay_buffer.observations[indices, 0], None if extra_obs is None else extra_obs[indices, 0]
+        )
+        self.next_states[indices] = self._to_states(
+            replay_buffer.next_observations[indices, 0], None if next_extra_obs is None else next_extra_obs[indices, 0]
         )
-    else:
-        next_states = replay_buffer.next_observations[:real_buffer_size, 0]
-    next_state_dict = to_dict_by_space(next_states, state_space, prefix="next_obs", to_tensor=True)
-
-    inputs = {}
-    inputs.update(state_dict)
-    inputs.update(act_dict)
-
-    if mech == "transition":
-        outputs = next_state_dict
-    elif mech == "reward_mech":
-        rewards = replay_buffer.rewards[:real_buffer_size, 0]
-        rewards_dict = {"reward": torch.from_numpy(rewards[:, None])}
-        inputs.update(next_state_dict)
-        outputs = rewards_dict
-    elif mech == "termination_mech":
-        terminals = replay_buffer.dones[:real_buffer_size, 0] * (1 - replay_buffer.timeouts[:real_buffer_size, 0])
-        terminals_dict = {"terminal": torch.from_numpy(terminals[:, None])}
-        inputs.update(next_state_dict)
-        outputs = terminals_dict
-    else:
-        raise NotImplementedError("support mechs in [transition, reward_mech, termination_mech] only")
-
-    return inputs, outputs
+        self.terminals[indices, 0] = replay_buffer.dones[indices, 0] * (1 - replay_buffer.timeouts[indices, 0])
+
+        self.pos, self.full = replay_buffer.pos, replay_buffer.full
+        return row_num
+
+    def get(self, mech: str) -> Tuple[Dict[str, torch.Tensor], Dict[str, torch.Tensor]]:
+        """Get inputs and outputs of the mech, as tensors sharing memory with the cache and the buffer.
+
+        Args:
+            mech: "transition", "reward_mech" or "termination_mech".
+
+        Returns: inputs and outputs, dict of variable name and tensor with shape (data-size, specific-dim).
+
+        """
+        assert mech in ["transition", "reward_mech", "termination_mech"]
+        assert self.replay_buffer is not None, "update the cache with a replay buffer first"
+
+        size = self.replay_buffer.buffer_size if self.full else self.pos
+        states = torch.from_numpy(self.states[:size])
+        next_states = torch.from_numpy(self.next_states[:size])
+        actions = torch.from_numpy(self.replay_buffer.actions[:size, 0].astype(np.float32, copy=False))
+
+        inputs = dict([(name, states[:, s]) for name, s in self.state_slices.items()])
+        inputs.update([(name, actions[:, s]) for name, s in self.act_slices.items()])
+        next_state_dict = dict([("next_{}".format(name), next_states[:, s]) for name, s in self.state_slices.items()])
+
+        if mech == "transition":
+            outputs = next_state_dict
+        elif mech == "reward_mech":
+            inputs.update(next_state_dict)
+            outputs = {"reward": torch.from_numpy(self.replay_buffer.rewards[:size, 0, None].astype(np.float32, copy=False))}
+        elif mech == "termination_mech":
+            inputs.update(next_state_dict)
+            outputs = {"terminal": torch.from_numpy(self.terminals[:size])}
+        else:
+            raise NotImplementedError("support mechs in [transition, reward_mech, termination_mech] only")
+
+        return inputs, outputs
 
 
 class EnsembleBufferDataset(Dataset):
@@ -96,6 +167,238 @@ class EnsembleBufferDataset(Dataset):
         return len(self.indexes)
 
 
+class EnsembleDataSplit:
+    def __init__(self, ensemble_num: int = 7, train_ratio: float = 0.8, seed: int = 1):
+        """Persistent train/valid split of a growing dataset, shared by repeated learning.
+
+        The split is extended incrementally when the dataset grows, so a data point never migrates between train and
+        valid sets. Only the int32 indexes of both sets are stored, the bootstrap indexes of ensemble members are
+        generated lazily for every epoch. A local generator is used rather than the global random state of numpy.
+
+        Args:
+            ensemble_num: number of ensemble members.
+            train_ratio: ratio of train data.
+            seed: seed of the local generator.
+        """
+        self.ensemble_num = ensemble_num
+        self.train_ratio = train_ratio
+        self.generator = np.random.default_rng(seed)
+
+        self.size = 0
+        self.train_indexes = np.empty(0, dtype=np.int32)
+        self.valid_indexes = np.empty(0, dtype=np.int32)
+        self.train_mask = np.empty(0, dtype=bool)
+
+    def extend(self, size: int):
+        """Split the data points in [self.size, size), keeping the split of existing data points."""
+        if size < self.size:
+            raise ValueError("dataset can not shrink from {} to {}".format(self.size, size))
+
+        new_indexes = self.generator.permutation(np.arange(self.size, size, dtype=np.int32))
+        new_train_num = int(size * self.train_ratio) - len(self.train_indexes)
+        self.train_indexes = np.concatenate([self.train_indexes, new_indexes[:new_train_num]])
+        self.valid_indexes = np.concatenate([self.valid_indexes, new_indexes[new_train_num:]])
+        self.train_mask = np.concatenate([self.train_mask, np.zeros(size - self.size, dtype=bool)])
+        self.train_mask[new_indexes[:new_train_num]] = True
+        self.size = size
+
+    def train_ensemble_indexes(self) -> np.ndarray:
+        """Bootstrap indexes of train set for an epoch, with shape (train-size, ensemble-num)."""
+        return np.stack([self.generator.permutation(self.train_indexes) for _ in range(self.ensemble_num)], axis=1)
+
+    def valid_ensemble_indexes(self, sample_num: Optional[int] = None) -> np.ndarray:
+        """Indexes of valid set, the same for all members, with shape (valid-size, ensemble-num).
+
+        Args:
+            sample_num: sample at most ``sample_num`` indexes of valid set without replacement, or all if None.
+        """
+        valid_indexes = self.valid_indexes
+        if sample_num is not None and sample_num < len(valid_indexes):
+            valid_indexes = self.generator.choice(valid_indexes, size=sample_num, replace=False)
+        return np.broadcast_to(valid_indexes[:, None], (len(valid_indexes), self.ensemble_num))
+
+    def recent_ensemble_indexes(
+        self, sample_num: int, recent_indexes: Optional[np.ndarray] = None, recent_ratio: float = 0.5
+    ) -> np.ndarray:
+        """Sample indexes of train set with replacement for every member, biased to the recent data.
+
+        Args:
+            sample_num: number of indexes of every member.
+            recent_indexes: indexes of data added recently, of which the ones in train set are sampled with a ratio of
+                ``recent_ratio``, and the rest is sampled from the whole train set.
+            recent_ratio: ratio of samples from recent data.
+
+        Returns: indexes with shape (sample-num, ensemble-num).
+
+        """
+        recent_train_indexes = np.empty(0, dtype=np.int32)
+        if recent_indexes is not None and len(recent_indexes) > 0:
+            recent_train_indexes = recent_indexes[self.train_mask[recent_indexes]].astype(np.int32)
+        recent_num = int(sample_num * recent_ratio) if len(recent_train_indexes) > 0 else 0
+
+        indexes = np.concatenate(
+            [
+                self.generator.choice(recent_train_indexes, size=(recent_num, self.ensemble_num)),
+                self.generator.choice(self.train_indexes, size=(sample_num - recent_num, self.ensemble_num)),
+            ]
+        ).astype(np.int32)
+        return self.generator.permuted(indexes, axis=0)
+
+
+class PackedTensorData:
+    def __init__(self, device: Union[str, torch.device] = "cpu"):
+        """Inputs and outputs of a growing dataset, packed into one contiguous tensor on ``device``, persistent across
+        repeated learning, from which ``TensorEnsembleBatchSampler`` gathers batches by index.
+
+        The tensor is written in place: an update copies only the rows appended since the last update and the rows
+        given as changed, e.g. the ones overwritten in a replay buffer, so that its cost does not grow with data. The
+        storage grows geometrically, and its rows beyond ``size`` are not used.
+
+        Args:
+            device: device of the packed data.
+        """
+        self.device = device
+
+        self.input_slices: Dict[str, slice] = {}
+        self.output_slices: Dict[str, slice] = {}
+        self.storage: Optional[torch.Tensor] = None
+        self.size = 0
+
+    @property
+    def data(self) -> torch.Tensor:
+        # [data-size, input-dim + output-dim]
+        return self.storage[: self.size]
+
+    def views(self) -> Tuple[Dict[str, torch.Tensor], Dict[str, torch.Tensor]]:
+        """Inputs and outputs as views of the packed tensor, with shape (data-size, specific-dim)."""
+        data = self.data
+        inputs = dict([(key, data[:, s]) for key, s in self.input_slices.items()])
+        outputs = dict([(key, data[:, s]) for key, s in self.output_slices.items()])
+        return inputs, outputs
+
+    def update(
+        self,
+        inputs: MutableMapping[str, torch.Tensor],
+        outputs: MutableMapping[str, torch.Tensor],
+        indexes: Optional[np.ndarray] = None,
+    ) -> int:
+        """Pack the rows of ``inputs`` and ``outputs`` appended since the last update, and the rows of ``indexes``.
+
+        All rows are packed again if ``indexes`` is None, if the variables differ from the last update, or if the
+        dataset shrinks.
+
+        Args:
+            inputs: dict of tensors with shape (data-size, specific-dim).
+            outputs: dict of tensors with shape (data-size, specific-dim).
+            indexes: indexes of the rows changed since the last update, e.g. ``BufferDatasetCache.recent_indexes``.
+
+        Returns: number of packed rows.
+
+        """
+        size = len(next(iter(inputs.values())))
+        input_slices = variable_slices_of(inputs)
+        input_dim = sum(s.stop - s.start for s in input_slices.values())
+        output_slices = variable_slices_of(outputs, start=input_dim)
+        if indexes is None or input_slices != self.input_slices or output_slices != self.output_slices or size < self.size:
+            self.input_slices, self.output_slices = input_slices, output_slices
+            self.storage, self.size = None, 0
+            indexes = np.empty(0, dtype=np.int64)
+
+        if self.storage is None or size > len(self.storage):
+            dim = input_dim + sum(s.stop - s.start for s in output_slices.values())
+            capacity = size if self.storage is None else max(size, 2 * len(self.storage))
+            storage = torch.empty((capacity, dim), dtype=torch.float32, device=self.device)
+            if self.storage is not None:
+                storage[: self.size] = self.storage[: self.size]
+            self.storage = storage
+
+        indexes = np.asarray(indexes, dtype=np.int64)
+        indexes = np.concatenate([indexes[indexes < self.size], np.arange(self.size, size, dtype=np.int64)])
+        if len(indexes) > 0:
+            rows = torch.as_tensor(indexes)
+            self.storage[rows.to(self.device)] = torch.cat(
+                [torch.as_tensor(value, dtype=torch.float32)[rows].reshape(len(rows), -1) for value in inputs.values()]
+                + [torch.as_tensor(value, dtype=torch.float32)[rows].reshape(len(rows), -1) for value in outputs.values()],
+                dim=-1,
+            ).to(self.device)
+        self.size = size
+        return len(indexes)
+
+
+class TensorEnsembleBatchSampler:
+    def __init__(
+        self,
+        inputs: MutableMapping[str, torch.Tensor],
+        outputs: MutableMapping[str, torch.Tensor],
+        indexes: Union[np.ndarray, Callable[[], np.ndarray]],
+        batch_size: int = 256,
+        device: Union[str, torch.device] = "cpu",
+        packed_data: Optional[PackedTensorData] = None,
+    ):
+        """In-memory batch sampler of ensemble data, a replacement of ``EnsembleBufferDataset`` and ``DataLoader``.
+
+        Inputs and outputs are packed into one contiguous tensor (on ``device``), and every batch is gathered from it
+        by one fancy-indexing, then split into views of variables. No worker process is used.
+
+        Args:
+            inputs: dict of tensors with shape (data-size, specific-dim).
+            outputs: dict of tensors with shape (data-size, specific-dim).
+            indexes: data indexes of every ensemble member with shape (sample-num, ensemble-num), see
+                ``EnsembleBufferDataset.indexes``, or a function generating them for every epoch, see
+                ``EnsembleDataSplit.train_ensemble_indexes``.
+            batch_size: batch size.
+            device: device of the packed data.
+            packed_data: persistent packed data of inputs and outputs, already updated, to gather batches from rather
+                than packing inputs and outputs again (default None).
+        """
+        self.batch_size = batch_size
+
+        if packed_data is None:
+            packed_data = PackedTensorData(device)
+            packed_data.update(inputs, outputs)
+        self.device = packed_data.device
+        self.input_slices = packed_data.input_slices
+        self.output_slices = packed_data.output_slices
+        # [data-size, input-dim + output-dim]
+        self.data = packed_data.data
+        self.index_fn = indexes if callable(indexes) else None
+        self.indexes = self._to_tensor(indexes() if callable(indexes) else indexes)
+        self._fresh = True
+
+    def _to_tensor(self, indexes: np.ndarray) -> torch.Tensor:
+        # [ensemble-num, sample-num]
+        return torch.as_tensor(np.ascontiguousarray(np.asarray(indexes).T), dtype=torch.long, device=self.device)
+
+    @property
+    def sample_num(self):
+        return self.indexes.shape[1]
+
+    def __len__(self):
+        return math.ceil(self.sample_num / self.batch_size)
+
+    def __iter__(self):
+        if self.index_fn is not None and not self._fresh:
+            self.indexes = self._to_tensor(self.index_fn())
+        self._fresh = False
+
+        for start in range(0, self.indexes.shape[1], self.batch_size):
+            # [ensemble-num, batch-size, input-dim + output-dim]
+            batch = self.data[self.indexes[:, start : start + self.batch_size]]
+            inputs = dict([(key, batch[..., s]) for key, s in self.input_slices.items()])
+            outputs = dict([(key, batch[..., s]) for key, s in self.output_slices.items()])
+            yield inputs, outputs
+
+
+def variable_slices_of(data: MutableMapping[str, torch.Tensor], start: int = 0) -> Dict[str, slice]:
+    """Slices of every value in the packed data, where values are flattened and concatenated in the last dim."""
+    slices = {}
+    for key, value in data.items():
+        dim = int(np.prod(value.shape[1:]))
+        slices[key] = slice(start, start + dim)
+        start += dim
+    return slices
+
+
 def collate_fn(data):
     inputs, outputs = default_collate(data)
     inputs = dict([(key, value.transpose(0, 1)) for key, value in inputs.items()])
@@ -1,20 +1,20 @@
-import abc
-from collections import ChainMap
+import copy
 import pathlib
+import threading
+import time
 from typing import Dict, List, Optional, Tuple, Union
-from functools import partial
 
 import numpy as np
 import torch
 from gym import spaces
-from torch.utils.data import DataLoader
 from stable_baselines3.common.logger import Logger
 from stable_baselines3.common.buffers import ReplayBuffer
+from stable_baselines3.common.policies import BasePolicy
 
-from cmrl.utils.variables import to_dict_by_space
+from cmrl.utils.variables import parse_space, variable_slices
 from cmrl.models.causal_mech.base import BaseCausalMech
-from cmrl.models.data_loader import buffer_to_dict
-from cmrl.types import Obs2StateFnType, State2ObsFnType
+from cmrl.models.data_loader import BufferDatasetCache
+from cmrl.types import Obs2StateFnType, State2ObsFnType, RewardFnType, TermFnType
 
 
 class Dynamics:
@@ -27,9 +27,21 @@ class Dynamics:
             state2obs_fn: State2ObsFnType,
             reward_mech: Optional[BaseCausalMech] = None,
             termination_mech: Optional[BaseCausalMech] = None,
+            elite_only: bool = False,
+            propagation: str = "mean",
             seed: int = 7,
             logger: Optional[Logger] = None,
     ):
+        """Dynamics composed of transition, reward-mech and termination-mech.
+
+        Args:
+            elite_only: whether to forward elite members of the mechs only, once they are known, rather than the whole
+                ensemble.
+            propagation: how to propagate the ensemble in ``step``, "mean" for the mean of members, "random" for
+                a member sampled uniformly for every sample (i.e. TS-1).
+
+        """
+        assert propagation in ["mean", "random"], "not supported propagation method: {}".format(propagation)
         self.transition = transition
         self.state_space = state_space
         self.action_space = action_space
@@ -37,6 +49,8 @@ class Dynamics:
         self.state2obs_fn = state2obs_fn
         self.reward_mech = reward_mech
         self.termination_mech = termination_mech
+        self.elite_only = elite_only
+        self.propagation = propagation
         self.seed = seed
         self.logger = logger
 
@@ -44,41 +58,345 @@ class Dynamics:
         self.learn_termination = termination_mech is not None
 
         self.device = self.transition.device
-        pass
-
-    def learn(self, real_replay_buffer: ReplayBuffer, work_dir: Optional[Union[str, pathlib.Path]] = None, **kwargs):
-        get_dataset = partial(
-            buffer_to_dict,
-            state_space=self.state_space,
-            action_space=self.action_space,
-            obs2state_fn=self.obs2state_fn,
-            replay_buffer=real_replay_buffer,
-            device=self.device
-        )
+        self.generator = torch.Generator(device=self.device)
+        self.generator.manual_seed(seed)
+
+        # static index from variable name to its slice in the packed obs and action
+        self.obs_slices = variable_slices(parse_space(self.state_space, "obs"))
+        self.act_slices = variable_slices(parse_space(self.action_space, "act"))
+
+        self.dataset_cache = BufferDatasetCache(self.state_space, self.action_space, self.obs2state_fn)
+
+    def learn(
+        self,
+        real_replay_buffer: ReplayBuffer,
+        work_dir: Optional[Union[str, pathlib.Path]] = None,
+        train_steps: Optional[int] = None,
+        longest_epoch: Optional[int] = None,
+        recent_ratio: float = 0.5,
+        **kwargs
+    ):
+        """Learn mechs from the replay buffer, warm-started from their current weights and optimizer states.
+
+        Args:
+            real_replay_buffer: replay buffer of real data.
+            work_dir: directory to save models.
+            train_steps: if given, learn incrementally, i.e. train every mech for a budget of ``train_steps`` batches
+                per epoch, with a ratio of ``recent_ratio`` sampled from data added since the last learning.
+            longest_epoch: the longest epoch of incremental learning, mech's own if None.
+            recent_ratio: ratio of samples from recent data.
+        """
+        # convert the newly added data only, and share it between mechs
+        self.dataset_cache.update(real_replay_buffer)
+        learn_kwargs = self._learn_kwargs(work_dir, train_steps, longest_epoch, recent_ratio)
 
-        # transition
-        self.transition.learn(*get_dataset(mech="transition"), work_dir=work_dir)
-        # reward-mech
+        for name, mech in self.learned_mechs.items():
+            # only the rows converted in this update are packed again into the persistent tensor of the mech
+            mech.learn(*self.dataset_cache.get(name), updated_indexes=self.dataset_cache.recent_indexes, **learn_kwargs)
+
+    @property
+    def learned_mechs(self) -> Dict[str, BaseCausalMech]:
+        """Mechs to learn, i.e. transition, and reward-mech and termination-mech if they are learned."""
+        mechs = {"transition": self.transition}
         if self.learn_reward:
-            self.reward_mech.learn(*get_dataset(mech="reward_mech"), work_dir=work_dir)
-        # termination-mech
+            mechs["reward_mech"] = self.reward_mech
         if self.learn_termination:
-            self.termination_mech.learn(*get_dataset(mech="termination_mech"), work_dir=work_dir)
+            mechs["termination_mech"] = self.termination_mech
+        return mechs
 
-    def step(self, batch_obs, batch_action):
+    def _learn_kwargs(
+        self,
+        work_dir: Optional[Union[str, pathlib.Path]] = None,
+        train_steps: Optional[int] = None,
+        longest_epoch: Optional[int] = None,
+        recent_ratio: float = 0.5,
+    ) -> Dict:
+        learn_kwargs = dict(work_dir=work_dir)
+        if train_steps is not None:
+            learn_kwargs.update(
+                train_steps=train_steps,
+                longest_epoch=longest_epoch,
+                recent_indexes=self.dataset_cache.recent_indexes,
+                recent_ratio=recent_ratio,
+            )
+        return learn_kwargs
+
+    def to_inputs(self, batch_obs: torch.Tensor, batch_action: torch.Tensor) -> Dict[str, torch.Tensor]:
+        """Split the packed obs and action into views of every variable, without copying.
+
+        Args:
+            batch_obs: packed obs with shape (..., batch-size, obs-dim).
+            batch_action: packed action with shape (..., batch-size, action-dim).
+
+        Returns: dict of variable name and its view, with shape (..., batch-size, specific-dim).
+
+        """
+        inputs = dict([(name, batch_obs[..., s]) for name, s in self.obs_slices.items()])
+        inputs.update([(name, batch_action[..., s]) for name, s in self.act_slices.items()])
+        return inputs
+
+    def tensor_step(
+        self, obs: torch.Tensor, act: torch.Tensor
+    ) -> Tuple[torch.Tensor, Optional[torch.Tensor], Optional[torch.Tensor], torch.Tensor]:
+        """Run transition, reward-mech and termination-mech as one batched pipeline on the device.
+
+        Args:
+            obs: packed obs (i.e. state) with shape (batch-size, obs-dim).
+            act: packed action with shape (batch-size, action-dim).
+
+        Returns:
+            next state with shape (batch-size, obs-dim),
+            reward with shape (batch-size, 1), or None if the reward-mech is not learned,
+            terminal with shape (batch-size, 1), or None if the termination-mech is not learned,
+            next state of every ensemble member with shape (ensemble-num or elite-num, batch-size, obs-dim).
+
+        """
         with torch.no_grad():
-            obs_dict = to_dict_by_space(batch_obs, self.state_space, "obs",
-                                        repeat=7, to_tensor=True, device=self.device)
-            act_dict = to_dict_by_space(batch_action, self.action_space, "act",
-                                        repeat=7, to_tensor=True, device=self.device)
+            # [1, batch-size, obs-dim], the ensemble dim is broadcast in mechanisms rather than tiled
+            inputs = self.to_inputs(obs[None], act[None])
+
+            outputs = self.transition.forward(inputs, elite=self.elite_only)
+
+            # [ensemble-num or elite-num, batch-size, obs-dim], the mean of every next-obs variable
+            ensemble_next_state = torch.cat(
+                [outputs["next_{}".format(name)][..., : s.stop - s.start] for name, s in self.obs_slices.items()], dim=-1
+            )
+            if self.propagation == "mean":
+                batch_next_state = ensemble_next_state.mean(dim=0)
+            else:
+                member_num, batch_size = ensemble_next_state.shape[:2]
+                members = torch.randint(member_num, (batch_size,), generator=self.generator, device=self.device)
+                batch_next_state = ensemble_next_state[members, torch.arange(batch_size, device=self.device)]
+
+            batch_reward, batch_terminal = None, None
+            if self.learn_reward or self.learn_termination:
+                # reuse the obs and action views, and feed the propagated next state without leaving the device
+                inputs.update([("next_{}".format(name), batch_next_state[None, :, s]) for name, s in self.obs_slices.items()])
+            if self.learn_reward:
+                # [batch-size, 1], the mean of the reward distribution, averaged over members
+                batch_reward = self.reward_mech.forward(inputs, elite=self.elite_only)["reward"][..., :1].mean(dim=0)
+            if self.learn_termination:
+                # [batch-size, 1], terminal if the averaged probability is over one half
+                batch_terminal = self.termination_mech.forward(inputs, elite=self.elite_only)["terminal"].mean(dim=0) > 0.5
+
+        return batch_next_state, batch_reward, batch_terminal, ensemble_next_state
+
+    def step(self, batch_obs, batch_action):
+        obs = torch.as_tensor(batch_obs, dtype=torch.float32, device=self.device)
+        act = torch.as_tensor(batch_action, dtype=torch.float32, device=self.device)
+        batch_next_state, batch_reward, batch_terminal, ensemble_next_state = self.tensor_step(obs, act)
+
+        batch_next_obs = self.state2obs_fn(batch_next_state.cpu().numpy())
+        if batch_reward is not None:
+            batch_reward = batch_reward.cpu().numpy()
+        if batch_terminal is not None:
+            batch_terminal = batch_terminal.cpu().numpy()
+        info = {"origin-next_obs": ensemble_next_state.cpu().numpy()}
+
+        return batch_next_obs, batch_reward, batch_terminal, info
+
+    def rollout(
+        self,
+        start_obs: np.ndarray,
+        policy: BasePolicy,
+        horizon: int,
+        replay_buffer: ReplayBuffer,
+        reward_fn: Optional[RewardFnType] = None,
+        termination_fn: Optional[TermFnType] = None,
+        deterministic: bool = False,
+    ) -> int:
+        """Branch-rollout from a batch of obs for ``horizon`` steps, and add all transitions to ``replay_buffer``.
+
+        Every step calls ``policy.predict`` and ``tensor_step`` on the whole batch of alive branches, and writes the
+        batch of transitions to the arrays of ``replay_buffer`` at once. A branch stops once it is terminal.
+
+        Args:
+            start_obs: obs to branch from, with shape (batch-size, obs-dim).
+            policy: SB3's policy.
+            horizon: the longest length of branches.
+            replay_buffer: SB3's replay buffer of model data, with one env.
+            reward_fn: reward function, used only if the reward-mech is not learned.
+            termination_fn: termination function, used only if the termination-mech is not learned.
+            deterministic: whether to use deterministic actions.
+
+        Returns: number of transitions added.
+
+        """
+        assert self.learn_reward or reward_fn, "you must learn a reward-mech or give one"
+        assert self.learn_termination or termination_fn, "you must learn a termination-mech or give one"
+
+        transition_num = 0
+        batch_obs = np.asarray(start_obs, dtype=np.float32)
+        for _ in range(horizon):
+            if len(batch_obs) == 0:
+                break
+            batch_action, _ = policy.predict(batch_obs, deterministic=deterministic)
+            batch_next_state, batch_reward, batch_terminal, _ = self.tensor_step(
+                torch.as_tensor(batch_obs, dtype=torch.float32, device=self.device),
+                torch.as_tensor(batch_action, dtype=torch.float32, device=self.device),
+            )
+            batch_next_obs = self.state2obs_fn(batch_next_state.cpu().numpy())
+
+            if batch_reward is None:
+                batch_reward = reward_fn(batch_next_obs, batch_obs, batch_action)
+            else:
+                batch_reward = batch_reward.cpu().numpy()
+            if batch_terminal is None:
+                batch_terminal = termination_fn(batch_next_obs, batch_obs, batch_action)
+            else:
+                batch_terminal = batch_terminal.cpu().numpy()
+            batch_terminal = np.asarray(batch_terminal).reshape(-1).astype(bool)
+
+            buffer_action = batch_action
+            if isinstance(policy.action_space, spaces.Box):
+                buffer_action = policy.scale_action(batch_action)
+            add_to_buffer(replay_buffer, batch_obs, batch_next_obs, buffer_action, batch_reward, batch_terminal)
+            transition_num += len(batch_obs)
+
+            batch_obs = batch_next_obs[~batch_terminal]
+        return transition_num
+
+
+def add_to_buffer(
+    replay_buffer: ReplayBuffer,
+    obs: np.ndarray,
+    next_obs: np.ndarray,
+    action: np.ndarray,
+    reward: np.ndarray,
+    done: np.ndarray,
+):
+    """Add a batch of transitions to SB3's replay buffer of one env by slice assignment, rather than one by one."""
+    assert replay_buffer.n_envs == 1, "only replay buffer of one env is supported"
+    assert not replay_buffer.optimize_memory_usage, "replay buffer optimizing memory usage is not supported"
+
+    batch_size = len(obs)
+    # the latest transitions are kept if the batch is larger than the buffer
+    start = max(batch_size - replay_buffer.buffer_size, 0)
+    indices = (replay_buffer.pos + np.arange(batch_size - start)) % replay_buffer.buffer_size
+
+    replay_buffer.observations[indices, 0] = obs[start:].reshape(-1, *replay_buffer.obs_shape)
+    replay_buffer.next_observations[indices, 0] = next_obs[start:].reshape(-1, *replay_buffer.obs_shape)
+    replay_buffer.actions[indices, 0] = action[start:].reshape(-1, replay_buffer.action_dim)
+    replay_buffer.rewards[indices, 0] = np.asarray(reward).reshape(-1)[start:]
+    replay_buffer.dones[indices, 0] = done[start:]
+    if hasattr(replay_buffer, "timeouts"):
+        replay_buffer.timeouts[indices, 0] = 0
+
+    if replay_buffer.pos + batch_size >= replay_buffer.buffer_size:
+        replay_buffer.full = True
+    replay_buffer.pos = (replay_buffer.pos + batch_size - start) % replay_buffer.buffer_size
+
+
+class AsyncDynamicsLearner:
+    def __init__(self, dynamics: Dynamics):
+        """Learn dynamics in a background thread, double-buffered.
+
+        A round of learning trains a shadow of every learned mech (warm-started from the live one by
+        ``load_state_dict``, including the optimizer states) on a snapshot of the replay buffer, while the live mechs
+        keep serving rollouts. Once the round finishes, i.e. the shadow mechs hold their best validated weights, every
+        shadow mech is swapped in by replacing the reference held by dynamics, so that no rollout sees partially
+        trained weights, and the replaced live mech is the shadow of the next round. A shadow mech is swapped in only
+        if it validates better than the live one on the snapshot, otherwise it is kept as the shadow, so that a worse
+        or diverged round never replaces a good model.
+
+        The shadow of a mech is copied once, and shares the data split and the packed data with the live one. The
+        snapshot is the packed data itself, updated in place by the rows converted since the last round only.
+
+        Args:
+            dynamics: dynamics whose mechs are learned.
+        """
+        self.dynamics = dynamics
+
+        self.thread: Optional[threading.Thread] = None
+        self.shadow_mechs: Dict[str, BaseCausalMech] = {}
+        self.error: Optional[BaseException] = None
+        # names of the shadow mechs kept in the last swap, for not validating better than the live ones
+        self.rejected: List[str] = []
+        self.start_time = 0.0
+        self.learn_time = 0.0
+
+    @property
+    def running(self) -> bool:
+        return self.thread is not None and self.thread.is_alive()
+
+    @property
+    def finished(self) -> bool:
+        return self.thread is not None and not self.thread.is_alive()
+
+    def start(self, real_replay_buffer: ReplayBuffer, work_dir: Optional[Union[str, pathlib.Path]] = None, **kwargs):
+        """Start a round of learning on a snapshot of ``real_replay_buffer``, see ``Dynamics.learn`` for kwargs."""
+        assert not self.running, "the last round of learning is still running"
+
+        self.dynamics.dataset_cache.update(real_replay_buffer)
+        learn_kwargs = self.dynamics._learn_kwargs(
+            work_dir, kwargs.get("train_steps"), kwargs.get("longest_epoch"), kwargs.get("recent_ratio", 0.5)
+        )
+        # nothing to pack in background, the packed data is updated here
+        learn_kwargs["updated_indexes"] = np.empty(0, dtype=np.int64)
+
+        datasets = {}
+        for name, mech in self.dynamics.learned_mechs.items():
+            if name in self.shadow_mechs:
+                self.shadow_mechs[name].load_state_dict(mech.state_dict())
+            else:
+                self.shadow_mechs[name] = shadow_copy(mech)
+            # the cache and buffer keep changing in the main thread, so the views of the packed data are learned
+            mech.packed_data.update(*self.dynamics.dataset_cache.get(name), self.dynamics.dataset_cache.recent_indexes)
+            datasets[name] = mech.packed_data.views()
+
+        self.error = None
+        self.start_time = time.perf_counter()
+        self.thread = threading.Thread(target=self._learn, args=(datasets, learn_kwargs), daemon=True)
+        self.thread.start()
+
+    def _learn(self, datasets, learn_kwargs):
+        try:
+            for name in self.dynamics.learned_mechs:
+                self.shadow_mechs[name].learn(*datasets[name], **learn_kwargs)
+        except BaseException as e:
+            self.error = e
+        self.learn_time = time.perf_counter() - self.start_time
+
+    def maybe_swap(self) -> bool:
+        """Swap the shadow mechs in if the round of learning is finished, each only if it validates better than the
+        live mech, i.e. the mean validation loss of its members on the snapshot is lower after the round than before.
+
+        Returns: whether any mech is swapped.
+
+        """
+        if not self.finished:
+            return False
+
+        self.thread = None
+        if self.error is not None:
+            raise RuntimeError("background learning of dynamics failed") from self.error
+
+        self.rejected = []
+        for name in self.dynamics.learned_mechs:
+            mech, live_mech = self.shadow_mechs[name], getattr(self.dynamics, name)
+            # the loss before the round is of the weights copied from the live mech, on the same validation data
+            start_val_loss = getattr(mech, "start_val_loss", None)
+            best_val_loss = getattr(mech, "best_val_loss", None)
+            if start_val_loss is not None and not best_val_loss.mean() < start_val_loss.mean():
+                self.rejected.append(name)
+                if live_mech.logger is not None:
+                    live_mech.logger.record("dynamics/{}_swap_rejected".format(name), 1)
+                continue
+
+            mech.logger, live_mech.logger = live_mech.logger, None
+            setattr(self.dynamics, name, mech)
+            self.shadow_mechs[name] = live_mech
+        return len(self.rejected) < len(self.dynamics.learned_mechs)
 
-            inputs = ChainMap(obs_dict, act_dict)
-            outputs = self.transition.forward(inputs)
+    def wait(self):
+        if self.thread is not None:
+            self.thread.join()
 
-        batch_next_state = torch.concat([tensor.mean(dim=0)[:, :1] for tensor in outputs.values()],
-                                        dim=-1).cpu().numpy()
-        batch_next_obs = self.state2obs_fn(batch_next_state)
-        info = {
-            "origin-next_obs": torch.concat([tensor[:, :, :1] for tensor in outputs.values()], dim=-1).cpu().numpy()}
 
-        return batch_next_obs, None, None, info
+def shadow_copy(mech: BaseCausalMech) -> BaseCausalMech:
+    """Deep copy of the mech, without the logger which is not thread-safe, and sharing the data split and the packed
+    data with the mech."""
+    shared = [getattr(mech, name, None) for name in ["data_split", "packed_data"]]
+    memo = dict([(id(obj), obj) for obj in shared if obj is not None])
+    memo[id(mech.logger)] = None
+    return copy.deepcopy(mech, memo)
@@ -39,6 +39,7 @@ class VecFakeEnv(VecEnv):
             max_episode_steps: int = 1000,
             branch_rollout: bool = False,
             # others
+            seed: Optional[int] = None,
             logger: Optional[Logger] = None,
             **kwargs,
     ):
@@ -74,6 +75,9 @@ class VecFakeEnv(VecEnv):
         self._current_batch_action = None
         self._envs_length = np.zeros(self.num_envs, dtype=int)
 
+        # seeded by the seed of dynamics if not given, so that the same experiment seed gives the same init obs
+        self.generator = np.random.default_rng(self.dynamics.seed if seed is None else seed)
+
     def step_async(self, actions: np.ndarray) -> None:
         assert len(actions.shape) == 2  # batch, action_dim
         self._current_batch_action = actions
@@ -111,7 +115,7 @@ class VecFakeEnv(VecEnv):
             infos[idx]["TimeLimit.truncated"] = batch_truncate[idx]
             if batch_done[idx]:
                 infos[idx]["terminal_observation"] = batch_next_obs[idx].copy()
-                self.single_reset(idx)
+        self.bulk_reset(np.flatnonzero(batch_done))
 
         return (
             self._current_batch_obs.copy(),
@@ -127,12 +131,7 @@ class VecFakeEnv(VecEnv):
             return_info: bool = False,
             options: Optional[dict] = None,
     ):
-        if self.branch_rollout:
-            upper_bound = self.replay_buffer.buffer_size if self.replay_buffer.full else self.replay_buffer.pos
-            batch_inds = np.random.randint(0, upper_bound, size=self.num_envs)
-            self._current_batch_obs = self.replay_buffer.observations[batch_inds, 0]
-        else:
-            self._current_batch_obs = self.get_init_obs_fn(self.num_envs)
+        self._current_batch_obs = self._init_obs(self.num_envs)
         self._envs_length = np.zeros(self.num_envs, dtype=int)
 
         if return_info:
@@ -149,15 +148,25 @@ class VecFakeEnv(VecEnv):
     def env_is_wrapped(self, wrapper_class: Type[gym.Wrapper], indices: VecEnvIndices = None) -> List[bool]:
         return [False for _ in range(self.num_envs)]
 
-    def single_reset(self, idx):
-        self._envs_length[idx] = 0
+    def _init_obs(self, num: int) -> np.ndarray:
+        """Sample ``num`` init obs in one draw, from the replay buffer if using branch-rollout."""
         if self.branch_rollout:
             upper_bound = self.replay_buffer.buffer_size if self.replay_buffer.full else self.replay_buffer.pos
-            batch_idxs = np.random.randint(0, upper_bound)
-            self._current_batch_obs[idx] = self.replay_buffer.observations[batch_idxs, 0]
+            batch_inds = self.generator.integers(0, upper_bound, size=num)
+            return self.replay_buffer.observations[batch_inds, 0]
         else:
             assert self.get_init_obs_fn is not None
-            self._current_batch_obs[idx] = self.get_init_obs_fn(1)
+            return self.get_init_obs_fn(num)
+
+    def bulk_reset(self, indices: np.ndarray):
+        """Reset all envs of ``indices`` at once."""
+        if len(indices) == 0:
+            return
+        self._envs_length[indices] = 0
+        self._current_batch_obs[indices] = self._init_obs(len(indices))
+
+    def single_reset(self, idx):
+        self.bulk_reset(np.array([idx]))
 
     def render(self, mode="human"):
         raise NotImplementedError
@@ -172,7 +181,120 @@ class VecFakeEnv(VecEnv):
         pass
 
     def get_attr(self, attr_name: str, indices: VecEnvIndices = None) -> List[Any]:
-        pass
+        # attributes are shared by all fake envs
+        return [getattr(self, attr_name, None) for _ in self._get_indices(indices)]
 
     def set_attr(self, attr_name: str, value: Any, indices: VecEnvIndices = None) -> None:
         pass
+
+
+class TorchVecFakeEnv(VecFakeEnv):
+    def __init__(self, *args, **kwargs):
+        """``VecFakeEnv`` keeping obs, episode lengths and done masks as tensors on the device of dynamics.
+
+        Predictions never leave the device between steps, they are packed and copied to a pinned host buffer once
+        per step, as the numpy arrays returned to SB3. Two host buffers are used in turn, so the arrays returned by
+        one step stay valid until the step after the next one (SB3 keeps the last obs for one step).
+
+        The arguments are the same as ``VecFakeEnv``.
+        """
+        super(TorchVecFakeEnv, self).__init__(*args, **kwargs)
+
+        self.obs_dim = self.observation_space.shape[0]
+        self._obs = torch.zeros(self.num_envs, self.obs_dim, dtype=torch.float32, device=self.device)
+        self._actions = None
+        self._lengths = torch.zeros(self.num_envs, dtype=torch.long, device=self.device)
+
+        # [num-envs, obs-dim + 3], packed obs, reward, done and truncate
+        pin_memory = torch.device(self.device).type == "cuda" and torch.cuda.is_available()
+        self._host_buffers = [
+            torch.empty(self.num_envs, self.obs_dim + 3, dtype=torch.float32, pin_memory=pin_memory) for _ in range(2)
+        ]
+        self._host_index = 0
+
+    def _next_host_buffer(self) -> torch.Tensor:
+        self._host_index = 1 - self._host_index
+        return self._host_buffers[self._host_index]
+
+    def _fallback(self, fn, batch_next_obs: torch.Tensor, batch_obs: torch.Tensor, batch_action: torch.Tensor):
+        # reward or termination function given in numpy, only used if the mech is not learned
+        outputs = fn(batch_next_obs.cpu().numpy(), batch_obs.cpu().numpy(), batch_action.cpu().numpy())
+        return torch.as_tensor(np.asarray(outputs), device=self.device).reshape(self.num_envs)
+
+    def step_async(self, actions: np.ndarray) -> None:
+        assert len(actions.shape) == 2  # batch, action_dim
+        self._actions = torch.as_tensor(actions, dtype=torch.float32, device=self.device)
+
+    def step_wait(self):
+        batch_next_state, batch_reward, batch_terminal, ensemble_next_state = self.dynamics.tensor_step(
+            self._obs, self._actions
+        )
+        batch_next_obs = self.dynamics.state2obs_fn(batch_next_state)
+
+        if batch_reward is None:
+            batch_reward = self._fallback(self.reward_fn, batch_next_obs, self._obs, self._actions)
+        if batch_terminal is None:
+            batch_terminal = self._fallback(self.termination_fn, batch_next_obs, self._obs, self._actions)
+        batch_reward = batch_reward.reshape(self.num_envs).float()
+        batch_terminal = batch_terminal.reshape(self.num_envs).bool()
+
+        if self.penalty_coeff != 0:
+            # the same as ``get_penalty``
+            dists = torch.linalg.norm(ensemble_next_state - ensemble_next_state.mean(dim=0), dim=-1)
+            penalty = dists.max(dim=0)[0] * self.penalty_coeff
+            batch_reward = batch_reward - penalty
+
+            if self.logger is not None:
+                self.logger.record_mean("rollout/penalty", penalty.mean().item())
+
+        self._lengths += 1
+        batch_truncate = self._lengths >= self.max_episode_steps
+        batch_done = torch.logical_or(batch_terminal, batch_truncate)
+
+        packed = torch.cat([batch_next_obs, batch_reward[:, None], batch_done[:, None], batch_truncate[:, None]], dim=-1)
+        # the only device-to-host copy of the step
+        host = self._next_host_buffer().copy_(packed).numpy()
+        assert not np.isnan(host).any(), "next obs and reward of fake env should not be nan."
+        obs, reward = host[:, : self.obs_dim], host[:, self.obs_dim]
+        done, truncate = host[:, self.obs_dim + 1] > 0, host[:, self.obs_dim + 2] > 0
+
+        infos = [{} for _ in range(self.num_envs)]
+        self._obs = batch_next_obs
+        if done.any():
+            for idx in np.flatnonzero(done):
+                infos[idx]["TimeLimit.truncated"] = truncate[idx]
+                infos[idx]["terminal_observation"] = obs[idx].copy()
+            self._reset_done(done, obs)
+
+        return obs, reward, done, infos
+
+    def _reset_done(self, done: np.ndarray, obs: np.ndarray):
+        """Reset envs masked by ``done``, writing init obs to both the returned ``obs`` and device tensors."""
+        init_obs = self._init_obs(int(done.sum())).astype(np.float32)
+        obs[done] = init_obs
+        done_mask = torch.as_tensor(done, device=self.device)
+        self._obs = self._obs.masked_scatter(done_mask[:, None], torch.as_tensor(init_obs, device=self.device))
+        self._lengths.masked_fill_(done_mask, 0)
+
+    def reset(
+            self,
+            *,
+            seed: Optional[int] = None,
+            return_info: bool = False,
+            options: Optional[dict] = None,
+    ):
+        obs = self._next_host_buffer().numpy()[:, : self.obs_dim]
+        obs[:] = self._init_obs(self.num_envs)
+        self._obs = torch.as_tensor(obs, device=self.device).clone()
+        self._lengths.zero_()
+
+        if return_info:
+            return obs, {}
+        else:
+            return obs
+
+    def bulk_reset(self, indices: np.ndarray):
+        done = np.zeros(self.num_envs, dtype=bool)
+        done[indices] = True
+        if done.any():
+            self._reset_done(done, np.empty((self.num_envs, self.obs_dim), dtype=np.float32))
@@ -1,10 +1,10 @@
 from typing import Optional, List
+import copy
 
 import numpy as np
 import torch
 from torch import nn as nn
 from torch import Tensor
-from itertools import product
 
 from cmrl.models.util import truncated_normal_
 
@@ -46,7 +46,8 @@ class ParallelLinear(nn.Module):
         self.init_params()
 
     def init_params(self):
-        """Initialize weights and biases. Currently, only `kaiming_uniform` and `truncated_normal` are supported.
+        """Initialize weights and biases. Currently, only `kaiming_uniform`, `truncated_normal` and `linear` are
+        supported, where `linear` is the default initialization of ``nn.Linear`` for every parallel network.
 
         Returns: None
 
@@ -54,16 +55,53 @@ class ParallelLinear(nn.Module):
         if self.init_type == "kaiming_uniform":
             nn.init.kaiming_uniform_(self.weight, nonlinearity="relu")
         elif self.init_type == "truncated_normal":
-            stddev = 1 / (2 * np.sqrt(self.input_dim))
-            for dims in product(*map(range, self.extra_dims)):
-                truncated_normal_(self.weight.data[dims], std=stddev)
+            # all parallel networks at once
+            truncated_normal_(self.weight.data, std=1 / (2 * np.sqrt(self.input_dim)))
+        elif self.init_type == "linear":
+            # kaiming_uniform_(a=sqrt(5)) of ``nn.Linear`` weights and its bias, i.e. U(-1/sqrt(fan-in), 1/sqrt(fan-in))
+            bound = 1 / np.sqrt(self.input_dim)
+            nn.init.uniform_(self.weight, -bound, bound)
+            if self.use_bias:
+                nn.init.uniform_(self.bias, -bound, bound)
         else:
             raise NotImplementedError
 
-    def forward(self, x: Tensor) -> Tensor:
-        xw = x.matmul(self.weight)
+    def select(self, dim: int, index: Tensor) -> "ParallelLinear":
+        """Get a new layer with the parallel networks selected by ``index`` along one of the extra dims.
+
+        Args:
+            dim: index of the extra dim, e.g. -1 for the last extra dim.
+            index: indices of the parallel networks to keep.
+
+        Returns: new layer, whose parameters are detached copies of the selected slices.
+
+        """
+        dim = dim % len(self.extra_dims)
+        index = torch.as_tensor(index, dtype=torch.long, device=self.device)
+
+        layer = copy.copy(self)
+        layer._parameters = dict(self._parameters)
+        layer.extra_dims = list(self.extra_dims)
+        layer.extra_dims[dim] = len(index)
+        layer.weight = nn.Parameter(self.weight.detach().index_select(dim, index), requires_grad=False)
+        if self.use_bias:
+            layer.bias = nn.Parameter(self.bias.detach().index_select(dim, index), requires_grad=False)
+        return layer
+
+    def forward(self, x: Tensor, index: Optional[Tensor] = None) -> Tensor:
+        """Forward of the parallel networks, or only those selected by ``index`` along the first extra dim.
+
+        Args:
+            x: input tensor.
+            index: indices of the parallel networks to run, with live (trainable) parameters, unlike ``select``.
+
+        Returns: output tensor.
+
+        """
+        weight = self.weight if index is None else self.weight.index_select(0, index)
+        xw = x.matmul(weight)
         if self.use_bias:
-            return xw + self.bias
+            return xw + (self.bias if index is None else self.bias.index_select(0, index))
         else:
             return xw
 
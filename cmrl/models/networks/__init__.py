@@ -1,2 +1,2 @@
-from cmrl.models.networks.coder import VariableEncoder, VariableDecoder
+from cmrl.models.networks.coder import VariableEncoder, VariableDecoder, EncoderBank, DecoderBank
 from cmrl.models.networks.parallel_mlp import ParallelMLP
@@ -1,11 +1,15 @@
-from typing import List, Optional
+import pathlib
+from abc import abstractmethod
+from typing import List, Optional, Dict, MutableMapping, Sequence, Tuple, Union
 
+import torch
 import torch.nn as nn
 from omegaconf import DictConfig
+from hydra.utils import instantiate
 
 from cmrl.utils.variables import Variable, DiscreteVariable, ContinuousVariable, BinaryVariable, RadianVariable
 from cmrl.models.networks.base_network import BaseNetwork, create_activation
-from cmrl.models.layers import RadianLayer
+from cmrl.models.layers import RadianLayer, ParallelLinear
 
 
 class VariableEncoder(BaseNetwork):
@@ -102,3 +106,322 @@ class VariableDecoder(BaseNetwork):
             raise NotImplementedError("Type {} is not supported by VariableDecoder".format(type(self.variable)))
 
         self._layers = nn.ModuleList(layers)
+
+
+class CoderBank(BaseNetwork):
+    def __init__(
+        self,
+        variables: List[Variable],
+        coder_cfg: DictConfig,
+        coder_type: str = "encoder",
+    ):
+        """Base class of the banks of coders, in which continuous and radian variables are grouped, and each group
+        is computed by a stack of ``ParallelLinear`` layers. The stacks keep the layer indices and the ``nn.Linear``
+        initialization of the single-variable coder, so that the coder of every variable can still be saved to and
+        loaded from its own `{name}_{type}.pth`, and is trained from the same initial distribution.
+
+        Args:
+            variables: variables, the order of which is kept in the outputs.
+            coder_cfg: config of the single-variable coder.
+            coder_type: "encoder" or "decoder".
+        """
+        self.variables = variables
+        self.coder_cfg = coder_cfg
+        self.coder_type = coder_type
+        self.hidden_dims = list(coder_cfg.get("hidden_dims", None) or [])
+        self.bias = coder_cfg.get("bias", True)
+        self.activation_fn_cfg = coder_cfg.get("activation_fn_cfg", None)
+
+        # group name -> names of variables in the group
+        self.groups: Dict[str, List[str]] = {}
+        for var in self.variables:
+            group_name = self.group_name(var)
+            if group_name is None:
+                self.groups[var.name] = [var.name]
+            else:
+                self.groups.setdefault(group_name, []).append(var.name)
+
+        super(CoderBank, self).__init__()
+        self._model_filename = "{}_bank.pth".format(coder_type)
+
+        # indices to restore the order of variables after concatenating outputs of groups
+        names = [name for group_names in self.groups.values() for name in group_names]
+        order = [names.index(var.name) for var in self.variables]
+        self.register_buffer("_order", torch.tensor(order, dtype=torch.long), persistent=False)
+        self._ordered = order == list(range(len(order)))
+
+    @abstractmethod
+    def group_name(self, variable: Variable) -> Optional[str]:
+        """Name of the group of the variable, or None if it is not stacked with others."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def build_group(self, variable: Variable, group_size: int) -> nn.ModuleList:
+        raise NotImplementedError
+
+    def build(self):
+        variables_dict = dict([(var.name, var) for var in self.variables])
+
+        layers = {}
+        for group_name, names in self.groups.items():
+            var = variables_dict[names[0]]
+            if self.group_name(var) is None:
+                layers[group_name] = instantiate(self.coder_cfg)(variable=var)
+            else:
+                layers[group_name] = self.build_group(var, len(names))
+        self._layers = nn.ModuleDict(layers)
+
+    def run_group(self, layers: nn.ModuleList, x: torch.Tensor, index: Optional[torch.Tensor] = None) -> torch.Tensor:
+        """Run a group of stacked layers.
+
+        Args:
+            layers: stacked layers of the group.
+            x: tensor with shape (group-size, ..., input-dim), or (len(index), ..., input-dim) if ``index`` is given.
+            index: indices of the coders in the group to run, all of them if None.
+
+        Returns: tensor with shape (group-size or len(index), ..., output-dim).
+
+        """
+        extra_shape = x.shape[1:-1]
+        # [group-size, N, input-dim]
+        x = x.reshape(x.shape[0], -1, x.shape[-1])
+        for layer in layers:
+            x = layer(x, index) if isinstance(layer, ParallelLinear) else layer(x)
+        return x.reshape(x.shape[0], *extra_shape, x.shape[-1])
+
+    def variable_state_dict(self, name: str) -> Dict[str, torch.Tensor]:
+        """State dict of the coder of a single variable, in the format of the single-variable coder."""
+        for group_name, names in self.groups.items():
+            if name not in names:
+                continue
+            layers = self._layers[group_name]
+            if not isinstance(layers, nn.ModuleList):
+                return layers.state_dict()
+
+            idx = names.index(name)
+            state_dict = {}
+            for key, value in layers.state_dict(prefix="_layers.").items():
+                if key.endswith("weight"):
+                    # [input-dim, output-dim] of ``ParallelLinear`` -> [output-dim, input-dim] of ``nn.Linear``
+                    state_dict[key] = value[idx].T.clone()
+                else:
+                    # [1, output-dim] -> [output-dim]
+                    state_dict[key] = value[idx, 0].clone()
+            return state_dict
+        raise KeyError("no {} for variable {}".format(self.coder_type, name))
+
+    def load_variable_state_dict(self, name: str, state_dict: Dict[str, torch.Tensor]):
+        """Load the state dict of a single-variable coder into its slice of the bank."""
+        for group_name, names in self.groups.items():
+            if name not in names:
+                continue
+            layers = self._layers[group_name]
+            if not isinstance(layers, nn.ModuleList):
+                layers.load_state_dict(state_dict)
+                return
+
+            idx = names.index(name)
+            own_state_dict = layers.state_dict(prefix="_layers.")
+            assert set(own_state_dict.keys()) == set(state_dict.keys()), "mismatched keys in {} of {}".format(
+                self.coder_type, name
+            )
+            with torch.no_grad():
+                for key, value in own_state_dict.items():
+                    if key.endswith("weight"):
+                        value[idx].copy_(state_dict[key].T)
+                    else:
+                        value[idx, 0].copy_(state_dict[key])
+            return
+        raise KeyError("no {} for variable {}".format(self.coder_type, name))
+
+    def save(self, save_dir: Union[str, pathlib.Path]):
+        """Saves the coder of every variable to `{name}_{type}.pth`, the same as single-variable coders."""
+        for var in self.variables:
+            model_dict = {"state_dict": self.variable_state_dict(var.name)}
+            torch.save(model_dict, pathlib.Path(save_dir) / "{}_{}.pth".format(var.name, self.coder_type))
+
+    def load(self, load_dir: Union[str, pathlib.Path]):
+        """Loads the coder of every variable from `{name}_{type}.pth`."""
+        for var in self.variables:
+            model_path = pathlib.Path(load_dir) / "{}_{}.pth".format(var.name, self.coder_type)
+            model_dict = torch.load(model_path, map_location=self.device)
+            self.load_variable_state_dict(var.name, model_dict["state_dict"])
+
+
+class EncoderBank(CoderBank):
+    def __init__(
+        self,
+        variables: List[Variable],
+        encoder_cfg: DictConfig,
+    ):
+        """Encoders of all input variables. Continuous and radian variables with the same type and dim are encoded
+        together in one batched call, other variables fall back to their own ``VariableEncoder``.
+
+        Args:
+            variables: input variables.
+            encoder_cfg: config of ``VariableEncoder``, with `output_dim`, `hidden_dims`, `bias` and
+                `activation_fn_cfg`.
+        """
+        self.output_dim = encoder_cfg.get("output_dim", 100)
+
+        super(EncoderBank, self).__init__(variables, encoder_cfg, coder_type="encoder")
+
+    def group_name(self, variable: Variable) -> Optional[str]:
+        if isinstance(variable, (ContinuousVariable, RadianVariable)):
+            return "{}_{}".format(type(variable).__name__, variable.dim)
+        return None
+
+    def build_group(self, variable: Variable, group_size: int) -> nn.ModuleList:
+        hidden_dim = self.output_dim if len(self.hidden_dims) == 0 else self.hidden_dims[0]
+
+        # keep the same layer indices as ``VariableEncoder``, so that their state dicts share keys
+        layers = []
+        if isinstance(variable, RadianVariable):
+            layers.append(RadianLayer())
+        layers.append(ParallelLinear(variable.dim, hidden_dim, extra_dims=[group_size], init_type="linear"))
+
+        hidden_dims = self.hidden_dims + [self.output_dim]
+        for i in range(len(hidden_dims) - 1):
+            layers += [
+                ParallelLinear(hidden_dims[i], hidden_dims[i + 1], extra_dims=[group_size], bias=self.bias, init_type="linear")
+            ]
+            layers += [create_activation(self.activation_fn_cfg)]
+
+        return nn.ModuleList(layers)
+
+    def subset_plan(self, names: Sequence[str]) -> Tuple[Dict, Optional[torch.Tensor]]:
+        """Plan to encode a subset of input variables only, see ``forward``.
+
+        Args:
+            names: names of the input variables to encode.
+
+        Returns: dict of group name and (names of the subset in the group, indices of them in the group or None if
+            the whole group is in the subset), and the indices to restore the order of ``names`` (None if kept).
+
+        """
+        groups = {}
+        for group_name, group_names in self.groups.items():
+            subset = [name for name in group_names if name in names]
+            if len(subset) == 0:
+                continue
+            index = None
+            if len(subset) != len(group_names):
+                index = torch.tensor([group_names.index(name) for name in subset], dtype=torch.long, device=self.device)
+            groups[group_name] = (subset, index)
+
+        encoded_names = [name for subset, _ in groups.values() for name in subset]
+        order = [encoded_names.index(name) for name in names]
+        if order == list(range(len(order))):
+            return groups, None
+        return groups, torch.tensor(order, dtype=torch.long, device=self.device)
+
+    def forward(
+        self,
+        inputs: MutableMapping[str, torch.Tensor],
+        plan: Optional[Tuple[Dict, Optional[torch.Tensor]]] = None,
+    ) -> torch.Tensor:
+        """Encode all input variables, or only a subset of them planned by ``subset_plan``.
+
+        Args:
+            inputs: dict of tensors with shape (..., specific-dim).
+            plan: plan of the subset to encode, the encoders out of which are skipped.
+
+        Returns: tensor with shape (..., input-var-num or subset-size, encoder-output-dim).
+
+        """
+        device = self.device
+        if plan is None:
+            groups = [(group_name, names, None) for group_name, names in self.groups.items()]
+        else:
+            groups = [(group_name, names, index) for group_name, (names, index) in plan[0].items()]
+
+        outputs = []
+        for group_name, names, index in groups:
+            layers = self._layers[group_name]
+            if not isinstance(layers, nn.ModuleList):
+                outputs.append(layers(inputs[names[0]].to(device)).unsqueeze(-2))
+            else:
+                # [group-size, ..., specific-dim]
+                x = torch.stack([inputs[name].to(device) for name in names])
+                # [..., group-size, encoder-output-dim]
+                outputs.append(self.run_group(layers, x, index).movedim(0, -2))
+
+        outputs = outputs[0] if len(outputs) == 1 else torch.cat(outputs, dim=-2)
+        if plan is not None:
+            if plan[1] is not None:
+                outputs = outputs.index_select(-2, plan[1])
+        elif not self._ordered:
+            outputs = outputs.index_select(-2, self._order)
+        return outputs
+
+
+class DecoderBank(CoderBank):
+    def __init__(
+        self,
+        variables: List[Variable],
+        decoder_cfg: DictConfig,
+    ):
+        """Decoders of all output variables. Continuous and radian variables with the same dim are decoded together
+        by one stack of ``ParallelLinear`` layers, indexed by the output-var dimension of the network output. Other
+        variables fall back to their own ``VariableDecoder``.
+
+        Args:
+            variables: output variables.
+            decoder_cfg: config of ``VariableDecoder``, with `input_dim`, `hidden_dims`, `bias` and
+                `activation_fn_cfg`.
+        """
+        self.input_dim = decoder_cfg.get("input_dim", 100)
+
+        super(DecoderBank, self).__init__(variables, decoder_cfg, coder_type="decoder")
+
+        # all outputs can be packed in one tensor if they are decoded by a single stack
+        self.packable = len(self.groups) == 1 and isinstance(next(iter(self._layers.values())), nn.ModuleList)
+
+    def group_name(self, variable: Variable) -> Optional[str]:
+        if isinstance(variable, (ContinuousVariable, RadianVariable)):
+            return "gaussian_{}".format(variable.dim)
+        return None
+
+    def build_group(self, variable: Variable, group_size: int) -> nn.ModuleList:
+        # keep the same layer indices as ``VariableDecoder``, so that their state dicts share keys
+        layers = [create_activation(self.activation_fn_cfg)]
+
+        hidden_dims = [self.input_dim] + self.hidden_dims
+        for i in range(len(hidden_dims) - 1):
+            layers += [
+                ParallelLinear(hidden_dims[i], hidden_dims[i + 1], extra_dims=[group_size], bias=self.bias, init_type="linear")
+            ]
+            layers += [create_activation(self.activation_fn_cfg)]
+
+        # mean and log-var
+        layers.append(ParallelLinear(hidden_dims[-1], variable.dim * 2, extra_dims=[group_size], init_type="linear"))
+        return nn.ModuleList(layers)
+
+    def forward(self, hidden: torch.Tensor) -> Tuple[Optional[torch.Tensor], Dict[str, torch.Tensor]]:
+        """Decode all output variables.
+
+        Args:
+            hidden: output of network, with shape (output-var-num, ..., decoder-input-dim).
+
+        Returns: packed outputs with shape (output-var-num, ..., 2 * dim), or None if the outputs can not be packed;
+            and dict of outputs with shape (..., specific-dim), the tensors in which are views of the packed outputs.
+
+        """
+        assert hidden.shape[0] == len(self.variables), "the first dimension of hidden should be output-var-num"
+
+        if self.packable:
+            packed = self.run_group(next(iter(self._layers.values())), hidden)
+            return packed, dict([(var.name, packed[i]) for i, var in enumerate(self.variables)])
+
+        index_dict = dict([(var.name, i) for i, var in enumerate(self.variables)])
+        outputs = {}
+        for group_name, names in self.groups.items():
+            layers = self._layers[group_name]
+            if not isinstance(layers, nn.ModuleList):
+                outputs[names[0]] = layers(hidden[index_dict[names[0]]])
+            else:
+                index = torch.tensor([index_dict[name] for name in names], device=hidden.device)
+                group_outputs = self.run_group(layers, hidden.index_select(0, index))
+                for i, name in enumerate(names):
+                    outputs[name] = group_outputs[i]
+        return None, dict([(var.name, outputs[var.name]) for var in self.variables])
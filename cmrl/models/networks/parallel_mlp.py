@@ -1,6 +1,7 @@
 import pathlib
 from typing import List, Optional, Sequence, Union
 from abc import abstractmethod
+import copy
 
 import torch
 import torch.nn as nn
@@ -50,3 +51,24 @@ class ParallelMLP(BaseNetwork):
         ]
 
         self._layers = nn.ModuleList(layers)
+
+    def select(self, dim: int, index: torch.Tensor) -> "ParallelMLP":
+        """Get a new network with the parallel networks selected by ``index`` along one of the extra dims, e.g. the
+        elite members of an ensemble. The parameters of the new network are sliced once and not trainable.
+
+        Args:
+            dim: index of the extra dim, e.g. -1 for the last extra dim.
+            index: indices of the parallel networks to keep.
+
+        Returns: new network
+        """
+        dim = dim % len(self.extra_dims)
+
+        network = copy.copy(self)
+        network._modules = dict(self._modules)
+        network.extra_dims = list(self.extra_dims)
+        network.extra_dims[dim] = len(index)
+        network._layers = nn.ModuleList(
+            [layer.select(dim, index) if isinstance(layer, ParallelLinear) else layer for layer in self._layers]
+        )
+        return network
@@ -10,7 +10,11 @@ from cmrl.utils.variables import Variable, ContinuousVariable, DiscreteVariable,
 # inplace truncated normal function for pytorch.
 # credit to https://github.com/Xingyu-Lin/mbpo_pytorch/blob/main/model.py#L64
 def truncated_normal_(tensor: torch.Tensor, mean: float = 0, std: float = 1) -> torch.Tensor:
-    """Samples from a truncated normal distribution in-place.
+    """Samples from a normal distribution truncated to two standard deviations, in-place.
+
+    The whole tensor is sampled at once, and only the values out of bounds are re-sampled in every round of
+    rejection, so the number of rounds (and syncs with device) grows with the log of the tensor size, rather than
+    with the number of slices sampled one by one.
 
     Args:
         tensor (tensor): the tensor in which sampled values will be stored.
@@ -21,11 +25,17 @@ def truncated_normal_(tensor: torch.Tensor, mean: float = 0, std: float = 1) ->
         (tensor): the tensor with the stored values. Note that this modifies the input tensor
             in place, so this is just a pointer to the same object.
     """
-    torch.nn.init.normal_(tensor, mean=mean, std=std)
-    while True:
-        cond = torch.logical_or(tensor < mean - 2 * std, tensor > mean + 2 * std)
-        bound_violations = torch.sum(cond).item()
-        if bound_violations == 0:
-            break
-        tensor[cond] = torch.normal(mean, std, size=(bound_violations,), device=tensor.device)
+    with torch.no_grad():
+        contiguous = tensor if tensor.is_contiguous() else torch.empty_like(tensor, memory_format=torch.contiguous_format)
+        flat = contiguous.view(-1)
+        flat.normal_(mean, std)
+        index = ((flat - mean).abs() > 2 * std).nonzero().squeeze(-1)
+        while len(index) > 0:
+            values = torch.empty(len(index), dtype=flat.dtype, device=flat.device).normal_(mean, std)
+            valid = (values - mean).abs() <= 2 * std
+            flat[index[valid]] = values[valid]
+            index = index[~valid]
+
+        if contiguous is not tensor:
+            tensor.copy_(contiguous)
     return tensor
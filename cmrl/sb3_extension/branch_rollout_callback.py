@@ -0,0 +1,110 @@
+from typing import Optional
+
+import numpy as np
+from stable_baselines3.common.callbacks import BaseCallback
+from stable_baselines3.common.buffers import ReplayBuffer
+from stable_baselines3.common.noise import ActionNoise
+from stable_baselines3.common.off_policy_algorithm import OffPolicyAlgorithm
+from stable_baselines3.common.type_aliases import RolloutReturn, TrainFreq, TrainFrequencyUnit
+from stable_baselines3.common.utils import should_collect_more_steps
+from stable_baselines3.common.vec_env import VecEnv
+
+from cmrl.models.dynamics import Dynamics
+from cmrl.types import RewardFnType, TermFnType
+
+
+class BranchRolloutCallback(BaseCallback):
+    def __init__(
+        self,
+        dynamics: Dynamics,
+        real_replay_buffer: ReplayBuffer,
+        reward_fn: Optional[RewardFnType] = None,
+        termination_fn: Optional[TermFnType] = None,
+        rollout_batch_size: int = 100000,
+        rollout_length: int = 5,
+        freq_rollout: int = 250,
+        seed: Optional[int] = None,
+    ):
+        """Feed the replay buffer of the agent with bulk branch-rollouts of dynamics, i.e. ``Dynamics.rollout``, rather
+        than stepping the fake env one step at a time.
+
+        Args:
+            dynamics: dynamics to rollout.
+            real_replay_buffer: replay buffer of real data, from which branches start.
+            reward_fn: reward function, used only if the reward-mech is not learned.
+            termination_fn: termination function, used only if the termination-mech is not learned.
+            rollout_batch_size: number of branches of every rollout.
+            rollout_length: the longest length of branches.
+            freq_rollout: rollout every ``freq_rollout`` steps.
+            seed: seed of sampling start obs.
+        """
+        super(BranchRolloutCallback, self).__init__(verbose=0)
+
+        self.dynamics = dynamics
+        self.real_replay_buffer = real_replay_buffer
+        self.reward_fn = reward_fn
+        self.termination_fn = termination_fn
+        self.rollout_batch_size = rollout_batch_size
+        self.rollout_length = rollout_length
+        self.freq_rollout = freq_rollout
+
+        self.generator = np.random.default_rng(seed)
+
+    def _on_step(self) -> bool:
+        # the agent is trained right after the first step, on data of this callback only
+        if self.n_calls % self.freq_rollout == 0 or self.model.replay_buffer.size() == 0:
+            self.rollout()
+        return True
+
+    def rollout(self):
+        upper_bound = self.real_replay_buffer.buffer_size if self.real_replay_buffer.full else self.real_replay_buffer.pos
+        if upper_bound == 0:
+            return
+
+        batch_inds = self.generator.integers(0, upper_bound, size=self.rollout_batch_size)
+        transition_num = self.dynamics.rollout(
+            self.real_replay_buffer.observations[batch_inds, 0],
+            self.model.policy,
+            self.rollout_length,
+            self.model.replay_buffer,
+            reward_fn=self.reward_fn,
+            termination_fn=self.termination_fn,
+        )
+        self.logger.record("rollout/branch_transitions", transition_num)
+
+
+def feeding_collect_rollouts(
+    self: OffPolicyAlgorithm,
+    env: VecEnv,
+    callback: BaseCallback,
+    train_freq: TrainFreq,
+    replay_buffer: ReplayBuffer,
+    action_noise: Optional[ActionNoise] = None,
+    learning_starts: int = 0,
+    log_interval: Optional[int] = None,
+) -> RolloutReturn:
+    """Replacement of ``OffPolicyAlgorithm.collect_rollouts`` of the agent whose replay buffer is fed by
+    ``BranchRolloutCallback``, which runs the callbacks for every step as SB3 does, but steps no env. Bind it to the
+    agent by ``agent.collect_rollouts = MethodType(feeding_collect_rollouts, agent)``.
+
+    Every step counts as one timestep of the agent, rather than ``env.num_envs`` as in SB3.
+    """
+    self.policy.set_training_mode(False)
+    assert train_freq.frequency > 0, "Should at least collect one step or episode."
+    assert train_freq.unit == TrainFrequencyUnit.STEP, "no episode ends without stepping env"
+
+    num_collected_steps = 0
+    callback.on_rollout_start()
+    while should_collect_more_steps(train_freq, num_collected_steps, 0):
+        self.num_timesteps += 1
+        num_collected_steps += 1
+
+        callback.update_locals(locals())
+        if not callback.on_step():
+            return RolloutReturn(num_collected_steps, 0, continue_training=False)
+
+        self._update_current_progress_remaining(self.num_timesteps, self._total_timesteps)
+        self._on_step()
+    callback.on_rollout_end()
+
+    return RolloutReturn(num_collected_steps, 0, continue_training=True)
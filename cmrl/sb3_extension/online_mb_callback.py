@@ -11,7 +11,7 @@ from stable_baselines3.common.buffers import ReplayBuffer
 from stable_baselines3.common.vec_env import DummyVecEnv
 
 from cmrl.models.fake_env import VecFakeEnv
-from cmrl.models.dynamics import Dynamics
+from cmrl.models.dynamics import Dynamics, AsyncDynamicsLearner
 
 
 class OnlineModelBasedCallback(BaseCallback):
@@ -28,9 +28,26 @@ class OnlineModelBasedCallback(BaseCallback):
         longest_epoch: int = -1,
         improvement_threshold: float = 0.01,
         patience: int = 5,
+        # incremental dynamics learning
+        train_steps_per_round: Optional[int] = None,
+        epochs_per_round: int = 5,
+        recent_ratio: float = 0.5,
+        # asynchronous dynamics learning
+        async_learn: bool = False,
         work_dir: Optional[Union[str, pathlib.Path]] = None,
         device: str = "cpu",
     ):
+        """Callback of online model-based RL, which steps the real env and learns dynamics periodically.
+
+        Args:
+            train_steps_per_round: if given, learn dynamics incrementally, for at most ``epochs_per_round`` epochs of
+                ``train_steps_per_round`` batches in every round, with a ratio of ``recent_ratio`` sampled from data
+                added since the last round, so the cost of a round does not grow with the buffer. Otherwise, learn
+                until early stopping over the whole buffer. Dynamics is always warm-started.
+            async_learn: if True, learn dynamics in a background thread on a snapshot of the replay buffer, while the
+                agent keeps training on the previous dynamics, see ``AsyncDynamicsLearner``. A new round starts only
+                after the last one is swapped in or rejected.
+        """
         super(OnlineModelBasedCallback, self).__init__(verbose=2)
 
         self.env = DummyVecEnv([lambda: env])
@@ -44,6 +61,14 @@ class OnlineModelBasedCallback(BaseCallback):
         self.longest_epoch = longest_epoch
         self.improvement_threshold = improvement_threshold
         self.patience = patience
+        # incremental dynamics learning
+        self.train_steps_per_round = train_steps_per_round
+        self.epochs_per_round = epochs_per_round
+        self.recent_ratio = recent_ratio
+        # asynchronous dynamics learning
+        self.async_learner = AsyncDynamicsLearner(dynamics) if async_learn else None
+        self._learn_start_timesteps = 0
+        self._learn_start_calls = 0
         self.work_dir = work_dir
         self.device = device
 
@@ -54,17 +79,19 @@ class OnlineModelBasedCallback(BaseCallback):
         self._last_obs = None
 
     def _on_step(self) -> bool:
+        if self.async_learner is not None:
+            self.maybe_swap_dynamics()
+
         if self.n_calls % self.freq_train_model == 0:
             # dump some residual log before dynamics learn
             self.model.logger.dump(step=self.num_timesteps)
 
-            self.dynamics.learn(
-                self.real_replay_buffer,
-                longest_epoch=self.longest_epoch,
-                improvement_threshold=self.improvement_threshold,
-                patience=self.patience,
-                work_dir=self.work_dir,
-            )
+            if self.async_learner is None:
+                self.dynamics.learn(self.real_replay_buffer, work_dir=self.work_dir, **self.learn_kwargs)
+            elif not self.async_learner.running:
+                self._learn_start_timesteps = self.now_online_timesteps
+                self._learn_start_calls = self.n_calls
+                self.async_learner.start(self.real_replay_buffer, work_dir=self.work_dir, **self.learn_kwargs)
 
             self.step_and_add(explore=False)
 
@@ -72,6 +99,37 @@ class OnlineModelBasedCallback(BaseCallback):
             return False
         return True
 
+    @property
+    def learn_kwargs(self):
+        kwargs = dict(
+            longest_epoch=self.longest_epoch, improvement_threshold=self.improvement_threshold, patience=self.patience
+        )
+        if self.train_steps_per_round is not None:
+            # bounded budget of every round
+            kwargs.update(
+                train_steps=self.train_steps_per_round, longest_epoch=self.epochs_per_round, recent_ratio=self.recent_ratio
+            )
+        return kwargs
+
+    def maybe_swap_dynamics(self):
+        if not self.async_learner.finished:
+            return
+
+        swapped = self.async_learner.maybe_swap()
+        # mechs kept live, for not improving on the validation data in the round
+        self.logger.record("dynamics/rejected_swaps", len(self.async_learner.rejected))
+        self.logger.record("dynamics/learn_time", self.async_learner.learn_time)
+        if swapped:
+            # env-steps of data collected since the snapshot, i.e. missing in the swapped dynamics
+            self.logger.record("dynamics/staleness_env_steps", self.now_online_timesteps - self._learn_start_timesteps)
+            # agent-steps overlapped with the learning
+            self.logger.record("dynamics/overlapped_agent_steps", self.n_calls - self._learn_start_calls)
+
+    def _on_training_end(self):
+        if self.async_learner is not None:
+            self.async_learner.wait()
+            self.maybe_swap_dynamics()
+
     def _on_training_start(self):
         assert self.env.num_envs == 1
 
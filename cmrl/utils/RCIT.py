@@ -1,39 +1,37 @@
+import random
+from functools import lru_cache
+
 import numpy as np
 from numpy import sqrt
-from numpy.linalg import eigh, eigvalsh
+from numpy.linalg import eigh, eigvalsh, inv, pinv, svd
 from scipy import stats
-from sklearn.gaussian_process import GaussianProcessRegressor
-from sklearn.gaussian_process.kernels import RBF
-from sklearn.gaussian_process.kernels import ConstantKernel as C
-from sklearn.gaussian_process.kernels import WhiteKernel
+from scipy.spatial.distance import pdist
 
 from causallearn.utils.KCI.GaussianKernel import GaussianKernel
 from causallearn.utils.KCI.Kernel import Kernel
 from causallearn.utils.KCI.LinearKernel import LinearKernel
 from causallearn.utils.KCI.PolynomialKernel import PolynomialKernel
-import random
-import math
-import time
-from numpy.linalg import inv
+
 
 ##################### For Random Feature #####################
-try:
-    import rpy2
-    import rpy2.robjects
+@lru_cache(maxsize=None)
+def import_r_package(package='RCIT'):
+    """
+    Import the R package through rpy2 on first use, rather than at import of this module, since neither is required
+    by the tests implemented in python
 
-    rpy2.robjects.r['options'](warn=-1)
-    from rpy2.robjects.packages import importr
+    Returns
+    _________
+    r: the R session of rpy2, with the functions of the package
+    """
+    import rpy2.robjects
     import rpy2.robjects.numpy2ri
+    from rpy2.robjects.packages import importr
 
+    rpy2.robjects.r['options'](warn=-1)
     rpy2.robjects.numpy2ri.activate()
-except:
-    print("Could not import rpy package")
-
-try:
-    importr('RCIT')
-except:
-    print("Could not import r-package RCIT")
-import random
+    importr(package)
+    return rpy2.robjects.r
 
 
 def set_random_seed(seed):
@@ -122,7 +120,7 @@ class KCI_UInd(object):
         return pvalue, test_stat
 
     def compute_pvalue_rf(self, data_x=None, data_y=None):
-        rit = rpy2.robjects.r['RIT'](data_x, data_y, approx="lpd4", seed=42)
+        rit = import_r_package()['RIT'](data_x, data_y, approx="lpd4", seed=42)
         sta = float(rit.rx2('Sta')[0])
         pval = float(rit.rx2('p')[0])
         return pval, sta
@@ -285,7 +283,8 @@ class KCI_CInd(object):
     """
 
     def __init__(self, kernelX='Gaussian', kernelY='Gaussian', kernelZ='Gaussian', nullss=5000, est_width='empirical',
-                 use_gp=False, approx=True, polyd=2, kwidthx=None, kwidthy=None, kwidthz=None):
+                 use_gp=False, approx=True, polyd=2, kwidthx=None, kwidthy=None, kwidthz=None, rank=None,
+                 factorization='nystrom', seed=42, max_eig_products=2000):
         """
         Construct the KCI_CInd model.
         Parameters
@@ -307,6 +306,15 @@ class KCI_CInd(object):
         kwidthx: kernel width for data x (standard deviation sigma, default None)
         kwidthy: kernel width for data y (standard deviation sigma)
         kwidthz: kernel width for data z (standard deviation sigma)
+        rank: rank of the low-rank approximation of kernel matrices (default None, exact dense kernel matrices).
+            With rank r, no nxn matrix is built, and a test costs O(nr^2 + nm^2 + m^3) time and O(nr + m^2) memory,
+            m = min(r^2, max_eig_products), rather than O(n^3) time and O(n^2) memory. Not supported with use_gp.
+        factorization: factorization of the low-rank approximation
+            'nystrom': Nystrom approximation on r random landmarks
+            'icholesky': pivoted incomplete Cholesky decomposition
+        seed: seed of the landmarks of Nystrom approximation
+        max_eig_products: most products of the eigenvectors of Kx and Ky kept for the null distribution, those of the
+            largest eigenvalues, if there are more of them than both this and the sample size (default 2000)
         """
         self.kernelX = kernelX
         self.kernelY = kernelY
@@ -322,15 +330,20 @@ class KCI_CInd(object):
         self.use_gp = use_gp
         self.thresh = 1e-5
         self.approx = approx
+        self.rank = rank
+        self.factorization = factorization
+        self.seed = seed
+        self.max_eig_products = max_eig_products
+        assert rank is None or not use_gp, 'low-rank approximation is not supported with use_gp'
 
     def compute_pvalue_rf(self, data_x=None, data_y=None, data_z=None):
-        rit = rpy2.robjects.r['RCIT'](data_x, data_y, data_z, num_f=10000, num_f2=200, approx="lpd4", seed=42)
+        rit = import_r_package()['RCIT'](data_x, data_y, data_z, num_f=10000, num_f2=200, approx="lpd4", seed=42)
         sta = float(rit.rx2('Sta')[0])
         pval = float(rit.rx2('p')[0])
         print(pval)
         return pval, sta
 
-    def compute_pvalue(self, data_x=None, data_y=None, data_z=None):
+    def compute_pvalue(self, data_x=None, data_y=None, data_z=None, cache=None, cache_key=None):
         """
         Main function: compute the p value and return it together with the test statistic
         Parameters
@@ -338,23 +351,231 @@ class KCI_CInd(object):
         data_x: input data for x (nxd1 array)
         data_y: input data for y (nxd2 array)
         data_z: input data for z (nxd3 array)
+        cache: mapping-like cache (with `get` and `put`) of the kernel matrices (or their low-rank factors) depending
+            on y and z only, to share them among tests of different x (default None, not cached). Not used with use_gp.
+        cache_key: key of data y and z in cache
 
         Returns
         _________
         pvalue: p value
         test_stat: test statistic
         """
-        Kx, Ky, Kzx, Kzy = self.kernel_matrix(data_x, data_y, data_z)
-        test_stat, KxR, KyR = self.KCI_V_statistic(Kx, Ky, Kzx, Kzy)
-        uu_prod, size_u = self.get_uuprod(KxR, KyR)
+        if (cache is None and self.rank is None) or self.use_gp:
+            Kx, Ky, Kzx, Kzy = self.kernel_matrix(data_x, data_y, data_z)
+            test_stat, KxR, KyR = self.KCI_V_statistic(Kx, Ky, Kzx, Kzy)
+            uu_prod, size_u = self.get_uuprod(KxR, KyR)
+        else:
+            yz_kernels = None if cache is None else cache.get(cache_key)
+            if yz_kernels is None:
+                if self.rank is None:
+                    yz_kernels = self.yz_kernel_matrix(data_y, data_z)
+                else:
+                    yz_kernels = self.yz_kernel_factor(data_y, data_z)
+                if cache is not None:
+                    cache.put(cache_key, yz_kernels)
+
+            if self.rank is None:
+                Kx = self.x_kernel_matrix(data_x, yz_kernels["data_z"])
+                KxR = yz_kernels["Rzx"].dot(Kx.dot(yz_kernels["Rzx"]))
+                test_stat = np.sum(KxR * yz_kernels["KyR"])
+                uu_prod, size_u = self.get_uuprod(KxR, yz_kernels["KyR"], vy=yz_kernels["vy"])
+            else:
+                # KxR = Gx.dot(Gx.T) and KyR = Gy.dot(Gy.T)
+                Gx = self.x_kernel_factor(data_x, yz_kernels["data_z"])
+                Gx = Gx - yz_kernels["Pzx"].dot(yz_kernels["Gz"].T.dot(Gx))
+                # sum(KxR * KyR) = trace(KxR.dot(KyR))
+                test_stat = np.sum(Gx.T.dot(yz_kernels["Gy"]) ** 2)
+                uu_prod, size_u = self.uu_product(self.eigen_factor(Gx, factor=True), yz_kernels["vy"])
         if self.approx:
             k_appr, theta_appr = self.get_kappa(uu_prod)
             pvalue = 1 - stats.gamma.cdf(test_stat, k_appr, 0, theta_appr)
         else:
-            null_samples = self.null_sample_spectral(uu_prod, size_u, Kx.shape[0])
+            null_samples = self.null_sample_spectral(uu_prod, size_u, data_x.shape[0])
             pvalue = sum(null_samples > test_stat) / float(self.nullss)
         return pvalue, test_stat
 
+    @staticmethod
+    def normalize(data):
+        data = stats.zscore(data, ddof=1, axis=0)
+        data[np.isnan(data)] = 0.
+        # We set 'ddof=1' to conform to the normalization way in the original Matlab implementation in
+        # http://people.tuebingen.mpg.de/kzhang/KCI-test.zip
+        return data
+
+    def make_kernel(self, kernel, kwidth, data, data_z, name):
+        """
+        Construct the kernel function for data
+        Parameters
+        ----------
+        kernel: kernel function, in 'Gaussian', 'Polynomial' and 'Linear'
+        kwidth: kernel width set by users, for Gaussian kernel with est_width 'manual'
+        data: normalized input data for the kernel (nxd array)
+        data_z: normalized input data for z (nxd3 array), which determines the empirical width of Gaussian kernel
+        name: name of the variable, in 'x', 'y' and 'z'
+
+        Returns
+        _________
+        kernel: kernel function
+        """
+        if kernel == 'Gaussian':
+            if self.est_width == 'manual':
+                if kwidth is not None:
+                    return GaussianKernel(kwidth)
+                else:
+                    raise Exception('specify kwidth{}'.format(name))
+            gaussian_kernel = GaussianKernel()
+            if self.est_width == 'median':
+                gaussian_kernel.set_width_median(data)
+            elif self.est_width == 'empirical':
+                # the empirical width is determined by data_z's shape, please refer to the original code
+                # (http://people.tuebingen.mpg.de/kzhang/KCI-test.zip) in the file
+                # 'algorithms/CInd_test_new_withGP.m', Line 37 to 52.
+                gaussian_kernel.set_width_empirical_kci(data_z)
+            else:
+                raise Exception('Undefined kernel width estimation method')
+            return gaussian_kernel
+        elif kernel == 'Polynomial':
+            return PolynomialKernel(self.polyd)
+        elif kernel == 'Linear':
+            return LinearKernel()
+        else:
+            raise Exception('Undefined kernel function')
+
+    def x_kernel_matrix(self, data_x, data_z):
+        """
+        Compute centered kernel matrix for data x, the same as Kx of kernel_matrix
+        Parameters
+        ----------
+        data_x: input data for x (nxd1 array)
+        data_z: normalized input data for z (nxd3 array)
+
+        Returns
+        _________
+        Kx: kernel matrix for data_x (nxn)
+        """
+        data_x = np.concatenate((self.normalize(data_x), 0.5 * data_z), axis=1)
+        kernelX = self.make_kernel(self.kernelX, self.kwidthx, data_x, data_z, 'x')
+        return Kernel.center_kernel_matrix(kernelX.kernel(data_x))
+
+    def yz_kernel_matrix(self, data_y, data_z):
+        """
+        Compute the kernel matrices depending on data y and z only, which are the same for tests of different x.
+        Kernel of z is centered with the same width as kernel_matrix, since use_gp is not supported.
+        Parameters
+        ----------
+        data_y: input data for y (nxd2 array)
+        data_z: input data for z (nxd3 array)
+
+        Returns
+        _________
+        dict of
+            data_z: normalized input data for z (nxd3 array)
+            Rzx: regression centering matrix for data_x (nxn)
+            KyR: centralized kernel matrix for data_y (nxn)
+            vy: eigenvectors of KyR, scaled by square roots of the eigenvalues (see get_uuprod)
+        """
+        assert not self.use_gp, 'kernel of z learned by gaussian process depends on data x'
+        data_y = self.normalize(data_y)
+        data_z = self.normalize(data_z)
+        kernelY = self.make_kernel(self.kernelY, self.kwidthy, data_y, data_z, 'y')
+        kernelZ = self.make_kernel(self.kernelZ, self.kwidthz, data_z, data_z, 'z')
+        Ky = Kernel.center_kernel_matrix(kernelY.kernel(data_y))
+        Kz = Kernel.center_kernel_matrix(kernelZ.kernel(data_z))
+
+        KyR, Rzy = Kernel.center_kernel_matrix_regression(Ky, Kz, self.epsilon_y)
+        if self.epsilon_x != self.epsilon_y:
+            _, Rzx = Kernel.center_kernel_matrix_regression(Ky, Kz, self.epsilon_x)
+        else:
+            Rzx = Rzy
+        return dict(data_z=data_z, Rzx=Rzx, KyR=KyR, vy=self.eigen_factor(KyR))
+
+    def kernel_factor(self, kernel, data):
+        """
+        Compute the centered low-rank factor G of kernel matrix, K ~= G.dot(G.T), without building K
+        Parameters
+        ----------
+        kernel: kernel function
+        data: normalized input data for the kernel (nxd array)
+
+        Returns
+        _________
+        G: centered factor (nxr), i.e. HKH ~= G.dot(G.T)
+        """
+        n = data.shape[0]
+        rank = min(self.rank, n)
+        if self.factorization == 'nystrom':
+            landmarks = np.random.default_rng(self.seed).choice(n, rank, replace=False)
+            Knm = kernel.kernel(data, data[landmarks])
+            w, v = eigh(Knm[landmarks])
+            v = v[:, w > np.max(w) * 1e-10]
+            w = w[w > np.max(w) * 1e-10]
+            G = Knm.dot(v / np.sqrt(w))
+        elif self.factorization == 'icholesky':
+            G = np.zeros((n, rank))
+            # diagonal of the residual kernel matrix, in chunks of samples
+            d = np.concatenate([np.diag(kernel.kernel(data[i:i + 1000])) for i in range(0, n, 1000)])
+            for j in range(rank):
+                pivot = np.argmax(d)
+                if d[pivot] <= 1e-10 * n:
+                    G = G[:, :j]
+                    break
+                G[:, j] = (kernel.kernel(data, data[pivot:pivot + 1])[:, 0] - G[:, :j].dot(G[pivot, :j])) / sqrt(
+                    d[pivot])
+                d = np.maximum(d - G[:, j] ** 2, 0)
+        else:
+            raise Exception('Undefined factorization')
+        # centering, HKH ~= (HG).dot((HG).T)
+        return G - G.mean(axis=0)
+
+    def x_kernel_factor(self, data_x, data_z):
+        """
+        Compute the centered low-rank factor of kernel matrix for data x, see x_kernel_matrix
+        Parameters
+        ----------
+        data_x: input data for x (nxd1 array)
+        data_z: normalized input data for z (nxd3 array)
+
+        Returns
+        _________
+        Gx: centered factor of kernel matrix for data_x (nxr)
+        """
+        data_x = np.concatenate((self.normalize(data_x), 0.5 * data_z), axis=1)
+        return self.kernel_factor(self.make_kernel(self.kernelX, self.kwidthx, data_x, data_z, 'x'), data_x)
+
+    def yz_kernel_factor(self, data_y, data_z):
+        """
+        Compute the low-rank factors depending on data y and z only, see yz_kernel_matrix.
+        With Kz ~= Gz.dot(Gz.T), the regression centering matrix by Woodbury identity is
+        Rz = epsilon * (Kz + epsilon * I)^-1 = I - Gz.dot((Gz.T.dot(Gz) + epsilon * I)^-1).dot(Gz.T)
+        Parameters
+        ----------
+        data_y: input data for y (nxd2 array)
+        data_z: input data for z (nxd3 array)
+
+        Returns
+        _________
+        dict of
+            data_z: normalized input data for z (nxd3 array)
+            Gz: centered factor of kernel matrix for data_z (nxr)
+            Pzx: Gz.dot((Gz.T.dot(Gz) + epsilon_x * I)^-1), i.e. Rzx = I - Pzx.dot(Gz.T) (nxr)
+            Gy: factor of centralized kernel matrix for data_y, i.e. KyR ~= Gy.dot(Gy.T) (nxr)
+            vy: eigenvectors of KyR, scaled by square roots of the eigenvalues (see get_uuprod)
+        """
+        assert not self.use_gp, 'kernel of z learned by gaussian process depends on data x'
+        data_y = self.normalize(data_y)
+        data_z = self.normalize(data_z)
+        Gy = self.kernel_factor(self.make_kernel(self.kernelY, self.kwidthy, data_y, data_z, 'y'), data_y)
+        Gz = self.kernel_factor(self.make_kernel(self.kernelZ, self.kwidthz, data_z, data_z, 'z'), data_z)
+
+        GzTGz = Gz.T.dot(Gz)
+        Pzy = Gz.dot(inv(GzTGz + self.epsilon_y * np.eye(Gz.shape[1])))
+        if self.epsilon_x != self.epsilon_y:
+            Pzx = Gz.dot(inv(GzTGz + self.epsilon_x * np.eye(Gz.shape[1])))
+        else:
+            Pzx = Pzy
+        Gy = Gy - Pzy.dot(Gz.T.dot(Gy))
+        return dict(data_z=data_z, Gz=Gz, Pzx=Pzx, Gy=Gy, vy=self.eigen_factor(Gy, factor=True))
+
     def kernel_matrix(self, data_x, data_y, data_z):
         """
         Compute kernel matrix for data x, data y, and data_z
@@ -372,66 +593,14 @@ class KCI_CInd(object):
         kzy: centering kernel matrix for data_y (nxn)
         """
         # normalize the data
-        data_x = stats.zscore(data_x, ddof=1, axis=0)
-        data_x[np.isnan(data_x)] = 0.
-
-        data_y = stats.zscore(data_y, ddof=1, axis=0)
-        data_y[np.isnan(data_y)] = 0.
-
-        data_z = stats.zscore(data_z, ddof=1, axis=0)
-        data_z[np.isnan(data_z)] = 0.
-        # We set 'ddof=1' to conform to the normalization way in the original Matlab implementation in
-        # http://people.tuebingen.mpg.de/kzhang/KCI-test.zip
+        data_x = self.normalize(data_x)
+        data_y = self.normalize(data_y)
+        data_z = self.normalize(data_z)
 
         # concatenate x and z
         data_x = np.concatenate((data_x, 0.5 * data_z), axis=1)
-        if self.kernelX == 'Gaussian':
-            if self.est_width == 'manual':
-                if self.kwidthx is not None:
-                    kernelX = GaussianKernel(self.kwidthx)
-                else:
-                    raise Exception('specify kwidthx')
-            else:
-                kernelX = GaussianKernel()
-                if self.est_width == 'median':
-                    kernelX.set_width_median(data_x)
-                elif self.est_width == 'empirical':
-                    # kernelX's empirical width is determined by data_z's shape, please refer to the original code
-                    # (http://people.tuebingen.mpg.de/kzhang/KCI-test.zip) in the file
-                    # 'algorithms/CInd_test_new_withGP.m', Line 37 to 52.
-                    kernelX.set_width_empirical_kci(data_z)
-                else:
-                    raise Exception('Undefined kernel width estimation method')
-        elif self.kernelX == 'Polynomial':
-            kernelX = PolynomialKernel(self.polyd)
-        elif self.kernelX == 'Linear':
-            kernelX = LinearKernel()
-        else:
-            raise Exception('Undefined kernel function')
-
-        if self.kernelY == 'Gaussian':
-            if self.est_width == 'manual':
-                if self.kwidthy is not None:
-                    kernelY = GaussianKernel(self.kwidthy)
-                else:
-                    raise Exception('specify kwidthy')
-            else:
-                kernelY = GaussianKernel()
-                if self.est_width == 'median':
-                    kernelY.set_width_median(data_y)
-                elif self.est_width == 'empirical':
-                    # kernelY's empirical width is determined by data_z's shape, please refer to the original code
-                    # (http://people.tuebingen.mpg.de/kzhang/KCI-test.zip) in the file
-                    # 'algorithms/CInd_test_new_withGP.m', Line 37 to 52.
-                    kernelY.set_width_empirical_kci(data_z)
-                else:
-                    raise Exception('Undefined kernel width estimation method')
-        elif self.kernelY == 'Polynomial':
-            kernelY = PolynomialKernel(self.polyd)
-        elif self.kernelY == 'Linear':
-            kernelY = LinearKernel()
-        else:
-            raise Exception('Undefined kernel function')
+        kernelX = self.make_kernel(self.kernelX, self.kwidthx, data_x, data_z, 'x')
+        kernelY = self.make_kernel(self.kernelY, self.kwidthy, data_y, data_z, 'y')
 
         Kx = kernelX.kernel(data_x)
         Ky = kernelY.kernel(data_y)
@@ -440,82 +609,62 @@ class KCI_CInd(object):
         Kx = Kernel.center_kernel_matrix(Kx)
         Ky = Kernel.center_kernel_matrix(Ky)
 
-        if self.kernelZ == 'Gaussian':
-            if not self.use_gp:
-                if self.est_width == 'manual':
-                    if self.kwidthz is not None:
-                        kernelZ = GaussianKernel(self.kwidthz)
-                    else:
-                        raise Exception('specify kwidthz')
-                else:
-                    kernelZ = GaussianKernel()
-                    if self.est_width == 'median':
-                        kernelZ.set_width_median(data_z)
-                    elif self.est_width == 'empirical':
-                        kernelZ.set_width_empirical_kci(data_z)
-                Kzx = kernelZ.kernel(data_z)
-                Kzx = Kernel.center_kernel_matrix(Kzx)
-                # centering kernel matrix to conform with the original Matlab implementation,
-                # specifically, Line 100 in the file 'algorithms/CInd_test_new_withGP.m'
-                Kzy = Kzx
-            else:
-                # learning the kernel width of Kz using Gaussian process
-                n, Dz = data_z.shape
-                if self.kernelX == 'Gaussian':
-                    widthz = sqrt(1.0 / (kernelX.width * data_x.shape[1]))
-                else:
-                    widthz = 1.0
-                # Instantiate a Gaussian Process model for x
-                wx, vx = eigh(0.5 * (Kx + Kx.T))
-                topkx = int(np.min((400, np.floor(n / 4))))
-                idx = np.argsort(-wx)
-                wx = wx[idx]
-                vx = vx[:, idx]
-                wx = wx[0:topkx]
-                vx = vx[:, 0:topkx]
-                vx = vx[:, wx > wx.max() * self.thresh]
-                wx = wx[wx > wx.max() * self.thresh]
-                vx = 2 * sqrt(n) * vx.dot(np.diag(np.sqrt(wx))) / sqrt(wx[0])
-                kernelx = C(1.0, (1e-3, 1e3)) * RBF(widthz * np.ones(Dz), (1e-2, 1e2)) + WhiteKernel(0.1, (1e-10, 1e+1))
-                gpx = GaussianProcessRegressor(kernel=kernelx)
-                # fit Gaussian process, including hyperparameter optimization
-                gpx.fit(data_z, vx)
-
-                # construct Gaussian kernels according to learned hyperparameters
-                Kzx = gpx.kernel_.k1(data_z, data_z)
-                self.epsilon_x = np.exp(gpx.kernel_.theta[-1])
-
-                # Instantiate a Gaussian Process model for y
-                wy, vy = eigh(0.5 * (Ky + Ky.T))
-                topky = int(np.min((400, np.floor(n / 4))))
-                idy = np.argsort(-wy)
-                wy = wy[idy]
-                vy = vy[:, idy]
-                wy = wy[0:topky]
-                vy = vy[:, 0:topky]
-                vy = vy[:, wy > wy.max() * self.thresh]
-                wy = wy[wy > wy.max() * self.thresh]
-                vy = 2 * sqrt(n) * vy.dot(np.diag(np.sqrt(wy))) / sqrt(wy[0])
-                kernely = C(1.0, (1e-3, 1e3)) * RBF(widthz * np.ones(Dz), (1e-2, 1e2)) + WhiteKernel(0.1, (1e-10, 1e+1))
-                gpy = GaussianProcessRegressor(kernel=kernely)
-                # fit Gaussian process, including hyperparameter optimization
-                gpy.fit(data_z, vy)
-
-                # construct Gaussian kernels according to learned hyperparameters
-                Kzy = gpy.kernel_.k1(data_z, data_z)
-                self.epsilon_y = np.exp(gpy.kernel_.theta[-1])
-        elif self.kernelZ == 'Polynomial':
-            kernelZ = PolynomialKernel(self.polyd)
-            Kzx = kernelZ.kernel(data_z)
-            Kzx = Kernel.center_kernel_matrix(Kzx)
-            Kzy = Kzx
-        elif self.kernelZ == 'Linear':
-            kernelZ = LinearKernel()
+        if self.kernelZ != 'Gaussian' or not self.use_gp:
+            kernelZ = self.make_kernel(self.kernelZ, self.kwidthz, data_z, data_z, 'z')
             Kzx = kernelZ.kernel(data_z)
             Kzx = Kernel.center_kernel_matrix(Kzx)
+            # centering kernel matrix to conform with the original Matlab implementation,
+            # specifically, Line 100 in the file 'algorithms/CInd_test_new_withGP.m'
             Kzy = Kzx
         else:
-            raise Exception('Undefined kernel function')
+            # learning the kernel width of Kz using Gaussian process
+            from sklearn.gaussian_process import GaussianProcessRegressor
+            from sklearn.gaussian_process.kernels import RBF, WhiteKernel, ConstantKernel as C
+
+            n, Dz = data_z.shape
+            if self.kernelX == 'Gaussian':
+                widthz = sqrt(1.0 / (kernelX.width * data_x.shape[1]))
+            else:
+                widthz = 1.0
+            # Instantiate a Gaussian Process model for x
+            wx, vx = eigh(0.5 * (Kx + Kx.T))
+            topkx = int(np.min((400, np.floor(n / 4))))
+            idx = np.argsort(-wx)
+            wx = wx[idx]
+            vx = vx[:, idx]
+            wx = wx[0:topkx]
+            vx = vx[:, 0:topkx]
+            vx = vx[:, wx > wx.max() * self.thresh]
+            wx = wx[wx > wx.max() * self.thresh]
+            vx = 2 * sqrt(n) * vx.dot(np.diag(np.sqrt(wx))) / sqrt(wx[0])
+            kernelx = C(1.0, (1e-3, 1e3)) * RBF(widthz * np.ones(Dz), (1e-2, 1e2)) + WhiteKernel(0.1, (1e-10, 1e+1))
+            gpx = GaussianProcessRegressor(kernel=kernelx)
+            # fit Gaussian process, including hyperparameter optimization
+            gpx.fit(data_z, vx)
+
+            # construct Gaussian kernels according to learned hyperparameters
+            Kzx = gpx.kernel_.k1(data_z, data_z)
+            self.epsilon_x = np.exp(gpx.kernel_.theta[-1])
+
+            # Instantiate a Gaussian Process model for y
+            wy, vy = eigh(0.5 * (Ky + Ky.T))
+            topky = int(np.min((400, np.floor(n / 4))))
+            idy = np.argsort(-wy)
+            wy = wy[idy]
+            vy = vy[:, idy]
+            wy = wy[0:topky]
+            vy = vy[:, 0:topky]
+            vy = vy[:, wy > wy.max() * self.thresh]
+            wy = wy[wy > wy.max() * self.thresh]
+            vy = 2 * sqrt(n) * vy.dot(np.diag(np.sqrt(wy))) / sqrt(wy[0])
+            kernely = C(1.0, (1e-3, 1e3)) * RBF(widthz * np.ones(Dz), (1e-2, 1e2)) + WhiteKernel(0.1, (1e-10, 1e+1))
+            gpy = GaussianProcessRegressor(kernel=kernely)
+            # fit Gaussian process, including hyperparameter optimization
+            gpy.fit(data_z, vy)
+
+            # construct Gaussian kernels according to learned hyperparameters
+            Kzy = gpy.kernel_.k1(data_z, data_z)
+            self.epsilon_y = np.exp(gpy.kernel_.theta[-1])
         return Kx, Ky, Kzx, Kzy
 
     def KCI_V_statistic(self, Kx, Ky, Kzx, Kzy):
@@ -542,7 +691,7 @@ class KCI_CInd(object):
             - * If (self.kernelZ == 'Gaussian' and self.use_gp), then Kzx has all the same diagonal elements (not necessarily 1).
               * The same applies to Kzy.
         2. If not (self.kernelZ == 'Gaussian' and self.use_gp): assert (Kzx == Kzy).all()
-           With this we could save one repeated calculation of pinv(Kzy+\epsilonI), which consumes most time.
+           With this we could save one repeated calculation of pinv(Kzy+\\epsilonI), which consumes most time.
         """
         KxR, Rzx = Kernel.center_kernel_matrix_regression(Kx, Kzx, self.epsilon_x)
         if self.epsilon_x != self.epsilon_y or (self.kernelZ == 'Gaussian' and self.use_gp):
@@ -553,7 +702,32 @@ class KCI_CInd(object):
         Vstat = np.sum(KxR * KyR)
         return Vstat, KxR, KyR
 
-    def get_uuprod(self, Kx, Ky):
+    def eigen_factor(self, K, factor=False):
+        """
+        Eigenvectors of the significant eigenvalues of K, scaled by square roots of the eigenvalues
+
+        Parameters
+        ----------
+        K: centralized kernel matrix (nxn), or its factor G (nxr) with K = G.dot(G.T) if factor
+        factor: whether K is given by its factor, whose thin SVD gives the eigenvectors without building K
+
+        Returns
+        _________
+        v: scaled eigenvectors (nxk), in descending order of eigenvalues
+        """
+        if factor:
+            v, s, _ = svd(K, full_matrices=False)
+            w = s ** 2
+        else:
+            w, v = eigh(0.5 * (K + K.T))
+            idx = np.argsort(-w)
+            w = w[idx]
+            v = v[:, idx]
+        v = v[:, w > np.max(w) * self.thresh]
+        w = w[w > np.max(w) * self.thresh]
+        return v.dot(np.diag(np.sqrt(w)))
+
+    def get_uuprod(self, Kx, Ky, vy=None):
         """
         Compute eigenvalues for null distribution estimation
 
@@ -561,6 +735,7 @@ class KCI_CInd(object):
         ----------
         Kx: centralized kernel matrix for data_x (nxn)
         Ky: centralized kernel matrix for data_y (nxn)
+        vy: scaled eigenvectors of Ky if already known (default None)
 
         Returns
         _________
@@ -568,35 +743,47 @@ class KCI_CInd(object):
         size_u: number of producted eigenvectors
 
         """
-        wx, vx = eigh(0.5 * (Kx + Kx.T))
-        wy, vy = eigh(0.5 * (Ky + Ky.T))
-        idx = np.argsort(-wx)
-        idy = np.argsort(-wy)
-        wx = wx[idx]
-        vx = vx[:, idx]
-        wy = wy[idy]
-        vy = vy[:, idy]
-        vx = vx[:, wx > np.max(wx) * self.thresh]
-        wx = wx[wx > np.max(wx) * self.thresh]
-        vy = vy[:, wy > np.max(wy) * self.thresh]
-        wy = wy[wy > np.max(wy) * self.thresh]
-        vx = vx.dot(np.diag(np.sqrt(wx)))
-        vy = vy.dot(np.diag(np.sqrt(wy)))
-
-        # calculate their product
-        T = Kx.shape[0]
+        vx = self.eigen_factor(Kx)
+        vy = self.eigen_factor(Ky) if vy is None else vy
+        return self.uu_product(vx, vy)
+
+    def uu_product(self, vx, vy):
+        """
+        Compute the product of the eigenvectors of Kx and Ky, see get_uuprod
+
+        Parameters
+        ----------
+        vx: scaled eigenvectors of Kx (nxkx)
+        vy: scaled eigenvectors of Ky (nxky)
+
+        Returns
+        _________
+        uu_prod: product of the eigenvectors of Kx and Ky
+        size_u: number of producted eigenvectors
+
+        """
+        T = vx.shape[0]
         num_eigx = vx.shape[1]
         num_eigy = vy.shape[1]
         size_u = num_eigx * num_eigy
-        uu = np.zeros((T, size_u))
-        for i in range(0, num_eigx):
-            for j in range(0, num_eigy):
-                uu[:, i * num_eigy + j] = vx[:, i] * vy[:, j]
-
-        if size_u > T:
-            uu_prod = uu.dot(uu.T)
+        # uu[:, i * num_eigy + j] = vx[:, i] * vy[:, j]
+        if size_u > T and T <= self.max_eig_products:
+            # uu.dot(uu.T) is the element-wise product of vx.dot(vx.T) and vy.dot(vy.T)
+            uu_prod = vx.dot(vx.T) * vy.dot(vy.T)
         else:
-            uu_prod = uu.T.dot(uu)
+            idx = np.arange(size_u)
+            if size_u > self.max_eig_products:
+                # keep the products of the largest eigenvalues, never building a (T x T) or (size_u x size_u) matrix
+                eig_prod = np.outer(np.sum(vx ** 2, axis=0), np.sum(vy ** 2, axis=0)).ravel()
+                idx = np.argsort(-eig_prod)[:self.max_eig_products]
+                size_u = len(idx)
+            idx_x, idx_y = idx // num_eigy, idx % num_eigy
+            # accumulate uu.T.dot(uu) over chunks of samples, never building the whole uu (T x size_u)
+            uu_prod = np.zeros((size_u, size_u))
+            chunk = max(1, 2 ** 22 // size_u)
+            for i in range(0, T, chunk):
+                uu = vx[i:i + chunk, idx_x] * vy[i:i + chunk, idx_y]
+                uu_prod += uu.T.dot(uu)
 
         return uu_prod, size_u
 
@@ -641,3 +828,136 @@ class KCI_CInd(object):
         k_appr = mean_appr ** 2 / var_appr
         theta_appr = var_appr / mean_appr
         return k_appr, theta_appr
+
+
+class RCIT_CInd(object):
+    """
+    Python implementation of Randomized Conditional Independence Test (RCIT) and Randomized conditional Correlation
+    Test (RCoT), which approximate KCI with random Fourier features, in linear time of the sample size.
+    The original R implementation can be found in https://github.com/ericstrobl/RCIT
+
+    References
+    ----------
+    [1] E. V. Strobl, K. Zhang, and S. Visweswaran, "Approximate kernel-based conditional independence tests for fast
+    non-parametric causal discovery," Journal of Causal Inference, 2019.
+    """
+
+    def __init__(self, num_f=100, num_f2=5, rcot=True, approx=True, nullss=5000, seed=42):
+        """
+        Construct the RCIT_CInd model.
+        Parameters
+        ----------
+        num_f: number of random Fourier features for data z (conditional variable)
+        num_f2: number of random Fourier features for data x and data y
+        rcot: whether to use RCoT, otherwise use RCIT, in which features of y are computed on data y and z together
+        approx: whether to use gamma approximation (default=True), otherwise simulate the null distribution
+        nullss: sample size in simulating the null distribution
+        seed: seed of random Fourier features, the same for tests of different data
+        """
+        self.num_f = num_f
+        self.num_f2 = num_f2
+        self.rcot = rcot
+        self.approx = approx
+        self.nullss = nullss
+        self.seed = seed
+
+    def compute_pvalue(self, data_x=None, data_y=None, data_z=None, cache=None, cache_key=None):
+        """
+        Main function: compute the p value and return it together with the test statistic
+        Parameters
+        ----------
+        data_x: input data for x (nxd1 array)
+        data_y: input data for y (nxd2 array)
+        data_z: input data for z (nxd3 array)
+        cache: mapping-like cache (with `get` and `put`) of the features depending on y and z only, to share them
+            among tests of different x (default None, not cached)
+        cache_key: key of data y and z in cache
+
+        Returns
+        _________
+        pvalue: p value
+        test_stat: test statistic
+        """
+        yz_features = None if cache is None else cache.get(cache_key)
+        if yz_features is None:
+            yz_features = self.yz_features(data_y, data_z)
+            if cache is not None:
+                cache.put(cache_key, yz_features)
+        f_z, i_Czz, f_y, res_y, Czy = (yz_features[k] for k in ["f_z", "i_Czz", "f_y", "res_y", "Czy"])
+
+        n = data_x.shape[0]
+        f_x = self.random_fourier_features(KCI_CInd.normalize(data_x), self.num_f2, 1)
+        Cxz = f_x.T.dot(f_z) / (n - 1)
+        # residuals of regressing features of x on features of z
+        res_x = f_x - f_z.dot(i_Czz.dot(Cxz.T))
+        Cxy_z = f_x.T.dot(f_y) / (n - 1) - Cxz.dot(i_Czz).dot(Czy)
+        test_stat = n * np.sum(Cxy_z ** 2)
+
+        # covariance of the products of residuals, i.e. the asymptotic covariance of n^0.5 * Cxy_z
+        res = (res_x[:, :, None] * res_y[:, None, :]).reshape(n, -1)
+        eig_d = eigvalsh(res.T.dot(res) / n)
+        eig_d = eig_d[eig_d > 0]
+
+        if self.approx:
+            mean_appr = np.sum(eig_d)
+            var_appr = 2 * np.sum(eig_d ** 2)
+            pvalue = 1 - stats.gamma.cdf(test_stat, mean_appr ** 2 / var_appr, 0, var_appr / mean_appr)
+        else:
+            f_rand = np.random.chisquare(1, (eig_d.shape[0], self.nullss))
+            pvalue = np.mean(eig_d.dot(f_rand) > test_stat)
+        return pvalue, test_stat
+
+    def yz_features(self, data_y, data_z):
+        """
+        Compute the features depending on data y and z only, which are the same for tests of different x.
+        Parameters
+        ----------
+        data_y: input data for y (nxd2 array)
+        data_z: input data for z (nxd3 array)
+
+        Returns
+        _________
+        dict of
+            f_z: features of data z (nxnum_f)
+            i_Czz: inverse of the covariance of f_z (num_fxnum_f)
+            f_y: features of data y (nxnum_f2)
+            res_y: residuals of regressing f_y on f_z (nxnum_f2)
+            Czy: covariance of f_z and f_y (num_fxnum_f2)
+        """
+        n = data_y.shape[0]
+        data_y = KCI_CInd.normalize(data_y)
+        data_z = KCI_CInd.normalize(data_z)
+        if not self.rcot:
+            data_y = np.concatenate((data_y, data_z), axis=1)
+
+        f_z = self.random_fourier_features(data_z, self.num_f, 0)
+        f_y = self.random_fourier_features(data_y, self.num_f2, 2)
+
+        Czz = f_z.T.dot(f_z) / (n - 1)
+        i_Czz = pinv(Czz + np.eye(self.num_f) * 1e-10)
+        Czy = f_z.T.dot(f_y) / (n - 1)
+        res_y = f_y - f_z.dot(i_Czz.dot(Czy))
+        return dict(f_z=f_z, i_Czz=i_Czz, f_y=f_y, res_y=res_y, Czy=Czy)
+
+    def random_fourier_features(self, data, num_f, stream):
+        """
+        Compute normalized random Fourier features of the Gaussian kernel, with width set by the median trick
+        Parameters
+        ----------
+        data: normalized input data (nxd array)
+        num_f: number of features
+        stream: index of the random stream, different for data x, y and z
+
+        Returns
+        _________
+        feat: normalized features (nxnum_f)
+        """
+        # median of pairwise distances of at most 500 samples, as the original R implementation
+        sigma = np.median(pdist(data[:500]))
+        sigma = sigma if sigma > 0 else 1.
+
+        rng = np.random.default_rng([self.seed, stream] if self.seed is not None else None)
+        W = rng.standard_normal((data.shape[1], num_f)) / sigma
+        b = rng.uniform(0, 2 * np.pi, num_f)
+        feat = sqrt(2) * np.cos(data.dot(W) + b)
+        return KCI_CInd.normalize(feat)
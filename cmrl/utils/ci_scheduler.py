@@ -0,0 +1,170 @@
+import os
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from multiprocessing import get_context
+from typing import Any, Callable, Dict, Hashable, Iterator, List, Optional, Tuple, Union
+
+import numpy as np
+
+from cmrl.utils.ci_test import get_ci_test
+
+# data shared by all tests of a worker, set once in `_init_worker` rather than pickled with every test
+_worker_state: Dict = {}
+
+
+class KernelCache:
+    """LRU cache of kernel matrices, with entries evicted once they take more than ``budget`` MiB.
+
+    The latest entry is always kept even if it alone exceeds the budget, so it is shared at least by the tests
+    following it.
+    """
+
+    def __init__(self, budget: float = 256):
+        self.budget = budget
+        self._entries: OrderedDict = OrderedDict()
+        self._nbytes: Dict[Hashable, int] = {}
+
+    @property
+    def nbytes(self) -> int:
+        return sum(self._nbytes.values())
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: Hashable) -> Optional[Dict[str, Any]]:
+        if key not in self._entries:
+            return None
+        self._entries.move_to_end(key)
+        return self._entries[key]
+
+    def put(self, key: Hashable, entry: Dict[str, Any]):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        self._nbytes[key] = sum(value.nbytes for value in entry.values() if isinstance(value, np.ndarray))
+
+        while len(self._entries) > 1 and self.nbytes > self.budget * 2**20:
+            oldest_key, _ = self._entries.popitem(last=False)
+            del self._nbytes[oldest_key]
+
+    def clear(self):
+        self._entries.clear()
+        self._nbytes.clear()
+
+
+def _init_worker(
+    inputs: List[np.ndarray],
+    outputs: List[np.ndarray],
+    ci_test: Callable,
+    blas_threads: Optional[int],
+    cache_budget: float,
+):
+    if blas_threads is not None:
+        # pin BLAS threads of every worker, otherwise `workers * cores` threads compete for the cores
+        from threadpoolctl import threadpool_limits
+
+        _worker_state["thread_limits"] = threadpool_limits(limits=blas_threads)
+
+    _worker_state.update(inputs=inputs, outputs=outputs, ci_test=ci_test, kernel_cache=KernelCache(cache_budget))
+
+
+def _run_tests(
+    key: Hashable, sample_indices: np.ndarray, in_idx: int, out_idxs: List[int]
+) -> Tuple[Hashable, Dict[int, float]]:
+    inputs, outputs = _worker_state["inputs"], _worker_state["outputs"]
+
+    data_y = inputs[in_idx][sample_indices]
+    data_z = np.concatenate([data[sample_indices] for idx, data in enumerate(inputs) if idx != in_idx], axis=1)
+    # y and z, i.e. the input and all other inputs, are the same for all outputs on the same samples
+    cache_key = (hash(sample_indices.tobytes()), in_idx)
+
+    p_values = {}
+    for out_idx in out_idxs:
+        data_x = outputs[out_idx][sample_indices]
+        p_values[out_idx] = _worker_state["ci_test"](
+            data_x, data_y, data_z, cache=_worker_state["kernel_cache"], cache_key=cache_key
+        )
+    return key, p_values
+
+
+class CITestScheduler:
+    """Scheduler of conditional-independence tests between output and input variables, given all other inputs.
+
+    Tests are independent of each other, so they are fanned out to a pool of processes, each pinned to
+    ``blas_threads`` BLAS threads. Tests of one input and several outputs on the same samples are run together by a
+    worker, sharing the kernel matrices of the input and the other inputs through a ``KernelCache`` of the worker.
+    Results are streamed back in the order of completion by ``results``, and tests submitted meanwhile (e.g. re-tests
+    of pairs whose votes are all in) are scheduled without waiting for the others.
+
+    Args:
+        inputs: data of input variables, each with shape (data-num, specific-dim).
+        outputs: data of output variables, each with shape (data-num, specific-dim).
+        ci_test: name of a registered CI test (see ``cmrl.utils.ci_test``), or a picklable function mapping data of x,
+            y and z to the p-value of x and y being independent given z, with keyword arguments ``cache`` and
+            ``cache_key`` of kernel matrices depending on y and z only.
+        workers: number of processes; 1 runs tests in the current process, and non-positive uses all cores.
+        blas_threads: number of BLAS threads of every worker, or None to leave it as is.
+        cache_budget: memory budget of the kernel cache of every worker, in MiB.
+    """
+
+    def __init__(
+        self,
+        inputs: List[np.ndarray],
+        outputs: List[np.ndarray],
+        ci_test: Union[str, Callable] = "kci",
+        workers: int = 1,
+        blas_threads: Optional[int] = 1,
+        cache_budget: float = 256,
+    ):
+        self.inputs = inputs
+        self.outputs = outputs
+        self.ci_test = get_ci_test(ci_test) if isinstance(ci_test, str) else ci_test
+        self.workers = workers if workers > 0 else os.cpu_count()
+        self.blas_threads = blas_threads
+        self.cache_budget = cache_budget
+
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._pending = set()
+        self._queue = deque()
+
+    def __enter__(self) -> "CITestScheduler":
+        if self.workers > 1:
+            # spawn rather than fork, since forking after torch or BLAS threads are started may deadlock
+            self._pool = ProcessPoolExecutor(
+                self.workers,
+                mp_context=get_context("spawn"),
+                initializer=_init_worker,
+                initargs=(self.inputs, self.outputs, self.ci_test, self.blas_threads, self.cache_budget),
+            )
+        else:
+            _init_worker(self.inputs, self.outputs, self.ci_test, None, self.cache_budget)
+        return self
+
+    def __exit__(self, *args):
+        if self._pool is not None:
+            # cancel tests not started yet, e.g. on an exception, rather than `shutdown(cancel_futures=True)` of 3.9+
+            for future in self._pending:
+                future.cancel()
+            self._pool.shutdown(wait=True)
+            self._pool = None
+        self._pending.clear()
+        self._queue.clear()
+        _worker_state.clear()
+
+    def submit(self, key: Hashable, sample_indices: np.ndarray, in_idx: int, out_idxs: List[int]):
+        """Schedule the tests of outputs ``out_idxs`` and input ``in_idx`` on ``sample_indices``, identified by
+        ``key``."""
+        if self._pool is not None:
+            self._pending.add(self._pool.submit(_run_tests, key, sample_indices, in_idx, out_idxs))
+        else:
+            self._queue.append((key, sample_indices, in_idx, out_idxs))
+
+    def results(self) -> Iterator[Tuple[Hashable, Dict[int, float]]]:
+        """Yield ``(key, p-values of every output)`` of submitted tests as soon as they complete, until no test is
+        left."""
+        while self._queue:
+            yield _run_tests(*self._queue.popleft())
+
+        while self._pending:
+            done, self._pending = wait(self._pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
@@ -0,0 +1,87 @@
+"""Registry of conditional independence (CI) tests, by name.
+
+Backends are registered as import paths rather than objects, and imported on first use, so that importing cmrl or
+any causal mech never touches their heavy dependencies (scipy.stats, causallearn, sklearn or R through rpy2).
+"""
+
+from importlib import import_module
+from typing import Any, Dict, Hashable, Optional
+
+import numpy as np
+
+_registry: Dict[str, "CITest"] = {}
+
+
+class CITest:
+    """Picklable CI test, calling ``method`` of the backend class at ``target`` (as "module:class") on data of x, y and
+    z, and returning the p-value of x and y being independent given z.
+
+    Args:
+        target: import path of the backend class, as "module:class".
+        init_kwargs: keyword arguments of the backend class.
+        method: method of the backend computing the p-value and the test statistic.
+        cacheable: whether the method takes ``cache`` and ``cache_key`` of kernel matrices depending on y and z only.
+    """
+
+    def __init__(
+        self,
+        target: str,
+        init_kwargs: Optional[Dict[str, Any]] = None,
+        method: str = "compute_pvalue",
+        cacheable: bool = True,
+    ):
+        self.target = target
+        self.init_kwargs = {} if init_kwargs is None else init_kwargs
+        self.method = method
+        self.cacheable = cacheable
+
+    def backend(self):
+        module_name, class_name = self.target.split(":")
+        return getattr(import_module(module_name), class_name)(**self.init_kwargs)
+
+    def __call__(
+        self,
+        data_x: np.ndarray,
+        data_y: np.ndarray,
+        data_z: np.ndarray,
+        cache: Optional[Any] = None,
+        cache_key: Optional[Hashable] = None,
+    ) -> float:
+        compute_pvalue = getattr(self.backend(), self.method)
+        if self.cacheable:
+            p_value, test_stat = compute_pvalue(data_x, data_y, data_z, cache=cache, cache_key=cache_key)
+        else:
+            p_value, test_stat = compute_pvalue(data_x, data_y, data_z)
+        return p_value
+
+    def __repr__(self):
+        return "CITest({}, {})".format(self.target, self.init_kwargs)
+
+
+def register_ci_test(name: str, ci_test: CITest):
+    _registry[name] = ci_test
+
+
+def get_ci_test(name: str, **init_kwargs) -> CITest:
+    """Registered CI test of ``name``, with keyword arguments of its backend overridden by ``init_kwargs``."""
+    assert name in _registry, "unsupported conditional independence test {}, in {}".format(name, list(_registry))
+    ci_test = _registry[name]
+    if len(init_kwargs) == 0:
+        return ci_test
+    return CITest(ci_test.target, {**ci_test.init_kwargs, **init_kwargs}, ci_test.method, ci_test.cacheable)
+
+
+def list_ci_tests():
+    return list(_registry)
+
+
+# kernel-based conditional independence test
+register_ci_test("kci", CITest("cmrl.utils.RCIT:KCI_CInd"))
+# low-rank approximations of KCI, without any matrix of the squared sample size
+register_ci_test("kci-nystrom", CITest("cmrl.utils.RCIT:KCI_CInd", dict(rank=200, factorization="nystrom")))
+register_ci_test("kci-icholesky", CITest("cmrl.utils.RCIT:KCI_CInd", dict(rank=200, factorization="icholesky")))
+# random Fourier feature approximations of KCI, in linear time of the sample size
+register_ci_test("rcit", CITest("cmrl.utils.RCIT:RCIT_CInd", dict(rcot=False)))
+register_ci_test("rcot", CITest("cmrl.utils.RCIT:RCIT_CInd", dict(rcot=True)))
+# the original R implementation of RCIT, requiring rpy2 and the R package RCIT
+register_ci_test("rcit-r", CITest("cmrl.utils.RCIT:KCI_CInd", method="compute_pvalue_rf", cacheable=False))
@@ -77,6 +77,8 @@ def create_dynamics(
         action_space=action_space,
         obs2state_fn=obs2state_fn,
         state2obs_fn=state2obs_fn,
+        elite_only=cfg.algorithm.get("elite_only", False),
+        propagation=cfg.algorithm.get("propagation", "mean"),
         logger=logger,
     )
 
@@ -64,6 +64,31 @@ def parse_space(
     return variables
 
 
+def variable_slices(variables: List[Variable]) -> Dict[str, slice]:
+    """Get the slice of every variable in the packed data, where variables are concatenated in order in the last dim.
+
+    Args:
+        variables: variables parsed from space, see ``parse_space``
+
+    Returns: dict of variable name and its slice
+
+    """
+    slices = {}
+    start = 0
+    for var in variables:
+        if isinstance(var, (ContinuousVariable, RadianVariable)):
+            dim = var.dim
+        elif isinstance(var, DiscreteVariable):
+            dim = var.n
+        elif isinstance(var, BinaryVariable):
+            dim = 1
+        else:
+            raise NotImplementedError("Type {} is not supported".format(type(var)))
+        slices[var.name] = slice(start, start + dim)
+        start += dim
+    return slices
+
+
 def to_dict_by_space(
         data: np.ndarray,
         space: spaces.Space,
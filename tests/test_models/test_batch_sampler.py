@@ -0,0 +1,132 @@
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+
+from cmrl.models.data_loader import (
+    EnsembleBufferDataset,
+    EnsembleDataSplit,
+    PackedTensorData,
+    TensorEnsembleBatchSampler,
+    collate_fn,
+)
+
+
+def test_same_as_data_loader():
+    data_size, ensemble_num, batch_size = 1000, 7, 64
+    inputs = {"obs_0": torch.rand(data_size, 1), "obs_1": torch.rand(data_size, 2), "act_0": torch.rand(data_size, 1)}
+    outputs = {"next_obs_0": torch.rand(data_size, 1), "next_obs_1": torch.rand(data_size, 2)}
+
+    for training in [True, False]:
+        dataset = EnsembleBufferDataset(inputs, outputs, training=training, ensemble_num=ensemble_num, seed=1)
+        loader = DataLoader(dataset, batch_size=batch_size, collate_fn=collate_fn)
+        sampler = TensorEnsembleBatchSampler(inputs, outputs, dataset.indexes, batch_size)
+
+        assert len(sampler) == len(loader)
+        for (batch_inputs, batch_outputs), (sampled_inputs, sampled_outputs) in zip(loader, sampler):
+            assert list(sampled_inputs.keys()) == list(inputs.keys())
+            assert list(sampled_outputs.keys()) == list(outputs.keys())
+            for key in inputs:
+                assert sampled_inputs[key].shape == batch_inputs[key].shape
+                assert torch.equal(sampled_inputs[key], batch_inputs[key])
+            for key in outputs:
+                assert torch.equal(sampled_outputs[key], batch_outputs[key])
+
+
+def test_data_split():
+    global_state = np.random.get_state()[1].copy()
+    split = EnsembleDataSplit(ensemble_num=7, train_ratio=0.8, seed=1)
+
+    split.extend(100)
+    train_indexes, valid_indexes = split.train_indexes.copy(), split.valid_indexes.copy()
+    assert len(train_indexes) == 80 and len(valid_indexes) == 20
+    assert split.train_indexes.dtype == np.int32
+
+    # new data is split alone, and no data point migrates
+    split.extend(250)
+    assert len(split.train_indexes) == 200 and len(split.valid_indexes) == 50
+    assert (split.train_indexes[:80] == train_indexes).all()
+    assert (split.valid_indexes[:20] == valid_indexes).all()
+    assert sorted(np.concatenate([split.train_indexes, split.valid_indexes])) == list(range(250))
+
+    # bootstrap indexes of every member are a permutation of train set, and differ between epochs
+    ensemble_indexes = split.train_ensemble_indexes()
+    assert ensemble_indexes.shape == (200, 7)
+    assert all(sorted(ensemble_indexes[:, i]) == sorted(split.train_indexes) for i in range(7))
+    assert not (ensemble_indexes == split.train_ensemble_indexes()).all()
+    assert split.valid_ensemble_indexes().shape == (50, 7)
+
+    assert (np.random.get_state()[1] == global_state).all()
+
+
+def test_sampler_with_index_fn():
+    data_size = 100
+    inputs = {"obs_0": torch.arange(data_size, dtype=torch.float32)[:, None]}
+    outputs = {"next_obs_0": torch.arange(data_size, dtype=torch.float32)[:, None]}
+    split = EnsembleDataSplit(ensemble_num=3, seed=1)
+    split.extend(data_size)
+
+    sampler = TensorEnsembleBatchSampler(inputs, outputs, split.train_ensemble_indexes, batch_size=16)
+    epochs = [torch.cat([batch_inputs["obs_0"] for batch_inputs, _ in sampler], dim=1) for _ in range(2)]
+
+    assert epochs[0].shape == (3, 80, 1)
+    assert not torch.equal(epochs[0], epochs[1])
+    assert torch.equal(epochs[0].sort(dim=1)[0], epochs[1].sort(dim=1)[0])
+
+
+def test_recent_ensemble_indexes():
+    split = EnsembleDataSplit(ensemble_num=5, seed=1)
+    split.extend(1000)
+    recent_indexes = np.arange(900, 1000)
+    recent_train_indexes = set(recent_indexes[split.train_mask[recent_indexes]])
+
+    indexes = split.recent_ensemble_indexes(2000, recent_indexes=recent_indexes, recent_ratio=0.5)
+    assert indexes.shape == (2000, 5) and indexes.dtype == np.int32
+    assert split.train_mask[indexes].all()
+    # half from recent data, plus the ones sampled from the whole train set
+    recent_num = np.isin(indexes, list(recent_train_indexes)).sum(axis=0)
+    assert (recent_num >= 1000).all() and (recent_num < 1300).all()
+
+    # the budget does not grow with data
+    split.extend(10000)
+    assert split.recent_ensemble_indexes(2000).shape == (2000, 5)
+    assert split.valid_ensemble_indexes(2000).shape == (2000, 5)
+
+
+def test_packed_data():
+    inputs = {"obs_0": torch.rand(1000, 1), "obs_1": torch.rand(1000, 2)}
+    outputs = {"next_obs_0": torch.rand(1000, 1)}
+    packed_data = PackedTensorData()
+
+    def packed(size):
+        return torch.cat([inputs["obs_0"][:size], inputs["obs_1"][:size], outputs["next_obs_0"][:size]], dim=-1)
+
+    assert packed_data.update(*[dict([(key, value[:100]) for key, value in data.items()]) for data in [inputs, outputs]])
+    storage = packed_data.storage
+    assert packed_data.size == 100 and torch.equal(packed_data.data, packed(100))
+
+    # appended and changed rows only, in place
+    inputs["obs_0"][:10] = 0
+    updated_num = packed_data.update(
+        *[dict([(key, value[:150]) for key, value in data.items()]) for data in [inputs, outputs]], indexes=np.arange(10)
+    )
+    assert updated_num == 60
+    assert packed_data.storage.data_ptr() != storage.data_ptr() and len(packed_data.storage) == 200
+    assert torch.equal(packed_data.data, packed(150))
+    assert packed_data.update(inputs, outputs, indexes=np.empty(0)) == 850
+    assert torch.equal(packed_data.data, packed(1000))
+    assert packed_data.update(inputs, outputs, indexes=np.arange(5)) == 5
+
+    # all again without indexes, or with different variables
+    assert packed_data.update(inputs, outputs) == 1000
+    assert packed_data.update(inputs, {"reward": torch.rand(1000, 1)}, indexes=np.empty(0)) == 1000
+
+    # batches of the sampler are gathered from the packed tensor
+    packed_data.update(inputs, outputs)
+    indexes = np.random.randint(0, 1000, (64, 3))
+    for sampler in [
+        TensorEnsembleBatchSampler(inputs, outputs, indexes, 16),
+        TensorEnsembleBatchSampler(inputs, outputs, indexes, 16, packed_data=packed_data),
+    ]:
+        batch_inputs, batch_outputs = next(iter(sampler))
+        assert torch.equal(batch_inputs["obs_1"], inputs["obs_1"][indexes[:16].T])
+        assert torch.equal(batch_outputs["next_obs_0"], outputs["next_obs_0"][indexes[:16].T])
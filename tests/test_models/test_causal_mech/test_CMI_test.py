@@ -51,10 +51,7 @@ def test_mask():
     for inputs, targets in train_loader:
         batch_size, extra_dim = mech.get_inputs_batch_size(inputs)
 
-        inputs_tensor = torch.zeros(mech.ensemble_num, batch_size, mech.input_var_num, mech.encoder_output_dim).to(mech.device)
-        for i, var in enumerate(mech.input_variables):
-            out = mech.variable_encoders[var.name](inputs[var.name].to(mech.device))
-            inputs_tensor[:, :, i] = out
+        inputs_tensor = mech.encoder_bank(inputs)
 
         mask = None
         masked_inputs_tensor = mech.reduce_encoder_output(inputs_tensor, mask)
@@ -0,0 +1,140 @@
+import copy
+from functools import partial
+
+import numpy as np
+import pytest
+import torch
+from gym import spaces
+
+from cmrl.models.causal_mech.oracle_mech import OracleMech
+from cmrl.models.causal_mech.util import variable_loss_func, train_func, eval_func
+from cmrl.models.data_loader import TensorEnsembleBatchSampler
+from cmrl.utils.variables import parse_space
+
+
+def prepare(data_num=1024):
+    state_space = spaces.Box(-1, 1, (4,), dtype=np.float32)
+    action_space = spaces.Box(-1, 1, (2,), dtype=np.float32)
+    input_variables = parse_space(state_space, "obs") + parse_space(action_space, "act")
+    output_variables = parse_space(state_space, "next_obs")
+
+    mech = OracleMech("transition", input_variables, output_variables, batch_size=128)
+    mech.set_oracle_graph(None)
+
+    inputs = dict([(var.name, torch.rand(data_num, 1)) for var in input_variables])
+    outputs = dict([(var.name, inputs[var.name[5:]] + 0.1 * torch.rand(data_num, 1)) for var in output_variables])
+    indexes = np.random.randint(data_num, size=(data_num, mech.ensemble_num))
+    loader = TensorEnsembleBatchSampler(inputs, outputs, indexes, mech.batch_size)
+    return mech, inputs, outputs, loader
+
+
+def accelerated_copy(mech, autocast_dtype="bfloat16", compile_forward=False):
+    accelerated = copy.deepcopy(mech)
+    accelerated.autocast_dtype = None if autocast_dtype is None else getattr(torch, autocast_dtype)
+    accelerated.compile_forward = compile_forward
+    return accelerated
+
+
+def test_autocast_train():
+    mech, _, _, loader = prepare()
+    accelerated = accelerated_copy(mech)
+
+    losses = []
+    for m, progress in [(mech, True), (accelerated, False)]:
+        loss_func = partial(variable_loss_func, output_variables=m.output_variables)
+        train_loss = train_func(loader, m.autocast_forward, m.optimizer, loss_func, progress=progress)
+        eval_loss = eval_func(loader, m.autocast_forward, loss_func, progress=progress)
+        losses.append((train_loss, eval_loss))
+
+    # same weights and batches, the losses of bf16 autocast match fp32
+    (train_loss, eval_loss), (accelerated_train_loss, accelerated_eval_loss) = losses
+    assert accelerated_train_loss.dtype == torch.float32
+    assert torch.allclose(train_loss.mean(dim=(-2, -1)), accelerated_train_loss.mean(dim=(-2, -1)), rtol=0.02, atol=0.02)
+    assert torch.allclose(eval_loss.mean(dim=(-2, -1)), accelerated_eval_loss.mean(dim=(-2, -1)), rtol=0.02, atol=0.02)
+
+
+def test_compiled_eval():
+    mech, _, _, loader = prepare()
+    accelerated = accelerated_copy(mech, compile_forward=True)
+
+    loss_func = partial(variable_loss_func, output_variables=mech.output_variables)
+    eval_loss = eval_func(loader, mech.forward, loss_func)
+    compiled_eval_loss = eval_func(loader, torch.compile(accelerated.autocast_forward), torch.compile(loss_func), False)
+
+    assert torch.allclose(eval_loss.mean(dim=(-2, -1)), compiled_eval_loss.mean(dim=(-2, -1)), rtol=0.02, atol=0.02)
+
+
+def test_accelerated_learn(tmp_path):
+    mech, inputs, outputs, _ = prepare()
+    mech.autocast_dtype = torch.bfloat16
+
+    mech.learn(inputs, outputs, work_dir=tmp_path, longest_epoch=2)
+    assert len(mech.elite_indices) == mech.elite_num
+
+
+def test_compile_once(tmp_path, monkeypatch):
+    mech, inputs, outputs, _ = prepare()
+    mech.compile_forward = True
+    compiled = []
+    monkeypatch.setattr(torch, "compile", lambda function: compiled.append(function) or function)
+
+    # compiled in the first learning only, and again once the network is built again
+    for _ in range(2):
+        mech.learn(inputs, outputs, work_dir=tmp_path, longest_epoch=1)
+    assert len(compiled) == 3
+    mech.build_network()
+    mech.build_optimizer()
+    mech.learn(inputs, outputs, work_dir=tmp_path, longest_epoch=1)
+    assert len(compiled) == 6
+    assert copy.deepcopy(mech)._compiled is None
+
+
+def test_learn_elite(tmp_path):
+    mech, inputs, outputs, _ = prepare()
+
+    mech.learn(inputs, outputs, work_dir=tmp_path, longest_epoch=3)
+    # ranked by the validation loss of the weights restored
+    assert mech.elite_indices == np.argsort(mech.best_val_loss.tolist())[: mech.elite_num].tolist()
+
+
+def test_load_state_dict(tmp_path):
+    mech, inputs, outputs, _ = prepare()
+    other, _, _, _ = prepare()
+
+    mech.learn(inputs, outputs, work_dir=tmp_path, longest_epoch=2)
+    network = other.network
+    other.load_state_dict(mech.state_dict())
+
+    # copied in place, the same forward of elites and the same optimizer state
+    assert other.network is network and other.elite_indices == mech.elite_indices
+    batch = dict([(key, value[None, :16]) for key, value in inputs.items()])
+    with torch.no_grad():
+        for name, value in mech.forward(batch, elite=True).items():
+            assert torch.equal(other.forward(batch, elite=True)[name], value)
+    assert other.optimizer.state_dict()["state"].keys() == mech.optimizer.state_dict()["state"].keys()
+    assert other.scheduler.state_dict() == mech.scheduler.state_dict()
+
+
+@pytest.mark.parametrize("reduction", ["sum", "mean", "max"])
+def test_sparse_forward(reduction):
+    state_space = spaces.Box(-1, 1, (4,), dtype=np.float32)
+    action_space = spaces.Box(-1, 1, (2,), dtype=np.float32)
+    input_variables = parse_space(state_space, "obs") + parse_space(action_space, "act")
+    output_variables = parse_space(state_space, "next_obs")
+
+    graph = np.random.randint(2, size=(len(input_variables), len(output_variables)))
+    graph[0] = 1  # avoid -inf for max reduction
+    graph[np.arange(len(input_variables)), np.arange(len(input_variables)) % len(output_variables)] = 1
+    graph[2] = 0  # input used by no output
+    mech = OracleMech("transition", input_variables, output_variables, encoder_reduction=reduction, sparse_forward=True)
+    mech.set_oracle_graph(graph)
+    assert mech.parent_mask.shape == (len(output_variables), 1, 1, len(input_variables) - 1)
+
+    inputs = dict([(var.name, torch.rand(1, 32, 1)) for var in input_variables])
+    sparse_outputs = mech.forward(inputs)
+    mech.sparse_forward = False
+    mech.build_sparse_forward()
+    dense_outputs = mech.forward(inputs)
+
+    for name in dense_outputs:
+        assert torch.allclose(sparse_outputs[name], dense_outputs[name], atol=1e-5)
@@ -0,0 +1,71 @@
+import numpy as np
+from gym import spaces
+
+from cmrl.models.causal_mech.kernel_test import KernelTestMech
+from cmrl.utils.variables import parse_space
+
+
+def prepare(data_num=500, **kwargs):
+    state_space = spaces.Box(-1, 1, (3,), dtype=np.float32)
+    action_space = spaces.Box(-1, 1, (1,), dtype=np.float32)
+    input_variables = parse_space(state_space, "obs") + parse_space(action_space, "act")
+    output_variables = parse_space(state_space, "next_obs")
+
+    mech = KernelTestMech("transition", input_variables, output_variables, **kwargs)
+
+    inputs = dict([(var.name, np.random.uniform(-1, 1, (data_num, 1))) for var in input_variables])
+    # obs_0 <- act_0, obs_1 <- obs_0, obs_2 <- nothing
+    outputs = {
+        "next_obs_0": inputs["obs_0"] + np.sin(3 * inputs["act_0"]),
+        "next_obs_1": inputs["obs_1"] + inputs["obs_0"] ** 2,
+        "next_obs_2": inputs["obs_2"] + 0.1 * np.random.randn(data_num, 1),
+    }
+    return mech, inputs, outputs
+
+
+def test_kci_compute_graph(tmp_path):
+    np.random.seed(0)
+    mech, inputs, outputs = prepare(sample_num=200, kci_times=2, longest_sample=400)
+
+    graph = mech.kci_compute_graph(inputs, outputs, work_dir=tmp_path)
+    assert graph.shape == (mech.input_var_num, mech.output_var_num)
+    assert graph[3, 0] and graph[0, 1]
+    assert not graph[:, 2].any()
+
+
+def test_parallel_kci_compute_graph(tmp_path):
+    mech, inputs, outputs = prepare(sample_num=100, kci_times=2, longest_sample=200)
+
+    graphs = []
+    for kci_workers in [1, 2]:
+        mech.kci_workers = kci_workers
+        np.random.seed(0)
+        graphs.append(mech.kci_compute_graph(inputs, outputs, work_dir=tmp_path))
+
+    # same samples in every round, whatever the order tests complete in
+    assert (graphs[0] == graphs[1]).all()
+
+
+def test_rcot_compute_graph(tmp_path):
+    np.random.seed(0)
+    mech, inputs, outputs = prepare(data_num=5000, sample_num=2000, kci_times=2, longest_sample=5000, ci_test="rcot")
+
+    graph = mech.kci_compute_graph(inputs, outputs, work_dir=tmp_path)
+    assert graph[3, 0] and graph[0, 1]
+    assert not graph[:, 2].any()
+
+
+def test_low_rank_kci_compute_graph(tmp_path):
+    np.random.seed(0)
+    mech, inputs, outputs = prepare(
+        data_num=5000,
+        sample_num=2000,
+        kci_times=2,
+        longest_sample=5000,
+        ci_test="kci-nystrom",
+        ci_test_kwargs=dict(rank=100),
+    )
+
+    graph = mech.kci_compute_graph(inputs, outputs, work_dir=tmp_path)
+    assert graph[3, 0] and graph[0, 1]
+    assert not graph[:, 2].any()
@@ -1,200 +1,104 @@
-import gym
-from stable_baselines3.common.buffers import ReplayBuffer
+import numpy as np
+import pytest
 import torch
-from torch.utils.data import DataLoader
+from gym import spaces
 
 from cmrl.models.causal_mech.reinforce import ReinforceCausalMech
-from cmrl.models.data_loader import EnsembleBufferDataset, EnsembleBufferDataset, collate_fn
-from cmrl.utils.creator import parse_space
-from cmrl.utils.env import load_offline_data
 from cmrl.models.causal_mech.util import variable_loss_func
+from cmrl.utils.variables import parse_space
 
 
-def prepare(freq_rate):
-    env = gym.make("BoundaryInvertedPendulumSwingUp-v0", freq_rate=freq_rate, time_step=0.02)
+def prepare(data_num=200, **kwargs):
+    state_space = spaces.Box(-1, 1, (3,), dtype=np.float32)
+    action_space = spaces.Box(-1, 1, (1,), dtype=np.float32)
+    input_variables = parse_space(state_space, "obs") + parse_space(action_space, "act")
+    output_variables = parse_space(state_space, "next_obs")
 
-    real_replay_buffer = ReplayBuffer(
-        1000, env.observation_space, env.action_space, device="cpu", handle_timeout_termination=False
-    )
-    load_offline_data(env, real_replay_buffer, "SAC-expert-replay", use_ratio=0.001)
-
-    ensemble_num = 7
-    # test for transition
-    train_dataset = EnsembleBufferDataset(
-        real_replay_buffer,
-        env.observation_space,
-        env.action_space,
-        training=False,
-        mech="transition",
-        train_ensemble=True,
-        ensemble_num=ensemble_num,
-    )
-    train_loader = DataLoader(train_dataset, batch_size=8, collate_fn=collate_fn)
-    valid_dataset = EnsembleBufferDataset(
-        real_replay_buffer, env.observation_space, env.action_space, training=True, mech="transition", repeat=ensemble_num
-    )
-    valid_loader = DataLoader(valid_dataset, batch_size=8, collate_fn=collate_fn)
+    mech = ReinforceCausalMech("transition", input_variables, output_variables, ensemble_num=3, elite_num=2, **kwargs)
 
-    input_variables = parse_space(env.observation_space, "obs") + parse_space(env.action_space, "act")
-    output_variables = parse_space(env.observation_space, "next_obs")
+    inputs = dict([(var.name, np.random.uniform(-1, 1, (data_num, 1)).astype(np.float32)) for var in input_variables])
+    outputs = {
+        "next_obs_0": inputs["obs_0"] + np.sin(3 * inputs["act_0"]),
+        "next_obs_1": inputs["obs_1"] + inputs["obs_0"] ** 2,
+        "next_obs_2": inputs["obs_2"],
+    }
+    return mech, inputs, outputs
 
-    return input_variables, output_variables, train_loader, valid_loader
 
+def batch(mech, data, batch_size=16):
+    # [ensemble-num, batch-size, specific-dim]
+    return dict(
+        [(name, torch.as_tensor(value[None, :batch_size]).repeat(mech.ensemble_num, 1, 1)) for name, value in data.items()]
+    )
 
-def test_init():
-    input_variables, output_variables, _, _ = prepare(freq_rate=1)
 
-    mech = ReinforceCausalMech(
-        name="test",
-        input_variables=input_variables,
-        output_variables=output_variables,
-    )
+def test_init():
+    mech, _, _ = prepare()
 
     assert mech.network, "network incorrectly initialized"
     assert mech.graph, "graph incorrectly initialized"
     assert mech.optimizer, "network optimizer incorrectly initialized"
     assert mech.graph_optimizer, "graph optimizer incorrectly initialized"
-
-
-def test_causal_graph():
-    input_variables, output_variables, _, _ = prepare(freq_rate=1)
-
-    mech = ReinforceCausalMech(
-        name="test",
-        input_variables=input_variables,
-        output_variables=output_variables,
-    )
-
-    assert mech.causal_graph is not None, "cannot obtain causal graph correctly"
     assert mech.causal_graph.all(), "incorrect initial causal graph"
 
 
-def test_single_step_forward():
-    input_variables, output_variables, train_loader, _ = prepare(freq_rate=1)
-
-    mech = ReinforceCausalMech(
-        name="test",
-        input_variables=input_variables,
-        output_variables=output_variables,
-    )
-    train_iter = iter(train_loader)
-    inputs, targets = next(train_iter)
-
-    # test training
-    outputs = mech.single_step_forward(inputs, train=True)
-    assert len(outputs.keys() ^ targets.keys()) == 0, "single forward output keys mismatch when training"
-    loss = variable_loss_func(outputs, targets, mech.output_variables)
-    assert loss is not None, "single forward output is incorrect when training"
-
-    # test evaluating
-    outputs = mech.single_step_forward(inputs, train=False)
-    assert len(outputs.keys() ^ targets.keys()) == 0, "single forward output keys mismatch when evaluating"
-    loss = variable_loss_func(outputs, targets, mech.output_variables)
-    assert loss is not None, "single forward outupt is incorrect when evaluating"
-
-    # test evaluating with fixed mask
-    extra_dims = next(iter(inputs.values())).shape[:-1]
-    mask = torch.randint(0, 2, size=(len(targets), *extra_dims, len(inputs)))
-    outputs = mech.single_step_forward(inputs, train=False, mask=mask)
-    assert len(outputs.keys() ^ targets.keys()) == 0, "single forward output keys mismatch when evaluating with given mask"
-    loss = variable_loss_func(outputs, targets, mech.output_variables)
-    assert loss is not None, "single forward output is incorrect when evaluating with given mask"
-
-
-def test_forward():
-    input_variables, output_variables, train_loader, _ = prepare(freq_rate=1)
-
-    # test single step
-    mech = ReinforceCausalMech(
-        name="test",
-        input_variables=input_variables,
-        output_variables=output_variables,
-    )
-    train_iter = iter(train_loader)
-    inputs, targets = next(train_iter)
-
-    outputs = mech.forward(inputs, train=True)
-    assert len(outputs.keys() ^ targets.keys()) == 0, "forward output keys mismatch when evaluating (single step)"
-    loss = variable_loss_func(outputs, targets, mech.output_variables)
-    assert loss is not None, "forward outupt is incorrect when evaluating (single step)"
-
-    # test multi-step
-    mech = ReinforceCausalMech(
-        name="test", input_variables=input_variables, output_variables=output_variables, multi_step="forward-euler 2"
-    )
-    train_iter = iter(train_loader)
-    inputs, targets = next(train_iter)
-
-    outputs = mech.forward(inputs, train=True)
-    assert len(outputs.keys() ^ targets.keys()) == 0, "forward output keys mismatch when evaluating (2 steps)"
-    loss = variable_loss_func(outputs, targets, mech.output_variables)
-    assert loss is not None, "forward outupt is incorrect when evaluating (2 steps)"
-
-
-def test_train_graph():
-    input_variables, output_variables, train_loader, _ = prepare(freq_rate=1)
+@pytest.mark.parametrize("multi_step", ["none", "forward-euler 2"])
+def test_forward(multi_step):
+    mech, inputs, outputs = prepare(multi_step=multi_step)
+    targets = batch(mech, outputs)
 
-    # test single step
-    mech = ReinforceCausalMech(
-        name="test",
-        input_variables=input_variables,
-        output_variables=output_variables,
-    )
+    for train in [True, False]:
+        outputs = mech.forward(batch(mech, inputs), train=train)
+        assert outputs.keys() == targets.keys()
+        assert outputs["next_obs_0"].shape == (mech.ensemble_num, 16, 2)
+        assert variable_loss_func(outputs, targets, mech.output_variables).shape == (mech.ensemble_num, 16, 3)
 
-    grads = mech.train_graph(train_loader, data_ratio=1.0)
-    assert grads is not None, "train graph single step failed"
 
-    # test multi-step
-    mech = ReinforceCausalMech(
-        name="test",
-        input_variables=input_variables,
-        output_variables=output_variables,
-        multi_step="forward-euler 2",
-    )
+@pytest.mark.parametrize("concat_mask", [True, False])
+@pytest.mark.parametrize("encoder_reduction", ["sum", "mean", "max"])
+@pytest.mark.parametrize("multi_step", ["none", "forward-euler 2"])
+def test_MC_forward(concat_mask, encoder_reduction, multi_step):
+    mech, inputs, _ = prepare(concat_mask=concat_mask, encoder_reduction=encoder_reduction, multi_step=multi_step)
+    inputs = batch(mech, inputs)
+    # [graph-count, output-var-num, input-var-num]
+    masks = torch.randint(0, 2, (5, mech.output_var_num, mech.input_var_num)).float()
+    # no empty parent set, which is nan in max reduction
+    masks[:, :, 0] = 1
 
-    grads = mech.train_graph(train_loader, data_ratio=0.5)
-    assert grads is not None, "train graph multi-step (2) failed"
+    with torch.no_grad():
+        outputs = mech._MC_forward(inputs, mech.encoder_bank(inputs), masks)
+        for i, mask in enumerate(masks):
+            # [output-var-num, 1, 1, input-var-num]
+            graph_outputs = mech.forward(dict(inputs), mask=mask[:, None, None])
+            for name, value in graph_outputs.items():
+                assert outputs[name].shape == (mech.ensemble_num, len(masks), 16, 2)
+                assert torch.allclose(outputs[name][:, i], value, atol=1e-5)
 
 
-def test_learn():
-    input_variables, output_variables, train_loader, valid_loader = prepare(freq_rate=1)
+def test_MC_sample():
+    mech, inputs, outputs = prepare(graph_MC_samples=7, graph_max_stack=3)
 
-    # test single step on cpu
-    mech = ReinforceCausalMech(
-        name="test single on cpu",
-        input_variables=input_variables,
-        output_variables=output_variables,
-    )
+    adj_mats, losses = mech._MC_sample(batch(mech, inputs), batch(mech, outputs))
+    assert adj_mats.shape == (7, mech.input_var_num, mech.output_var_num)
+    assert losses.shape == (7, mech.output_var_num)
 
-    mech.learn(train_loader, valid_loader)
 
-    # test multi-step on cpu
-    mech = ReinforceCausalMech(
-        name="test multi on cpu",
-        input_variables=input_variables,
-        output_variables=output_variables,
-        multi_step="forward-euler 2",
-    )
+def test_learn(tmp_path):
+    mech, inputs, outputs = prepare(longest_epoch=2, batch_size=32, graph_MC_samples=4)
 
-    mech.learn(train_loader, valid_loader)
+    mech.learn(inputs, outputs, work_dir=tmp_path)
+    assert mech.start_val_loss.shape == mech.best_val_loss.shape == (mech.ensemble_num,)
+    assert len(mech.elite_indices) == mech.elite_num
+    assert (tmp_path / "transition").exists()
 
-    # test single step on cuda
-    mech = ReinforceCausalMech(
-        name="test single on cuda",
-        input_variables=input_variables,
-        output_variables=output_variables,
-        device="cuda:0",
-    )
-
-    mech.learn(train_loader, valid_loader)
 
-    # test multi-step on cuda
-    mech = ReinforceCausalMech(
-        name="test multi on cuda",
-        input_variables=input_variables,
-        output_variables=output_variables,
-        multi_step="forward-euler 2",
-        device="cuda:0",
-    )
+def test_before_epoch():
+    mech, inputs, outputs = prepare(batch_size=32, graph_MC_samples=4, train_graph_freq=2)
+    train_loader, _ = mech.get_data_loaders(inputs, outputs)
+    init_graph_params = mech.graph.parameters[0].detach().clone()
 
-    mech.learn(train_loader, valid_loader)
+    # the graph is updated in the learning loop of the base class every `train_graph_freq` epochs
+    assert mech.before_epoch(1, train_loader) == {}
+    assert torch.equal(mech.graph.parameters[0], init_graph_params)
+    assert "graph_update_grads" in mech.before_epoch(2, train_loader)
+    assert not torch.equal(mech.graph.parameters[0], init_graph_params)
@@ -0,0 +1,166 @@
+import pytest
+import torch
+import torch.nn.functional as F
+
+from cmrl.models.causal_mech.util import (
+    masked_encoder_reduction,
+    variable_loss_func,
+    circular_gaussian_nll_loss,
+    EnsembleBestWeights,
+)
+from cmrl.utils.variables import ContinuousVariable, RadianVariable, BinaryVariable
+from cmrl.models.layers import ParallelLinear
+
+
+def repeated_reduction(encoder_output, mask, reduction):
+    # reference: repeat mask and encoder output, then reduce
+    mask = mask.expand(*mask.shape[:-3], *encoder_output.shape[:-1])
+    mask = mask[..., None].repeat([1] * len(mask.shape) + [encoder_output.shape[-1]])
+    masked_encoder_output = encoder_output.repeat(tuple(mask.shape[:-4]) + (1,) * 4)
+    masked_encoder_output[mask == 0] = -float("inf") if reduction == "max" else 0
+
+    if reduction == "sum":
+        return masked_encoder_output.sum(-2)
+    elif reduction == "mean":
+        return masked_encoder_output.mean(-2)
+    else:
+        return masked_encoder_output.max(-2)[0]
+
+
+@pytest.mark.parametrize("reduction", ["sum", "mean", "max"])
+def test_static_mask_reduction(reduction):
+    ensemble_num, batch_size, input_var_num, output_var_num, dim = 7, 16, 5, 4, 8
+
+    encoder_output = torch.rand(ensemble_num, batch_size, input_var_num, dim)
+    mask = torch.randint(2, (output_var_num, input_var_num))
+    mask[:, 0] = 1  # avoid -inf for max reduction
+    mask = mask[:, None, None, :]
+
+    reduced = masked_encoder_reduction(encoder_output, mask, reduction)
+    assert reduced.shape == (output_var_num, ensemble_num, batch_size, dim)
+    assert torch.allclose(reduced, repeated_reduction(encoder_output, mask, reduction), atol=1e-6)
+
+
+@pytest.mark.parametrize("reduction", ["sum", "mean", "max"])
+def test_sampled_mask_reduction(reduction):
+    ensemble_num, batch_size, input_var_num, output_var_num, dim = 7, 16, 5, 4, 8
+
+    encoder_output = torch.rand(ensemble_num, batch_size, input_var_num, dim)
+    mask = torch.randint(2, (3, output_var_num, ensemble_num, batch_size, input_var_num))
+    mask[..., 0] = 1
+
+    reduced = masked_encoder_reduction(encoder_output, mask, reduction)
+    assert reduced.shape == (3, output_var_num, ensemble_num, batch_size, dim)
+    assert torch.allclose(reduced, repeated_reduction(encoder_output, mask, reduction), atol=1e-6)
+
+
+def test_ensemble_best_weights():
+    layer = ParallelLinear(3, 4, extra_dims=[5, 7])
+    best_weights = EnsembleBestWeights([(layer.weight, 1), (layer.bias, 1)], [])
+    best_weights.reset()
+    init_weight = layer.weight.detach().clone()
+
+    with torch.no_grad():
+        layer.weight.add_(1)
+    improved = torch.zeros(7, dtype=torch.bool)
+    improved[[2, 5]] = True
+    assert best_weights.update(improved)
+    assert not best_weights.update(torch.zeros(7, dtype=torch.bool))
+
+    with torch.no_grad():
+        layer.weight.add_(1)
+    best_weights.restore()
+
+    # only the improved members are kept, the others are restored to the initial weights
+    assert torch.equal(layer.weight[:, [2, 5]], init_weight[:, [2, 5]] + 1)
+    assert torch.equal(layer.weight[:, [0, 1, 3, 4, 6]], init_weight[:, [0, 1, 3, 4, 6]])
+
+
+def test_ensemble_best_weights_shared():
+    layer = ParallelLinear(3, 4, extra_dims=[5, 7])
+    shared = torch.nn.Linear(3, 4)
+    best_weights = EnsembleBestWeights([(layer.weight, 1), (layer.bias, 1)], list(shared.parameters()))
+    best_weights.reset()
+    init_weight, init_shared = layer.weight.detach().clone(), shared.weight.detach().clone()
+
+    with torch.no_grad():
+        layer.weight.add_(1)
+        shared.weight.add_(1)
+    # members paired with the shared tensors are kept all together
+    with pytest.raises(AssertionError):
+        best_weights.update(torch.arange(7) < 2)
+    assert best_weights.update(torch.ones(7, dtype=torch.bool))
+
+    with torch.no_grad():
+        layer.weight.add_(1)
+        shared.weight.add_(1)
+    best_weights.restore()
+
+    # all of the same epoch
+    assert torch.equal(layer.weight, init_weight + 1)
+    assert torch.equal(shared.weight, init_shared + 1)
+
+
+def looped_variable_loss(outputs, targets, output_variables):
+    # reference: loss of every variable by itself
+    losses = []
+    for var in output_variables:
+        output, target = outputs[var.name], targets[var.name]
+        if isinstance(var, ContinuousVariable):
+            mean, log_var = output[..., : var.dim], torch.clamp(output[..., var.dim :], min=-10, max=10)
+            loss = F.gaussian_nll_loss(mean, target, log_var.exp(), reduction="none", full=True, eps=1e-4)
+        elif isinstance(var, RadianVariable):
+            mean, log_var = output[..., : var.dim], output[..., var.dim :]
+            loss = circular_gaussian_nll_loss(mean, target, log_var.exp(), reduction="none")
+        else:
+            loss = F.binary_cross_entropy(output, target, reduction="none")
+        losses.append(loss.mean(dim=-1))
+    return torch.stack(losses, dim=-1)
+
+
+def make_loss_data(ensemble_num=7, batch_size=16):
+    # interleaved types, to check the order of losses
+    output_variables = [
+        ContinuousVariable("next_obs_0", dim=1),
+        RadianVariable("next_obs_1", dim=1),
+        BinaryVariable("terminal"),
+        ContinuousVariable("next_obs_2", dim=2),
+        ContinuousVariable("next_obs_3", dim=1),
+    ]
+    outputs, targets = {}, {}
+    for var in output_variables:
+        if isinstance(var, BinaryVariable):
+            outputs[var.name] = torch.rand(ensemble_num, batch_size, 1, requires_grad=True)
+            targets[var.name] = torch.randint(2, (ensemble_num, batch_size, 1)).float()
+        else:
+            outputs[var.name] = (4 * torch.randn(ensemble_num, batch_size, 2 * var.dim)).requires_grad_()
+            targets[var.name] = 4 * torch.randn(ensemble_num, batch_size, var.dim)
+    return outputs, targets, output_variables
+
+
+def test_variable_loss():
+    outputs, targets, output_variables = make_loss_data()
+
+    loss = variable_loss_func(outputs, targets, output_variables)
+    reference = looped_variable_loss(outputs, targets, output_variables)
+    assert loss.shape == (7, 16, len(output_variables))
+    assert torch.allclose(loss, reference, atol=1e-5)
+
+    grads = torch.autograd.grad(loss.sum(), list(outputs.values()))
+    reference_grads = torch.autograd.grad(reference.sum(), list(outputs.values()))
+    assert all(torch.allclose(g, r, atol=1e-5) for g, r in zip(grads, reference_grads))
+
+
+@pytest.mark.filterwarnings("ignore:Anomaly Detection")
+def test_variable_loss_not_finite():
+    outputs, targets, output_variables = make_loss_data()
+    targets["next_obs_2"][3, 5, 1] = float("nan")
+
+    # the check can be deferred
+    loss = variable_loss_func(outputs, targets, output_variables, check_finite=False)
+    assert torch.isnan(loss[3, 5, 3]) and torch.isfinite(loss[..., [0, 1, 2, 4]]).all()
+    with pytest.raises(ValueError, match="nan loss for next_obs_2"):
+        variable_loss_func(outputs, targets, output_variables)
+    with torch.autograd.detect_anomaly():
+        with pytest.raises(ValueError, match="nan loss for next_obs_2"):
+            variable_loss_func(outputs, targets, output_variables, check_finite=False)
@@ -0,0 +1,69 @@
+from types import SimpleNamespace
+
+import numpy as np
+from gym import spaces
+
+from cmrl.models.data_loader import BufferDatasetCache
+
+
+def make_buffer(buffer_size, state_dim=3, action_dim=2):
+    # only the fields of SB3's replay buffer used by ``BufferDatasetCache``
+    return SimpleNamespace(
+        buffer_size=buffer_size,
+        observations=np.zeros((buffer_size, 1, state_dim), dtype=np.float32),
+        next_observations=np.zeros((buffer_size, 1, state_dim), dtype=np.float32),
+        extra_obs=np.zeros((buffer_size, 1, 1), dtype=np.float32),
+        next_extra_obs=np.zeros((buffer_size, 1, 1), dtype=np.float32),
+        actions=np.zeros((buffer_size, 1, action_dim), dtype=np.float32),
+        rewards=np.zeros((buffer_size, 1), dtype=np.float32),
+        dones=np.zeros((buffer_size, 1), dtype=np.float32),
+        timeouts=np.zeros((buffer_size, 1), dtype=np.float32),
+        pos=0,
+        full=False,
+    )
+
+
+def add(replay_buffer, num):
+    for _ in range(num):
+        pos = replay_buffer.pos
+        replay_buffer.observations[pos] = np.random.rand(1, 3)
+        replay_buffer.next_observations[pos] = np.random.rand(1, 3)
+        replay_buffer.extra_obs[pos] = np.random.rand(1, 1)
+        replay_buffer.next_extra_obs[pos] = np.random.rand(1, 1)
+        replay_buffer.actions[pos] = np.random.rand(1, 2)
+        replay_buffer.rewards[pos] = np.random.rand(1)
+        replay_buffer.dones[pos] = np.random.rand(1) > 0.5
+        replay_buffer.pos = (pos + 1) % replay_buffer.buffer_size
+        replay_buffer.full = replay_buffer.full or replay_buffer.pos == 0
+
+
+def test_incremental_update():
+    state_space = spaces.Box(-1, 1, (3,), dtype=np.float32)
+    action_space = spaces.Box(-1, 1, (2,), dtype=np.float32)
+    cache = BufferDatasetCache(state_space, action_space, obs2state_fn=lambda obs, extra_obs: obs + extra_obs)
+    replay_buffer = make_buffer(10)
+
+    for num in [4, 3, 5, 9]:
+        add(replay_buffer, num)
+        assert cache.update(replay_buffer) == num
+        size = replay_buffer.buffer_size if replay_buffer.full else replay_buffer.pos
+
+        states = replay_buffer.observations[:size, 0] + replay_buffer.extra_obs[:size, 0]
+        next_states = replay_buffer.next_observations[:size, 0] + replay_buffer.next_extra_obs[:size, 0]
+        inputs, outputs = cache.get("termination_mech")
+        for i in range(3):
+            assert np.allclose(inputs["obs_{}".format(i)].numpy(), states[:, i, None])
+            assert np.allclose(inputs["next_obs_{}".format(i)].numpy(), next_states[:, i, None])
+        for i in range(2):
+            assert np.allclose(inputs["act_{}".format(i)].numpy(), replay_buffer.actions[:size, 0, i, None])
+        assert np.allclose(outputs["terminal"].numpy(), replay_buffer.dones[:size])
+
+    # nothing new
+    assert cache.update(replay_buffer) == 0
+
+    # actions and rewards are shared with the buffer, states are shared between mechs
+    inputs, outputs = cache.get("reward_mech")
+    transition_inputs, _ = cache.get("transition")
+    assert np.shares_memory(inputs["act_0"].numpy(), replay_buffer.actions)
+    assert np.shares_memory(outputs["reward"].numpy(), replay_buffer.rewards)
+    assert np.shares_memory(inputs["obs_0"].numpy(), transition_inputs["obs_0"].numpy())
@@ -0,0 +1,283 @@
+from types import SimpleNamespace
+
+import numpy as np
+import torch
+from gym import spaces
+
+from cmrl.models.causal_mech.oracle_mech import OracleMech
+from cmrl.models.dynamics import Dynamics, AsyncDynamicsLearner, add_to_buffer
+from cmrl.utils.variables import parse_space, ContinuousVariable, BinaryVariable
+
+
+def prepare(obs_dim=4, act_dim=2):
+    state_space = spaces.Box(-1, 1, (obs_dim,), dtype=np.float32)
+    action_space = spaces.Box(-1, 1, (act_dim,), dtype=np.float32)
+
+    input_variables = parse_space(state_space, "obs") + parse_space(action_space, "act")
+    output_variables = parse_space(state_space, "next_obs")
+    transition = OracleMech("transition", input_variables, output_variables)
+    transition.set_oracle_graph(None)
+
+    dynamics = Dynamics(
+        transition,
+        state_space,
+        action_space,
+        obs2state_fn=lambda obs, extra_obs: obs,
+        state2obs_fn=lambda state: state,
+    )
+    return dynamics
+
+
+def make_buffer(buffer_size, pos=0):
+    # only the fields of SB3's replay buffer used by dynamics
+    return SimpleNamespace(
+        n_envs=1,
+        optimize_memory_usage=False,
+        buffer_size=buffer_size,
+        obs_shape=(4,),
+        action_dim=2,
+        observations=np.zeros((buffer_size, 1, 4), dtype=np.float32),
+        next_observations=np.zeros((buffer_size, 1, 4), dtype=np.float32),
+        actions=np.zeros((buffer_size, 1, 2), dtype=np.float32),
+        rewards=np.zeros((buffer_size, 1), dtype=np.float32),
+        dones=np.zeros((buffer_size, 1), dtype=np.float32),
+        extra_obs=np.zeros((buffer_size, 1, 1), dtype=np.float32),
+        next_extra_obs=np.zeros((buffer_size, 1, 1), dtype=np.float32),
+        timeouts=np.zeros((buffer_size, 1), dtype=np.float32),
+        pos=pos,
+        full=False,
+    )
+
+
+def test_step():
+    batch_size = 32
+    dynamics = prepare()
+    ensemble_num = dynamics.transition.ensemble_num
+
+    batch_obs = np.random.rand(batch_size, 4).astype(np.float32)
+    batch_action = np.random.rand(batch_size, 2).astype(np.float32)
+    batch_next_obs, _, _, info = dynamics.step(batch_obs, batch_action)
+
+    assert batch_next_obs.shape == (batch_size, 4)
+    assert info["origin-next_obs"].shape == (ensemble_num, batch_size, 4)
+
+    # same as tiling inputs for every ensemble member
+    inputs = dict([("obs_{}".format(i), torch.from_numpy(batch_obs[:, i, None])) for i in range(4)])
+    inputs.update([("act_{}".format(i), torch.from_numpy(batch_action[:, i, None])) for i in range(2)])
+    inputs = dict([(key, value[None].repeat(ensemble_num, 1, 1)) for key, value in inputs.items()])
+    with torch.no_grad():
+        outputs = dynamics.transition.forward(inputs)
+    tiled_next_obs = torch.cat([outputs["next_obs_{}".format(i)][..., :1] for i in range(4)], dim=-1)
+
+    assert np.allclose(info["origin-next_obs"], tiled_next_obs.numpy(), atol=1e-6)
+
+
+def test_random_propagation():
+    batch_size = 32
+    dynamics = prepare()
+    dynamics.propagation = "random"
+
+    batch_obs = np.random.rand(batch_size, 4).astype(np.float32)
+    batch_action = np.random.rand(batch_size, 2).astype(np.float32)
+    batch_next_obs, _, _, info = dynamics.step(batch_obs, batch_action)
+
+    # every sample comes from one of the members
+    assert batch_next_obs.shape == (batch_size, 4)
+    diff = np.abs(info["origin-next_obs"] - batch_next_obs[None]).max(axis=-1)
+    assert (diff.min(axis=0) < 1e-6).all()
+
+
+def test_elite_step():
+    batch_size = 32
+    dynamics = prepare()
+    transition = dynamics.transition
+    transition.elite_indices = [5, 1, 3]
+    transition.build_elite_network()
+
+    batch_obs = np.random.rand(batch_size, 4).astype(np.float32)
+    batch_action = np.random.rand(batch_size, 2).astype(np.float32)
+    # the whole ensemble by default
+    _, _, _, full_info = dynamics.step(batch_obs, batch_action)
+    assert full_info["origin-next_obs"].shape == (transition.ensemble_num, batch_size, 4)
+
+    dynamics.elite_only = True
+    _, _, _, info = dynamics.step(batch_obs, batch_action)
+
+    assert info["origin-next_obs"].shape == (3, batch_size, 4)
+    assert np.allclose(info["origin-next_obs"], full_info["origin-next_obs"][[5, 1, 3]], atol=1e-6)
+
+
+def test_learned_reward_and_termination():
+    batch_size = 32
+    dynamics = prepare()
+    state_space, action_space = dynamics.state_space, dynamics.action_space
+
+    input_variables = parse_space(state_space, "obs") + parse_space(action_space, "act") + parse_space(state_space, "next_obs")
+    reward_mech = OracleMech("reward_mech", input_variables, [ContinuousVariable("reward", dim=1)])
+    reward_mech.set_oracle_graph(None)
+    termination_mech = OracleMech("termination_mech", input_variables, [BinaryVariable("terminal")])
+    termination_mech.set_oracle_graph(None)
+    dynamics.reward_mech, dynamics.learn_reward = reward_mech, True
+    dynamics.termination_mech, dynamics.learn_termination = termination_mech, True
+
+    batch_obs = np.random.rand(batch_size, 4).astype(np.float32)
+    batch_action = np.random.rand(batch_size, 2).astype(np.float32)
+    batch_next_obs, batch_reward, batch_terminal, _ = dynamics.step(batch_obs, batch_action)
+    assert batch_reward.shape == (batch_size, 1)
+    assert batch_terminal.shape == (batch_size, 1) and batch_terminal.dtype == bool
+
+    # same as feeding the next obs back from numpy
+    inputs = dict([("obs_{}".format(i), torch.from_numpy(batch_obs[None, :, i, None])) for i in range(4)])
+    inputs.update([("act_{}".format(i), torch.from_numpy(batch_action[None, :, i, None])) for i in range(2)])
+    inputs.update([("next_obs_{}".format(i), torch.from_numpy(batch_next_obs[None, :, i, None])) for i in range(4)])
+    with torch.no_grad():
+        reward = reward_mech.forward(inputs)["reward"][..., :1].mean(dim=0)
+        terminal = termination_mech.forward(inputs)["terminal"].mean(dim=0) > 0.5
+
+    assert np.allclose(batch_reward, reward.numpy(), atol=1e-6)
+    assert (batch_terminal == terminal.numpy()).all()
+
+
+def test_add_to_buffer():
+    replay_buffer = make_buffer(10, pos=7)
+    obs = np.arange(6 * 4, dtype=np.float32).reshape(6, 4)
+    add_to_buffer(replay_buffer, obs, obs + 1, obs[:, :2], obs[:, 0], obs[:, 0] > 10)
+
+    assert replay_buffer.pos == 3 and replay_buffer.full
+    assert (replay_buffer.observations[[7, 8, 9, 0, 1, 2], 0] == obs).all()
+    assert (replay_buffer.next_observations[[7, 8, 9, 0, 1, 2], 0] == obs + 1).all()
+    assert (replay_buffer.dones[[7, 8, 9, 0, 1, 2], 0] == (obs[:, 0] > 10)).all()
+
+
+def test_rollout():
+    dynamics = prepare()
+    batch_size, horizon = 32, 3
+
+    class RandomPolicy:
+        action_space = dynamics.action_space
+
+        def predict(self, obs, deterministic=False):
+            return np.random.uniform(-1, 1, (len(obs), 2)).astype(np.float32), None
+
+        def scale_action(self, action):
+            return action
+
+    replay_buffer = make_buffer(1000)
+    start_obs = np.random.rand(batch_size, 4).astype(np.float32)
+    transition_num = dynamics.rollout(
+        start_obs,
+        RandomPolicy(),
+        horizon,
+        replay_buffer,
+        reward_fn=lambda next_obs, obs, act: next_obs.sum(-1),
+        termination_fn=lambda next_obs, obs, act: np.zeros(len(obs), dtype=bool),
+    )
+
+    assert transition_num == replay_buffer.pos == batch_size * horizon
+    assert (replay_buffer.observations[:batch_size, 0] == start_obs).all()
+    # branches continue from the predicted next obs
+    next_branch_obs = replay_buffer.observations[batch_size : 2 * batch_size, 0]
+    assert (next_branch_obs == replay_buffer.next_observations[:batch_size, 0]).all()
+    assert np.allclose(replay_buffer.rewards[:transition_num, 0], replay_buffer.next_observations[:transition_num, 0].sum(-1))
+
+
+def test_incremental_learn(tmp_path):
+    dynamics = prepare()
+    transition = dynamics.transition
+    replay_buffer = make_buffer(1000)
+
+    steps = []
+    for data_num in [300, 600]:
+        replay_buffer.observations[:data_num] = np.random.rand(data_num, 1, 4)
+        replay_buffer.next_observations[:data_num] = np.random.rand(data_num, 1, 4)
+        replay_buffer.pos = data_num
+
+        dynamics.learn(replay_buffer, work_dir=tmp_path, train_steps=2, longest_epoch=1)
+        # warm-started, with the optimizer state kept between rounds
+        steps.append(next(iter(transition.optimizer.state.values()))["step"].item())
+
+    # one epoch of 2 batches per round, whatever the size of data
+    assert steps == [2, 4]
+    assert len(transition.elite_indices) == transition.elite_num
+
+
+def test_learn_packed_data(tmp_path):
+    dynamics = prepare()
+    transition = dynamics.transition
+    replay_buffer = make_buffer(1000)
+
+    # the buffer wraps around in the last round, overwriting its oldest rows
+    for pos, rows in [(600, np.arange(600)), (100, np.arange(600, 1100) % 1000)]:
+        replay_buffer.observations[rows] = np.random.rand(len(rows), 1, 4)
+        replay_buffer.next_observations[rows] = np.random.rand(len(rows), 1, 4)
+        replay_buffer.pos, replay_buffer.full = pos, pos < 600
+
+        dynamics.learn(replay_buffer, work_dir=tmp_path, train_steps=2, longest_epoch=1)
+        # the rows of this round are packed in place, the same as packing all data again
+        inputs, outputs = dynamics.dataset_cache.get("transition")
+        assert torch.equal(transition.packed_data.data, torch.cat(list(inputs.values()) + list(outputs.values()), dim=-1))
+
+
+def test_async_learn(tmp_path):
+    dynamics = prepare()
+    live_transition = dynamics.transition
+    replay_buffer = make_buffer(1000)
+    replay_buffer.observations[:300] = np.random.rand(300, 1, 4)
+    # learnable, so that the round validates better than the live mech
+    replay_buffer.next_observations[:300] = 0.5 * replay_buffer.observations[:300]
+    replay_buffer.pos = 300
+
+    # keep the weights of any improvement of the short round
+    live_transition.improvement_threshold = 0.0
+
+    learner = AsyncDynamicsLearner(dynamics)
+    learner.start(replay_buffer, work_dir=tmp_path, train_steps=2, longest_epoch=1)
+    weights = [p.detach().clone() for p in live_transition.network.parameters()]
+
+    # the live mech is untouched while learning in background
+    batch_obs = np.random.rand(8, 4).astype(np.float32)
+    batch_action = np.random.rand(8, 2).astype(np.float32)
+    dynamics.step(batch_obs, batch_action)
+    learner.wait()
+    assert all(torch.equal(p, w) for p, w in zip(live_transition.network.parameters(), weights))
+
+    assert learner.maybe_swap() and learner.rejected == []
+    assert dynamics.transition is not live_transition
+    assert len(dynamics.transition.elite_indices) == dynamics.transition.elite_num
+    # trained on the shadow only
+    assert next(iter(dynamics.transition.optimizer.state.values()))["step"].item() == 2
+    assert len(live_transition.optimizer.state) == 0
+    assert not learner.maybe_swap()
+
+    # the replaced live mech is the shadow of the next round, warm-started in place and sharing the packed data
+    shadow_transition, transition = live_transition, dynamics.transition
+    assert learner.shadow_mechs["transition"] is shadow_transition
+    replay_buffer.observations[300:400] = np.random.rand(100, 1, 4)
+    replay_buffer.next_observations[300:400] = 0.5 * replay_buffer.observations[300:400]
+    replay_buffer.pos = 400
+    learner.start(replay_buffer, work_dir=tmp_path, train_steps=2, longest_epoch=0)
+    learner.wait()
+    assert learner.shadow_mechs["transition"] is shadow_transition
+    assert all(torch.equal(p, w) for p, w in zip(shadow_transition.network.parameters(), transition.network.parameters()))
+    assert next(iter(shadow_transition.optimizer.state.values()))["step"].item() == 2
+    assert shadow_transition.packed_data is transition.packed_data and transition.packed_data.size == 400
+
+
+def test_async_learn_rejected(tmp_path):
+    dynamics = prepare()
+    live_transition = dynamics.transition
+    replay_buffer = make_buffer(1000)
+    replay_buffer.observations[:300] = np.random.rand(300, 1, 4)
+    replay_buffer.next_observations[:300] = np.random.rand(300, 1, 4)
+    replay_buffer.pos = 300
+
+    learner = AsyncDynamicsLearner(dynamics)
+    # a round without any epoch does not validate better than the live mech
+    learner.start(replay_buffer, work_dir=tmp_path, train_steps=2, longest_epoch=0)
+    learner.wait()
+
+    assert not learner.maybe_swap()
+    assert learner.rejected == ["transition"]
+    assert dynamics.transition is live_transition and learner.shadow_mechs["transition"] is not live_transition
+    # a new round can start after the rejection
+    assert not learner.running
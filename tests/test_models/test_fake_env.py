@@ -0,0 +1,102 @@
+from types import SimpleNamespace
+
+import numpy as np
+
+from cmrl.models.fake_env import VecFakeEnv, TorchVecFakeEnv
+from tests.test_models.test_dynamics import prepare
+
+
+def make_env(env_cls, dynamics, num_envs=16, max_episode_steps=3):
+    rng = np.random.default_rng(0)
+    return env_cls(
+        num_envs,
+        dynamics.state_space,
+        dynamics.action_space,
+        dynamics,
+        reward_fn=lambda next_obs, obs, act: next_obs.sum(-1, keepdims=True),
+        termination_fn=lambda next_obs, obs, act: next_obs[:, :1] > 2,
+        get_init_obs_fn=lambda num: rng.random((num, 4), dtype=np.float32),
+        max_episode_steps=max_episode_steps,
+    )
+
+
+def test_torch_vec_fake_env():
+    dynamics = prepare()
+    env, torch_env = make_env(VecFakeEnv, dynamics), make_env(TorchVecFakeEnv, dynamics)
+
+    obs, torch_obs = env.reset(), torch_env.reset()
+    assert np.allclose(obs, torch_obs)
+
+    for step in range(5):
+        actions = np.random.rand(16, 2).astype(np.float32)
+        env.step_async(actions)
+        torch_env.step_async(actions)
+        obs, reward, done, infos = env.step_wait()
+        torch_obs, torch_reward, torch_done, torch_infos = torch_env.step_wait()
+
+        assert np.allclose(obs, torch_obs, atol=1e-5)
+        assert np.allclose(reward, torch_reward, atol=1e-5)
+        assert (done == torch_done).all()
+        for idx in np.flatnonzero(done):
+            assert infos[idx]["TimeLimit.truncated"] == torch_infos[idx]["TimeLimit.truncated"]
+            assert np.allclose(infos[idx]["terminal_observation"], torch_infos[idx]["terminal_observation"], atol=1e-5)
+
+
+def test_bulk_reset():
+    dynamics = prepare()
+    # only the fields used in branch-rollout
+    replay_buffer = SimpleNamespace(observations=np.zeros((100, 1, 4), dtype=np.float32), buffer_size=100, full=False, pos=50)
+    replay_buffer.observations[:50, 0] = np.random.rand(50, 4)
+
+    envs = []
+    for env_cls in [VecFakeEnv, TorchVecFakeEnv]:
+        env = env_cls(
+            16,
+            dynamics.state_space,
+            dynamics.action_space,
+            dynamics,
+            reward_fn=lambda next_obs, obs, act: next_obs.sum(-1, keepdims=True),
+            termination_fn=lambda next_obs, obs, act: next_obs[:, :1] > 2,
+            real_replay_buffer=replay_buffer,
+            max_episode_steps=1,
+            branch_rollout=True,
+        )
+        env.seed(0)
+        env.reset()
+        envs.append(env)
+
+    actions = np.random.rand(16, 2).astype(np.float32)
+    for env in envs:
+        env.step_async(actions)
+    (obs, _, done, _), (torch_obs, _, torch_done, _) = [env.step_wait() for env in envs]
+
+    # all envs are truncated, and reset to the same obs in buffer by the seeded generators
+    assert done.all() and torch_done.all()
+    assert np.allclose(obs, torch_obs)
+    assert all((replay_buffer.observations[:50, 0] == o).all(-1).any() for o in obs)
+
+
+def test_seeded_bulk_reset():
+    dynamics = prepare()
+    replay_buffer = SimpleNamespace(observations=np.random.rand(100, 1, 4).astype(np.float32), buffer_size=100, full=True)
+
+    draws = []
+    for seed in [0, 0, 1]:
+        env = VecFakeEnv(
+            16,
+            dynamics.state_space,
+            dynamics.action_space,
+            dynamics,
+            reward_fn=lambda next_obs, obs, act: next_obs.sum(-1, keepdims=True),
+            termination_fn=lambda next_obs, obs, act: next_obs[:, :1] > 2,
+            real_replay_buffer=replay_buffer,
+            branch_rollout=True,
+            seed=seed,
+        )
+        env.reset()
+        env.bulk_reset(np.arange(8))
+        draws.append(env._current_batch_obs.copy())
+
+    # seeded at construction, without calling `seed`
+    assert np.array_equal(draws[0], draws[1])
+    assert not np.array_equal(draws[0], draws[2])
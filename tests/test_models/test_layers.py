@@ -133,3 +133,14 @@ def test_repr():
 def test_device():
     layer = ParallelLinear(3, 5).to("cpu")
     assert str(layer.device) == "cpu"
+
+
+def test_truncated_normal_init():
+    input_dim = 200
+    layer = ParallelLinear(input_dim=input_dim, output_dim=200, extra_dims=[20, 7])
+
+    # every parallel network is sampled from the same truncated normal
+    std = 1 / (2 * input_dim**0.5)
+    weight = layer.weight.detach()
+    assert weight.abs().max() <= 2 * std
+    assert torch.allclose(weight.std(dim=(-2, -1)), torch.full((20, 7), 0.88 * std), rtol=0.05)
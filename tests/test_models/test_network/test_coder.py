@@ -1,8 +1,9 @@
 import torch
 from torch.nn.functional import one_hot
 
-from cmrl.models.networks.coder import VariableEncoder, VariableDecoder
-from cmrl.utils.variables import ContinuousVariable, DiscreteVariable, BinaryVariable
+from cmrl.models.constant import ENCODER_CFG, DECODER_CFG
+from cmrl.models.networks.coder import VariableEncoder, VariableDecoder, EncoderBank, DecoderBank
+from cmrl.utils.variables import ContinuousVariable, DiscreteVariable, BinaryVariable, RadianVariable
 
 
 def test_continuous_encoder():
@@ -100,3 +101,142 @@ def test_binary_decoder():
 
     assert outputs.shape == (batch_size, 1)
     assert (outputs >= 0).all() and (outputs <= 1).all()
+
+
+def test_encoder_bank():
+    ensemble_num = 7
+    batch_size = 128
+
+    variables = [
+        ContinuousVariable(name="obs_0", dim=1),
+        RadianVariable(name="obs_1", dim=1),
+        BinaryVariable(name="obs_2"),
+        ContinuousVariable(name="act_0", dim=1),
+    ]
+
+    bank = EncoderBank(variables, ENCODER_CFG)
+    inputs = dict([(var.name, torch.rand(ensemble_num, batch_size, 1)) for var in variables])
+    outputs = bank(inputs)
+
+    assert outputs.shape == (ensemble_num, batch_size, len(variables), ENCODER_CFG.output_dim)
+
+
+def test_encoder_bank_checkpoint(tmp_path):
+    batch_size = 128
+
+    variables = [
+        ContinuousVariable(name="obs_0", dim=1),
+        RadianVariable(name="obs_1", dim=1),
+        ContinuousVariable(name="act_0", dim=1),
+    ]
+    encoders = [
+        VariableEncoder(
+            var,
+            ENCODER_CFG.output_dim,
+            hidden_dims=list(ENCODER_CFG.hidden_dims),
+            activation_fn_cfg=ENCODER_CFG.activation_fn_cfg,
+        )
+        for var in variables
+    ]
+    for encoder in encoders:
+        encoder.save(tmp_path)
+
+    # load checkpoints of ``VariableEncoder``
+    bank = EncoderBank(variables, ENCODER_CFG)
+    bank.load(tmp_path)
+
+    inputs = dict([(var.name, torch.rand(batch_size, 1) * 10) for var in variables])
+    outputs = bank(inputs)
+    for i, encoder in enumerate(encoders):
+        assert torch.allclose(outputs[:, i], encoder(inputs[variables[i].name]), atol=1e-5)
+
+    # save checkpoints of ``VariableEncoder``
+    bank.save(tmp_path)
+    for i, encoder in enumerate(encoders):
+        encoder.load(tmp_path)
+        assert torch.allclose(outputs[:, i], encoder(inputs[variables[i].name]), atol=1e-5)
+
+
+def test_coder_bank_init():
+    torch.manual_seed(0)
+    variables = [ContinuousVariable(name="obs_{}".format(i), dim=1) for i in range(20)]
+
+    banks = [EncoderBank(variables, ENCODER_CFG), DecoderBank(variables, DECODER_CFG)]
+    coders = [
+        [VariableEncoder(var, ENCODER_CFG.output_dim, hidden_dims=list(ENCODER_CFG.hidden_dims)) for var in variables],
+        [VariableDecoder(var, DECODER_CFG.input_dim, hidden_dims=list(DECODER_CFG.hidden_dims)) for var in variables],
+    ]
+    for bank, single_coders in zip(banks, coders):
+        for key, value in single_coders[0].state_dict().items():
+            bank_values = torch.stack([bank.variable_state_dict(var.name)[key] for var in variables])
+            single_values = torch.stack([coder.state_dict()[key] for coder in single_coders])
+            # the default initialization of ``nn.Linear``, i.e. U(-1/sqrt(fan-in), 1/sqrt(fan-in)) of weight and bias
+            bound = 1 / single_coders[0].state_dict()[key.replace("bias", "weight")].shape[-1] ** 0.5
+            assert bank_values.abs().max() <= bound and single_values.abs().max() <= bound
+            assert torch.isclose(bank_values.std(), single_values.std(), rtol=0.1)
+
+
+def test_decoder_bank():
+    ensemble_num = 7
+    batch_size = 128
+
+    variables = [
+        ContinuousVariable(name="next_obs_0", dim=1),
+        RadianVariable(name="next_obs_1", dim=1),
+        ContinuousVariable(name="next_obs_2", dim=1),
+    ]
+
+    bank = DecoderBank(variables, DECODER_CFG)
+    hidden = torch.rand(len(variables), ensemble_num, batch_size, DECODER_CFG.input_dim)
+    packed, outputs = bank(hidden)
+
+    assert packed.shape == (len(variables), ensemble_num, batch_size, 2)
+    assert list(outputs.keys()) == [var.name for var in variables]
+    for i, var in enumerate(variables):
+        assert torch.equal(outputs[var.name], packed[i])
+
+
+def test_mixed_decoder_bank():
+    ensemble_num = 7
+    batch_size = 128
+
+    variables = [
+        ContinuousVariable(name="reward", dim=1),
+        BinaryVariable(name="terminal"),
+    ]
+
+    bank = DecoderBank(variables, DECODER_CFG)
+    hidden = torch.rand(len(variables), ensemble_num, batch_size, DECODER_CFG.input_dim)
+    packed, outputs = bank(hidden)
+
+    assert packed is None
+    assert outputs["reward"].shape == (ensemble_num, batch_size, 2)
+    assert outputs["terminal"].shape == (ensemble_num, batch_size, 1)
+
+
+def test_decoder_bank_checkpoint(tmp_path):
+    batch_size = 128
+
+    variables = [
+        ContinuousVariable(name="next_obs_0", dim=1),
+        RadianVariable(name="next_obs_1", dim=1),
+    ]
+    decoders = [
+        VariableDecoder(
+            var,
+            DECODER_CFG.input_dim,
+            hidden_dims=list(DECODER_CFG.hidden_dims),
+            activation_fn_cfg=DECODER_CFG.activation_fn_cfg,
+        )
+        for var in variables
+    ]
+    for decoder in decoders:
+        decoder.save(tmp_path)
+
+    bank = DecoderBank(variables, DECODER_CFG)
+    bank.load(tmp_path)
+
+    hidden = torch.rand(len(variables), batch_size, DECODER_CFG.input_dim)
+    packed, outputs = bank(hidden)
+    for i, decoder in enumerate(decoders):
+        assert torch.allclose(packed[i], decoder(hidden[i]), atol=1e-5)
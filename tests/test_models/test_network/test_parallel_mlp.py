@@ -34,3 +34,31 @@ def test_parallel_mlp():
     )
 
     assert str(mlp.device).startswith(device)
+
+
+def test_parallel_mlp_select():
+    input_dim = 5
+    output_dim = 6
+    extra_dims = [3, 7]
+    batch_size = 128
+
+    mlp = ParallelMLP(
+        input_dim=input_dim,
+        output_dim=output_dim,
+        hidden_dims=[32, 32],
+        extra_dims=extra_dims,
+        activation_fn_cfg=DictConfig({"_target_": "torch.nn.SiLU"}),
+    )
+    index = torch.tensor([4, 0, 2])
+    elite_mlp = mlp.select(-1, index)
+
+    model_in = torch.rand((batch_size, input_dim))
+    with torch.no_grad():
+        model_out = mlp(model_in)
+        elite_out = elite_mlp(model_in)
+    assert elite_out.shape == (3, len(index), batch_size, output_dim)
+    assert torch.allclose(elite_out, model_out[:, index], atol=1e-6)
+
+    # the full network is left untouched
+    assert mlp.extra_dims == extra_dims
+    assert mlp(model_in).shape == (*extra_dims, batch_size, output_dim)
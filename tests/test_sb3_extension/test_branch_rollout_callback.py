@@ -0,0 +1,76 @@
+from types import SimpleNamespace
+
+import numpy as np
+from gym import spaces
+from stable_baselines3.common.type_aliases import TrainFreq, TrainFrequencyUnit
+
+from cmrl.sb3_extension.branch_rollout_callback import BranchRolloutCallback, feeding_collect_rollouts
+from tests.test_models.test_dynamics import make_buffer, prepare
+
+
+class RandomPolicy:
+    action_space = spaces.Box(-1, 1, (2,), dtype=np.float32)
+
+    def __init__(self):
+        self.training_modes = []
+
+    def set_training_mode(self, mode):
+        self.training_modes.append(mode)
+
+    def predict(self, obs, deterministic=False):
+        return np.random.uniform(-1, 1, (len(obs), 2)).astype(np.float32), None
+
+    def scale_action(self, action):
+        return action
+
+
+class StubAgent:
+    """Only the members of SB3's off-policy algorithm used by ``feeding_collect_rollouts`` and the callback."""
+
+    def __init__(self, replay_buffer, total_timesteps):
+        self.policy = RandomPolicy()
+        self.replay_buffer = replay_buffer
+        self.logger = SimpleNamespace(record=lambda key, value: None)
+        self.num_timesteps = 0
+        self._total_timesteps = total_timesteps
+        self.progress_updates = 0
+        self.on_steps = 0
+
+    def get_env(self):
+        return None
+
+    def _update_current_progress_remaining(self, num_timesteps, total_timesteps):
+        self.progress_updates += 1
+
+    def _on_step(self):
+        self.on_steps += 1
+
+
+def test_feeding_collect_rollouts():
+    dynamics = prepare()
+    real_replay_buffer = SimpleNamespace(observations=np.random.uniform(-1, 1, (100, 1, 4)), buffer_size=100, pos=0, full=True)
+    replay_buffer = make_buffer(1000)
+    replay_buffer.size = lambda: replay_buffer.buffer_size if replay_buffer.full else replay_buffer.pos
+
+    agent = StubAgent(replay_buffer, total_timesteps=25)
+    callback = BranchRolloutCallback(
+        dynamics,
+        real_replay_buffer,
+        reward_fn=lambda next_obs, obs, act: next_obs.sum(-1),
+        termination_fn=lambda next_obs, obs, act: np.zeros(len(obs), dtype=bool),
+        rollout_batch_size=16,
+        rollout_length=2,
+        freq_rollout=10,
+        seed=0,
+    )
+    callback.init_callback(agent)
+
+    # no env is stepped, so none is given
+    rollout_returns = [
+        feeding_collect_rollouts(agent, None, callback, TrainFreq(5, TrainFrequencyUnit.STEP), replay_buffer) for _ in range(5)
+    ]
+    assert all(r.episode_timesteps == 5 and r.n_episodes == 0 and r.continue_training for r in rollout_returns)
+    assert agent.num_timesteps == callback.n_calls == agent.on_steps == agent.progress_updates == 25
+    assert agent.policy.training_modes == [False] * 5
+    # fed at the first step and every 10 steps
+    assert replay_buffer.size() == 3 * 16 * 2
@@ -0,0 +1,135 @@
+import numpy as np
+from causallearn.utils.KCI.KCI import KCI_CInd
+
+from cmrl.utils.ci_scheduler import CITestScheduler, KernelCache
+from cmrl.utils.ci_test import get_ci_test
+
+
+def prepare(data_num=200):
+    inputs = [np.random.uniform(-1, 1, (data_num, 1)) for _ in range(4)]
+    outputs = [
+        np.sin(3 * inputs[0]) + 0.1 * np.random.randn(data_num, 1),
+        inputs[1] * inputs[2] + 0.1 * np.random.randn(data_num, 1),
+        np.random.randn(data_num, 1),
+    ]
+    return inputs, outputs
+
+
+def test_kernel_cache_budget():
+    entry = dict(K=np.zeros((256, 256)))  # 0.5 MiB
+    cache = KernelCache(budget=1.2)
+    for key in range(3):
+        cache.put(key, entry)
+    assert len(cache) == 2 and cache.get(0) is None
+
+    # the latest entry is kept even beyond the budget
+    cache.put(3, dict(K=np.zeros((512, 512))))
+    assert len(cache) == 1 and cache.get(3) is not None
+
+
+def test_cached_kci():
+    inputs, outputs = prepare()
+    data_y, data_z = inputs[0], np.concatenate(inputs[1:], axis=1)
+
+    cache = KernelCache()
+    for data_x in outputs:
+        p_value, _ = KCI_CInd().compute_pvalue(data_x, data_y, data_z)
+        assert np.isclose(get_ci_test("kci")(data_x, data_y, data_z, cache=cache, cache_key=0), p_value)
+    # kernel matrices of y and z are computed once for all x
+    assert len(cache) == 1
+
+
+def test_scheduler():
+    inputs, outputs = prepare()
+    sample_indices = np.random.permutation(200)[:100]
+
+    with CITestScheduler(inputs, outputs) as scheduler:
+        for in_idx in range(len(inputs)):
+            scheduler.submit(in_idx, sample_indices, in_idx, [0, 2])
+        results = dict(scheduler.results())
+
+    assert sorted(results.keys()) == list(range(len(inputs)))
+    data_z = np.concatenate([data[sample_indices] for data in inputs[1:]], axis=1)
+    p_value = get_ci_test("kci")(outputs[2][sample_indices], inputs[0][sample_indices], data_z)
+    assert sorted(results[0].keys()) == [0, 2] and np.isclose(results[0][2], p_value)
+
+
+def test_parallel_scheduler():
+    np.random.seed(0)
+    inputs, outputs = prepare()
+    sample_indices = [np.random.permutation(200)[:100] for _ in range(2)]
+
+    results = []
+    for workers in [1, 2]:
+        with CITestScheduler(inputs, outputs, workers=workers) as scheduler:
+            for in_idx in range(len(inputs)):
+                for time in range(2):
+                    scheduler.submit((in_idx, time), sample_indices[time], in_idx, [0, 1, 2])
+            results.append(dict(scheduler.results()))
+
+    # spawned workers with pinned BLAS threads give the same p-values as the current process
+    assert results[0].keys() == results[1].keys()
+    for key, p_values in results[0].items():
+        assert p_values.keys() == results[1][key].keys()
+        assert np.allclose([p_values[i] for i in range(3)], [results[1][key][i] for i in range(3)])
+
+
+def test_parallel_scheduler_early_exit():
+    inputs, outputs = prepare()
+    sample_indices = np.random.permutation(200)[:100]
+
+    with CITestScheduler(inputs, outputs, workers=2) as scheduler:
+        for in_idx in range(len(inputs)):
+            scheduler.submit(in_idx, sample_indices, in_idx, [0, 1, 2])
+        key, p_values = next(scheduler.results())
+    # tests left pending are cancelled on exit
+    assert scheduler._pool is None and len(scheduler._pending) == 0
+
+
+def test_rcit():
+    np.random.seed(0)
+    inputs, outputs = prepare(data_num=2000)
+    data_y, data_z = inputs[0], np.concatenate(inputs[1:], axis=1)
+
+    for ci_test in ["rcit", "rcot"]:
+        cache = KernelCache()
+        p_values = [get_ci_test(ci_test)(data_x, data_y, data_z, cache=cache, cache_key=0) for data_x in outputs]
+        # output 0 depends on input 0, and the others are independent of it given other inputs
+        assert p_values[0] < 0.01 and p_values[1] > 0.01 and p_values[2] > 0.01
+        assert len(cache) == 1
+        # the same random features with or without cache
+        assert np.isclose(get_ci_test(ci_test)(outputs[1], data_y, data_z), p_values[1])
+
+
+def test_low_rank_kci():
+    np.random.seed(0)
+    inputs, outputs = prepare(data_num=1000)
+    data_y, data_z = inputs[0], np.concatenate(inputs[1:], axis=1)
+
+    for factorization in ["nystrom", "icholesky"]:
+        cache = KernelCache()
+        ci_test = get_ci_test("kci-" + factorization, rank=300)
+        p_values = [ci_test(data_x, data_y, data_z, cache=cache, cache_key=0) for data_x in outputs]
+        assert p_values[0] < 0.01 and p_values[1] > 0.01 and p_values[2] > 0.01
+        assert len(cache) == 1
+        # close to the exact p-values, and the same with or without cache
+        assert np.isclose(p_values[1], get_ci_test("kci")(outputs[1], data_y, data_z), atol=0.05)
+        assert np.isclose(ci_test(outputs[1], data_y, data_z), p_values[1])
+
+
+def test_kci_eig_products():
+    np.random.seed(0)
+    inputs, outputs = prepare(data_num=500)
+    data_y, data_z = np.concatenate(inputs[:2], axis=1), np.concatenate(inputs[2:], axis=1)
+
+    # multi-dimensional y, with more products of the eigenvectors than the sample size
+    p_values = [
+        get_ci_test("kci-nystrom", rank=100, max_eig_products=max_eig_products, approx=False)(outputs[0], data_y, data_z)
+        for max_eig_products in [2000, 300]
+    ]
+    assert p_values[0] < 0.01 and p_values[1] < 0.01
+    p_values = [
+        get_ci_test("kci-nystrom", rank=100, max_eig_products=max_eig_products)(outputs[2], data_y, data_z)
+        for max_eig_products in [2000, 300]
+    ]
+    assert np.isclose(p_values[0], p_values[1], atol=0.05)
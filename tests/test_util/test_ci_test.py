@@ -0,0 +1,41 @@
+import pickle
+import subprocess
+import sys
+
+import numpy as np
+import pytest
+
+from cmrl.utils.ci_test import CITest, get_ci_test, list_ci_tests, register_ci_test
+
+
+def test_lazy_import():
+    # in a fresh interpreter, since other tests may have imported the backends
+    code = (
+        "import sys\n"
+        "import cmrl.models.causal_mech\n"
+        "from cmrl.utils.ci_test import get_ci_test\n"
+        "get_ci_test('rcot')\n"
+        "heavy = ['rpy2', 'sklearn', 'causallearn', 'cmrl.utils.RCIT']\n"
+        "assert not [name for name in heavy if name in sys.modules], sys.modules.keys()\n"
+    )
+    result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True)
+    assert result.returncode == 0, result.stderr
+
+
+def test_registry():
+    assert {"kci", "rcit", "rcot", "rcit-r"} <= set(list_ci_tests())
+    with pytest.raises(AssertionError):
+        get_ci_test("unknown")
+
+    register_ci_test("rcot-small", CITest("cmrl.utils.RCIT:RCIT_CInd", dict(rcot=True, num_f=20)))
+    ci_test = pickle.loads(pickle.dumps(get_ci_test("rcot-small")))
+    data_z = np.random.uniform(-1, 1, (500, 2))
+    data_y = np.random.uniform(-1, 1, (500, 1))
+    assert 0 <= ci_test(data_z[:, :1] ** 2, data_y, data_z) <= 1
+
+
+def test_ci_test_kwargs():
+    ci_test = get_ci_test("kci-nystrom", rank=50)
+    assert ci_test.init_kwargs == dict(rank=50, factorization="nystrom")
+    # the registered test is left as is
+    assert get_ci_test("kci-nystrom").init_kwargs["rank"] == 200